@@ -16,10 +16,41 @@ parser.add_option("-s", "--skip", dest="skip", metavar="INT", default=0,
 parser.add_option("-b", action="store_true", dest="ignore_bad_association", default=False)
 parser.add_option("-l", "--log", dest="log_file", metavar="FILE", default='',
     help="the name of a log file to be created. ")
+parser.add_option("--stream", action="store_true", dest="streaming", default=False,
+    help="keep input files open and read one event at a time instead of loading whole datasets")
+parser.add_option("--index-cache", action="store_true", dest="index_cache", default=False,
+    help="store/load the event index of each input file in a sidecar file (<input>.l2s-index.npz)")
+parser.add_option("--no-mmap", action="store_false", dest="use_mmap", default=True,
+    help="do not memory-map uncompressed, contiguous input datasets")
+parser.add_option("--prefetch", dest="prefetch", metavar="INT", default=0,
+    help="number of upcoming events to read in a background thread (0 to disable)")
+parser.add_option("--check-integrity", action="store_true", dest="check_integrity", default=False,
+    help="run the input integrity check for whole files when reading them and report counts")
+parser.add_option("--shard", dest="shard", metavar="I/N", default='',
+    help="process only the I-th of N equal ranges of entries (counting from 0)")
+parser.add_option("--entries", dest="entries", metavar="A:B", default='',
+    help="process only the entries A to B (B excluded, either can be omitted)")
+parser.add_option("--workers", dest="workers", metavar="INT", default=0,
+    help="number of worker processes converting entries in parallel (0 to run in a single process)")
+parser.add_option("--pipeline", action="store_true", dest="pipeline", default=False,
+    help="run reading, conversion (with --workers processes) and storing as concurrent stages")
+parser.add_option("--queue-size", dest="queue_size", metavar="INT", default=4,
+    help="number of entries buffered between two stages of --pipeline")
+parser.add_option("--checkpoint", dest="checkpoint", metavar="INT", default=0,
+    help="write the output in numbered files of INT entries and record the finished ones in a checkpoint file")
+parser.add_option("--resume", action="store_true", dest="resume", default=False,
+    help="continue a job from its checkpoint file (<output>.l2s-checkpoint.json) if it exists")
+parser.add_option("--overwrite", action="store_true", dest="overwrite", default=False,
+    help="write the output (and its numbered files with --checkpoint) even if it exists, without resuming")
+parser.add_option("--precompute-hits", action="store_true", dest="precompute_hits", default=False,
+    help="compute packet positions and energies for blocks of packets in the reader instead of per event")
 
 (data, args) = parser.parse_args()
 
-if os.path.isfile(data.output_filename):
+# an existing output can only be continued from its checkpoint
+checkpoint_file = data.output_filename + larnd2supera.utils.SegmentWriter.CHECKPOINT_SUFFIX
+if os.path.isfile(data.output_filename) and not (data.resume and os.path.isfile(checkpoint_file)) \
+    and not data.overwrite:
     print('Ouput file already exists:',data.output_filename)
     print('Exiting')
     sys.exit(1)
@@ -32,6 +63,28 @@ if not data.config in larnd2supera.config.list_config() and not os.path.isfile(d
     sys.exit(2)
 
 
+shard = None
+if data.shard:
+    try:
+        shard = tuple(int(v) for v in data.shard.split('/'))
+        assert len(shard) == 2 and 0 <= shard[0] < shard[1]
+    except (ValueError, AssertionError):
+        print('Invalid shard argument (expected I/N):',data.shard)
+        sys.exit(2)
+
+entry_range = None
+if data.entries:
+    try:
+        entry_range = tuple(int(v) if v else None for v in data.entries.split(':'))
+        assert len(entry_range) == 2
+    except (ValueError, AssertionError):
+        print('Invalid entries argument (expected A:B):',data.entries)
+        sys.exit(2)
+
+if shard and entry_range:
+    print('Only one of --shard and --entries can be given')
+    sys.exit(2)
+
 if len(args) < 1:
     print('No input files given! Exiting')
     sys.exit(3)
@@ -58,4 +111,18 @@ larnd2supera.utils.run_supera(out_file=data.output_filename,
     num_skip=int(data.skip),
     ignore_bad_association=bool(data.ignore_bad_association),
     save_log=data.log_file,
+    streaming=bool(data.streaming),
+    index_cache=bool(data.index_cache),
+    use_mmap=bool(data.use_mmap),
+    prefetch=int(data.prefetch),
+    check_integrity=bool(data.check_integrity),
+    entry_range=entry_range,
+    shard=shard,
+    workers=int(data.workers),
+    pipeline=bool(data.pipeline),
+    queue_size=int(data.queue_size),
+    checkpoint=int(data.checkpoint),
+    resume=bool(data.resume),
+    precompute_hits=bool(data.precompute_hits),
+    overwrite=bool(data.overwrite),
     )
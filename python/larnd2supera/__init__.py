@@ -1,3 +1,3 @@
 import edep2supera
 #import utils,config
-from . import utils, config, driver, reader, pdg2mass
\ No newline at end of file
+from . import utils, config, driver, reader, pdg2mass, association, bulk, pipeline, geometry, checkpoint, particle_type
\ No newline at end of file
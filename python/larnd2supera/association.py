@@ -0,0 +1,674 @@
+'''
+Array implementation of the packet to segment association performed in SuperaDriver.ReadEvent.
+All functions operate on numpy arrays and do not depend on ROOT/supera.
+'''
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Association engines selectable with the "AssociationEngine" configuration key of SuperaDriver
+ENGINES = ('loop','numpy','jit')
+
+# True if the "jit" engine can be used (numba is importable)
+HAS_JIT = numba is not None
+
+# Counters filled by associate and associate_jit (in the order of the jit kernel counters array)
+COUNT_KEYS = ('packet_noass_input','ass_saturation','fraction_nan','packet_frac_sum',
+    'ass_negative_charge','drop_ctr_negative_charge','ass_drop_charge','drop_ctr_low_charge',
+    'invalid_traj_id','drop_ctr_drift_dist','ass_drop_dist','drop_ctr_dist3d',
+    'drop_ctr_total','ass_charge_frac','ass_frac',
+    )
+# Counters that are sums of fractions or energies (others are counts)
+_SUM_KEYS = ('packet_frac_sum','ass_negative_charge','ass_drop_charge','ass_drop_dist','ass_charge_frac')
+
+
+def poca_fraction(a, b, pt):
+    '''
+    Clamped fraction along a=>b of the point of closest approach to pt.
+    a, b, pt are arrays of shape (N,D). Same as SuperaDriver.PoCA_numpy(scalar=True) per row.
+    '''
+    ab = b - a
+    return _clamp_fraction(((pt - a) * ab).sum(axis=-1), (ab * ab).sum(axis=-1))
+
+
+def _clamp_fraction(t, denom):
+    frac = np.divide(t, denom, out=np.zeros_like(t), where=denom>0)
+    return np.where(t <= 0., 0., np.where(t >= denom, 1., frac))
+
+
+def segment_poca(start, end, t_start, t_end, pt):
+    '''
+    PoCA of N points pt to N segments start=>end of shape (N,3), measured from the earlier (in time) end point.
+    Returns the clamped fraction, the interpolated time and the 3D distance, each of shape (N,).
+    Same as the PoCA computation with supera.Point3D in SuperaDriver.AssociateLoop per row.
+    '''
+    table = SegmentTable(start, end, t_start, t_end)
+    return table.PoCA(np.arange(len(table)), np.asarray(pt,dtype=float))
+
+
+def segment_points(segments):
+    '''
+    Start and end points, shape (N,3), of segments as float arrays.
+    '''
+    start = np.column_stack([segments['x_start'],segments['y_start'],segments['z_start']]).astype(float)
+    end   = np.column_stack([segments['x_end'  ],segments['y_end'  ],segments['z_end'  ]]).astype(float)
+    return start, end
+
+
+class TPCLookup:
+    '''
+    Locate points in the TPCs given by larndsim.consts.detector.TPC_BORDERS (shape (T,3,2) with
+    z, y, x borders per TPC) and return their drift direction, for M points at once.
+    The first TPC containing a point (within tolerance) is used, same as SuperaDriver.drift_dir.
+
+    If grid is True, a regular grid of cells is built from the (tolerance expanded) TPC borders
+    so that a point is located with one searchsorted per axis instead of a comparison against
+    every TPC. Points exactly on a cell edge use the comparison against every TPC.
+    '''
+
+    # Maximum number of grid cells to build a grid lookup
+    MAX_GRID_CELLS = 1000000
+
+    def __init__(self, tpc_borders, tolerance=2e-2, grid=True):
+        borders = np.asarray(tpc_borders,dtype=float).reshape(-1,3,2)
+        # (T,3) lower/upper bounds in x, y, z order
+        self._lower = np.column_stack([borders[:,2].min(axis=1),borders[:,1,0],borders[:,0,0]]) - tolerance
+        self._upper = np.column_stack([borders[:,2].max(axis=1),borders[:,1,1],borders[:,0,1]]) + tolerance
+        # -1: drift toward +x, 1: drift toward -x
+        self._sign = np.where(borders[:,2,1] > borders[:,2,0], -1, 1)
+        self._edges = None
+        self._cells = None
+        if grid and len(borders):
+            self._build_grid()
+
+    def __len__(self):
+        return len(self._sign)
+
+    def Bounds(self):
+        '''
+        Lower and upper bounds (T,3) in x, y, z order (tolerance included) and drift direction (T,) of the TPCs.
+        '''
+        return self._lower, self._upper, self._sign
+
+    def _build_grid(self):
+        edges = [np.unique(np.concatenate([self._lower[:,i],self._upper[:,i]])) for i in range(3)]
+        shape = tuple(len(e)-1 for e in edges)
+        if min(shape) < 1 or np.prod(shape) > self.MAX_GRID_CELLS:
+            return
+        centers = np.meshgrid(*[(e[1:]+e[:-1])/2. for e in edges], indexing='ij')
+        self._edges = edges
+        self._cells = self._brute_index(np.column_stack([c.ravel() for c in centers])).reshape(shape)
+
+    def _brute_index(self, xyz):
+        inside = ((self._lower[None,:,:] <= xyz[:,None,:]) & (xyz[:,None,:] <= self._upper[None,:,:])).all(axis=2)
+        return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+    def Index(self, xyz):
+        '''
+        TPC index (-1 if outside all TPCs) of points xyz of shape (M,3).
+        '''
+        xyz = np.asarray(xyz,dtype=float).reshape(-1,3)
+        if self._cells is None:
+            return self._brute_index(xyz)
+
+        index = np.full(len(xyz),-1,dtype=np.int64)
+        cell = []
+        on_edge = np.zeros(len(xyz),dtype=bool)
+        inside = np.ones(len(xyz),dtype=bool)
+        for i, edges in enumerate(self._edges):
+            pos = np.searchsorted(edges, xyz[:,i], side='right') - 1
+            inside &= (pos >= 0) & (pos < len(edges)-1)
+            on_edge |= edges[np.clip(pos,0,len(edges)-1)] == xyz[:,i]
+            cell.append(np.clip(pos,0,len(edges)-2))
+        inside &= ~on_edge
+        index[inside] = self._cells[tuple(c[inside] for c in cell)]
+        if on_edge.any():
+            index[on_edge] = self._brute_index(xyz[on_edge])
+        return index
+
+    def DriftDirection(self, xyz):
+        '''
+        Drift direction (-1, 1, or 0 if outside all TPCs) of points xyz of shape (M,3).
+        '''
+        index = self.Index(xyz)
+        return np.where(index < 0, 0, self._sign[index])
+
+
+def drift_direction(xyz, tpc_borders, tolerance=2e-2):
+    '''
+    Drift direction (-1, 1, or 0 if outside all TPCs) of points xyz of shape (M,3).
+    Same as SuperaDriver.drift_dir per point. Use TPCLookup to reuse the TPC arrays across calls.
+    '''
+    return TPCLookup(tpc_borders, tolerance, grid=False).DriftDirection(xyz)
+
+
+def along_drift(start, end, pt, drift_dir, v_drift, time_future, time_past):
+    '''
+    Vectorized SuperaDriver.associated_along_drift for N (segment, point) pairs.
+    start, end, pt are arrays of shape (N,3) and drift_dir a function returning
+    the drift direction of an array of points (e.g. TPCLookup.DriftDirection).
+    Returns (passed, ambiguous) boolean arrays. Ambiguous pairs (no or both drift
+    directions found for the segment) do not pass.
+    '''
+    zeros = np.zeros(len(start))
+    table = SegmentTable(start, end, zeros, zeros, drift_dir)
+    return table.AlongDrift(np.arange(len(table)), np.asarray(pt,dtype=float), drift_dir, v_drift, time_future, time_past)
+
+
+class SegmentTable:
+    '''
+    Per-event segment geometry used by the association: start/end points, time ordered end points
+    (pt0 is the earlier one) with their difference, squared lengths and the drift directions of the
+    start and end points. Computed once per event and shared by associate and search, which then
+    gather the rows of the (segment, point) pairs they test.
+    '''
+
+    def __init__(self, start, end, t_start, t_end, drift_dir=None):
+        self.start = np.asarray(start,dtype=float).reshape(-1,3)
+        self.end   = np.asarray(end,dtype=float).reshape(-1,3)
+        t_start = np.asarray(t_start,dtype=float)
+        t_end   = np.asarray(t_end,dtype=float)
+        # along-drift check: projection on the YZ plane from the start point
+        self.span = self.end - self.start
+        self.length2_yz = (self.span[:,1:] * self.span[:,1:]).sum(axis=1)
+        self.drift = np.zeros((2,len(self.start)),dtype=int)
+        if drift_dir is not None:
+            self.drift[:] = np.asarray(drift_dir(np.concatenate([self.start,self.end]))).reshape(2,-1)
+        # PoCA: projection from the earlier (in time) end point
+        forward = t_start < t_end
+        self.pt0 = np.where(forward[:,None], self.start, self.end)
+        self.t0  = np.where(forward, t_start, t_end)
+        self.t1  = np.where(forward, t_end, t_start)
+        self.delta = np.where(forward[:,None], self.end, self.start) - self.pt0
+        self.length2 = (self.delta * self.delta).sum(axis=1)
+
+    @classmethod
+    def FromSegments(cls, segments, drift_dir):
+        start, end = segment_points(segments)
+        return cls(start, end, segments['t0_start'], segments['t0_end'], drift_dir)
+
+    def __len__(self):
+        return len(self.start)
+
+    def PoCA(self, iseg, pt):
+        '''
+        Clamped fraction, interpolated time and 3D distance for the pairs of segments iseg and points pt (N,3).
+        '''
+        pt0, delta = self.pt0[iseg], self.delta[iseg]
+        frac = _clamp_fraction(((pt - pt0) * delta).sum(axis=1), self.length2[iseg])
+        dist = np.linalg.norm(pt0 + delta * frac[:,None] - pt, axis=1)
+        t0 = self.t0[iseg]
+        return frac, t0 + frac * (self.t1[iseg] - t0), dist
+
+    def AlongDrift(self, iseg, pt, drift_dir, v_drift, time_future, time_past):
+        '''
+        Drift window (passed, ambiguous) masks for the pairs of segments iseg and points pt (N,3).
+        See along_drift.
+        '''
+        start, span = self.start[iseg], self.span[iseg]
+        frac = _clamp_fraction(((pt[:,1:] - start[:,1:]) * span[:,1:]).sum(axis=1), self.length2_yz[iseg])
+        seg_pt = start + frac[:,None] * span
+
+        directions = np.concatenate([self.drift[:,iseg], np.asarray(drift_dir(seg_pt)).reshape(1,-1)])
+        has_neg = (directions == -1).any(axis=0)
+        has_pos = (directions ==  1).any(axis=0)
+        ambiguous = has_neg == has_pos
+
+        # -1: signal | segment | induced signal, 1: induced signal | segment | signal
+        low = seg_pt[:,0] - np.where(has_neg, time_future, time_past) * v_drift
+        hi  = seg_pt[:,0] + np.where(has_neg, time_past, time_future) * v_drift
+        passed = ~ambiguous & (low < pt[:,0]) & (pt[:,0] < hi)
+        return passed, ambiguous
+
+
+def check_segment_index(track_ids, num_segments):
+    '''
+    Raise IndexError if an association (track_ids > -1) refers to a segment index out of [0, num_segments)
+    '''
+    bad = track_ids >= num_segments
+    if bad.any():
+        raise IndexError(f'Association refers to the segment index {track_ids[bad].max()} out of range (size {num_segments})')
+
+
+def associate(xyz, energy, track_ids, fractions, segments, trackid2idx,
+    drift_dir, v_drift, time_future, time_past, distance_limit, charge_limit, table=None):
+    '''
+    Associate packets to segments with array operations (AssociationEngine: numpy).
+
+    xyz, energy: position (P,3) and energy (P,) of the data packets
+    track_ids, fractions: association arrays (P,M) with segment indices local to segments (-1 for none)
+    segments: structured array of segments for this event
+    trackid2idx: array mapping a track ID to the particle index (-1 if invalid)
+    table: SegmentTable of segments (computed if not given)
+
+    Applies the same selection as the packet loop in SuperaDriver.ReadEvent: negative fraction,
+    charge limit, traj_id validity, drift window and PoCA distance cuts, followed by the fraction
+    renormalization among the remaining segments of each packet.
+
+    Returns a dict with
+      associated  : dict of arrays (index, x, y, z, t, e, dedx), one entry per (packet, segment) association
+      unassociated: dict of arrays (x, y, z, e), one entry per packet without association
+      counts      : dict of counters (SuperaDriver.LOG_KEYS and invalid_traj_id)
+      raw_sum, ana_sum: the sum of input packet energies and the energy accounted in the output
+    '''
+    xyz = np.asarray(xyz,dtype=float).reshape(-1,3)
+    energy = np.asarray(energy,dtype=float)
+    num_packets = len(energy)
+
+    check_segment_index(track_ids, len(segments))
+
+    counts = dict()
+    valid = track_ids > -1
+    counts['packet_noass_input'] = int((~valid).all(axis=1).sum())
+    counts['ass_saturation'] = int((track_ids != -1).all(axis=1).sum())
+    counts['fraction_nan'] = int((np.isnan(fractions) & valid).any(axis=1).sum())
+    counts['packet_frac_sum'] = float(fractions[valid].sum())
+
+    # (packet, segment) pairs, in the order of the packet loop
+    ip, islot = np.nonzero(valid)
+    seg = track_ids[ip,islot]
+    frac = fractions[ip,islot].astype(float)
+    de = energy[ip]
+
+    def select(mask):
+        return ip[mask], islot[mask], seg[mask], frac[mask], de[mask]
+
+    # 1. too small fraction (in relative and absolute)
+    cut = frac <= 0.
+    counts['ass_negative_charge'] = float((frac * de)[cut].sum())
+    counts['drop_ctr_negative_charge'] = int(cut.sum())
+    ip, islot, seg, frac, de = select(~cut)
+
+    cut = frac * de < charge_limit
+    counts['ass_drop_charge'] = float(frac[cut].sum())
+    counts['drop_ctr_low_charge'] = int(cut.sum())
+    ip, islot, seg, frac, de = select(~cut)
+
+    # 2. associated segments with invalid trajectory ID
+    traj_id = segments['traj_id'][seg].astype(np.int64)
+    good = (traj_id >= 0) & (traj_id < len(trackid2idx))
+    good[good] = trackid2idx[traj_id[good]] > -1
+    counts['invalid_traj_id'] = int((~good).sum())
+    ip, islot, seg, frac, de = select(good)
+
+    # 3. along-drift window
+    if table is None:
+        table = SegmentTable.FromSegments(segments, drift_dir)
+    pt = xyz[ip]
+    passed, ambiguous = table.AlongDrift(seg, pt, drift_dir, v_drift, time_future, time_past)
+    if ambiguous.any():
+        i = ambiguous.nonzero()[0][0]
+        raise RuntimeError(f'Found a packet with ambiguous drift direction start {table.start[seg[i]]} end {table.end[seg[i]]} packet {pt[i]}')
+    counts['drop_ctr_drift_dist'] = int((~passed).sum())
+    ip, islot, seg, frac, de = select(passed)
+    pt = pt[passed]
+
+    # 4. PoCA distance, computed from the earlier (in time) end point
+    _, time, dist = table.PoCA(seg, pt)
+
+    cut = dist > distance_limit
+    counts['ass_drop_dist'] = float(frac[cut].sum())
+    counts['drop_ctr_dist3d'] = int(cut.sum())
+    ip, islot, seg, frac, de = select(~cut)
+    time = time[~cut]
+
+    # split the energy among valid, associated segments
+    num_ass = np.bincount(ip, minlength=num_packets)
+    fsum = np.bincount(ip, weights=frac, minlength=num_packets)
+    noass = num_ass < 1
+    counts['drop_ctr_total'] = int(noass.sum())
+    counts['ass_charge_frac'] = float(fsum[~noass].sum())
+    counts['ass_frac'] = int((~noass).sum())
+
+    norm = np.where(fsum[ip] > 0, fsum[ip], num_ass[ip])
+    e = de * frac / norm
+
+    associated = dict(index=trackid2idx[segments['traj_id'][seg].astype(np.int64)],
+        x=xyz[ip,0], y=xyz[ip,1], z=xyz[ip,2],
+        t=time, e=e, dedx=segments['dEdx'][seg].astype(float))
+    unassociated = dict(x=xyz[noass,0], y=xyz[noass,1], z=xyz[noass,2], e=energy[noass])
+
+    return dict(associated=associated,
+        unassociated=unassociated,
+        counts=counts,
+        raw_sum=float(energy.sum()),
+        ana_sum=float(e.sum() + energy[noass].sum()),
+        )
+
+
+class SegmentGrid:
+    '''
+    Uniform grid over the bounding boxes of segments (start/end of shape (S,3)), padded by "padding".
+    Candidates returns, for a set of points, the (point, segment) pairs of segments whose padded
+    bounding box shares a grid cell with the point. Any segment within "padding" of a point
+    (3D distance) is among its candidates.
+    The cell size is at least 2*padding and 1/MAX_CELLS_PER_AXIS of the extent of all segments. Segments
+    covering more than MAX_CELLS_PER_SEGMENT cells (e.g. long tracks) are not put in the grid but are
+    candidates for all points.
+    '''
+    MAX_CELLS_PER_AXIS = 1024
+    MAX_CELLS_PER_SEGMENT = 4096
+
+    def __init__(self, start, end, padding, cell_size=None):
+        lower = np.minimum(start,end) - padding
+        upper = np.maximum(start,end) + padding
+        self._num_segments = len(start)
+        self._origin = lower.min(axis=0) if len(lower) else np.zeros(3)
+        extent = (upper.max(axis=0) - self._origin).max() if len(lower) else 0.
+        self._cell_size = max(float(cell_size) if cell_size else 2.*padding,
+            extent / self.MAX_CELLS_PER_AXIS, 1.e-3)
+        self._shape = np.zeros(3,dtype=np.int64)
+        self._keys = np.zeros(0,dtype=np.int64)
+        self._offsets = np.zeros(1,dtype=np.int64)
+        self._segments = np.zeros(0,dtype=np.int64)
+        self._large = np.zeros(0,dtype=np.int64)
+        if not len(lower):
+            return
+
+        cell_lo = self._cell(lower)
+        cell_hi = self._cell(upper)
+        self._shape = cell_hi.max(axis=0) + 1
+        # expand each segment to the cells covered by its padded bounding box
+        span = cell_hi - cell_lo + 1
+        num_cells = span.prod(axis=1)
+        large = num_cells > self.MAX_CELLS_PER_SEGMENT
+        self._large = np.nonzero(large)[0]
+        num_cells[large] = 0
+        iseg = np.repeat(np.arange(len(lower)), num_cells)
+        local = np.arange(len(iseg)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+        local = self._unravel(local, span[iseg])
+        keys = np.ravel_multi_index(tuple((cell_lo[iseg] + local).T), self._shape)
+        # sort by cell, then segment index
+        order = np.lexsort((iseg, keys))
+        keys, self._segments = keys[order], iseg[order]
+        self._keys, start_index = np.unique(keys, return_index=True)
+        self._offsets = np.append(start_index, len(keys)).astype(np.int64)
+
+    @staticmethod
+    def _unravel(index, span):
+        iz = index % span[:,2]
+        iy = (index // span[:,2]) % span[:,1]
+        ix = index // (span[:,2] * span[:,1])
+        return np.column_stack([ix,iy,iz])
+
+    def _cell(self, xyz):
+        return np.floor((xyz - self._origin) / self._cell_size).astype(np.int64)
+
+    def Count(self, xyz):
+        '''
+        Cell position (in self._keys, -1 if none) and number of candidate segments of points xyz (M,3).
+        '''
+        xyz = np.asarray(xyz,dtype=float).reshape(-1,3)
+        cell = self._cell(xyz)
+        valid = ((cell >= 0) & (cell < self._shape)).all(axis=1)
+        pos = np.full(len(xyz),-1,dtype=np.int64)
+        if valid.any() and len(self._keys):
+            keys = np.ravel_multi_index(tuple(cell[valid].T), self._shape)
+            found = np.searchsorted(self._keys, keys)
+            found[found >= len(self._keys)] = 0
+            pos[valid] = np.where(self._keys[found] == keys, found, -1)
+        counts = np.where(pos < 0, 0, self._offsets[pos+1] - self._offsets[np.maximum(pos,0)])
+        return pos, counts + len(self._large)
+
+    def Candidates(self, xyz, pos=None, counts=None):
+        '''
+        Candidate (point, segment) index pairs for points xyz (M,3), ordered by point then segment.
+        '''
+        if pos is None or counts is None:
+            pos, counts = self.Count(xyz)
+        counts = counts - len(self._large)
+        ipt = np.repeat(np.arange(len(counts)), counts)
+        first = np.repeat(self._offsets[np.maximum(pos,0)], counts)
+        local = np.arange(len(ipt)) - np.repeat(np.cumsum(counts) - counts, counts)
+        iseg = self._segments[first + local]
+        if not len(self._large):
+            return ipt, iseg
+        # segments outside the grid are candidates for all points
+        ipt = np.concatenate([ipt, np.repeat(np.arange(len(counts)), len(self._large))])
+        iseg = np.concatenate([iseg, np.tile(self._large, len(counts))])
+        order = np.lexsort((iseg, ipt))
+        return ipt[order], iseg[order]
+
+
+def search(xyz, segments, drift_dir, v_drift, time_future, time_past, distance_limit, chunk_size=1000000, cell_size=None, table=None):
+    '''
+    Search, for each of the points xyz (M,3), the first segment that passes the drift window
+    (ambiguous drift directions do not pass) and lies within distance_limit.
+    Same as the SearchAssociation loop of SuperaDriver.ReadEvent. Only the segments sharing a
+    SegmentGrid cell with a point are tested, in chunks of at most chunk_size (point, segment) pairs.
+    The SegmentTable of segments is computed if table is not given.
+    Returns the segment index (-1 if none found) and the interpolated time of each point.
+    '''
+    xyz = np.asarray(xyz,dtype=float).reshape(-1,3)
+    found = np.full(len(xyz),-1,dtype=np.int64)
+    time  = np.zeros(len(xyz),dtype=float)
+    if not len(segments) or not len(xyz):
+        return found, time
+
+    if table is None:
+        table = SegmentTable.FromSegments(segments, drift_dir)
+
+    grid = SegmentGrid(table.start, table.end, distance_limit, cell_size)
+    pos, counts = grid.Count(xyz)
+    # split points into chunks of at most chunk_size candidate pairs (at least one point each)
+    bounds = [0]
+    total = np.cumsum(counts)
+    while bounds[-1] < len(xyz):
+        offset = total[bounds[-1]-1] if bounds[-1] else 0
+        bounds.append(max(bounds[-1]+1, int(np.searchsorted(total, offset + chunk_size, side='right'))))
+
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        ipt, iseg = grid.Candidates(xyz[first:last], pos[first:last], counts[first:last])
+        ipt += first
+        passed, _ = table.AlongDrift(iseg, xyz[ipt], drift_dir, v_drift, time_future, time_past)
+        ipt, iseg = ipt[passed], iseg[passed]
+        _, t, dist = table.PoCA(iseg, xyz[ipt])
+        ok = dist < distance_limit
+        ipt, iseg, t = ipt[ok], iseg[ok], t[ok]
+        # pairs are ordered by (point, segment): keep the first segment for each point
+        ipt, first_pair = np.unique(ipt, return_index=True)
+        found[ipt] = iseg[first_pair]
+        time[ipt] = t[first_pair]
+
+    return found, time
+
+
+#
+# Compiled (numba) association kernel for AssociationEngine: jit.
+# The kernel functions are plain python, compiled with numba.njit if available.
+#
+def _clamp(t, denom):
+    if t <= 0.:
+        return 0.
+    if t >= denom:
+        return 1.
+    return t / denom
+
+
+def _drift_sign(x, y, z, lower, upper, sign):
+    for i in range(len(sign)):
+        if lower[i,0] <= x <= upper[i,0] and lower[i,1] <= y <= upper[i,1] and lower[i,2] <= z <= upper[i,2]:
+            return sign[i]
+    return 0
+
+
+def _associate_kernel(xyz, energy, track_ids, fractions,
+    start, span, length2_yz, drift, pt0, delta, length2, t0, t1, traj_id, dedx, trackid2idx,
+    lower, upper, sign, v_drift, time_future, time_past, distance_limit, charge_limit,
+    out_index, out_position, out_e, out_dedx, unassociated, counts):
+    '''
+    Packet loop of associate for one event. Fills the out_* arrays (one row per association),
+    the unassociated flag per packet and counts (COUNT_KEYS order).
+    Returns the number of associations and the first packet with an ambiguous drift direction (-1 if none).
+    '''
+    num_ass = 0
+    num_slots = track_ids.shape[1]
+    flag = np.zeros(num_slots, np.bool_)
+    times = np.zeros(num_slots)
+    for ip in range(len(energy)):
+        x, y, z = xyz[ip,0], xyz[ip,1], xyz[ip,2]
+        de = energy[ip]
+
+        # input quality
+        num_valid = 0
+        saturated = True
+        has_nan = False
+        for it in range(num_slots):
+            flag[it] = track_ids[ip,it] > -1
+            if track_ids[ip,it] == -1:
+                saturated = False
+            if flag[it]:
+                num_valid += 1
+                counts[3] += fractions[ip,it]
+                if np.isnan(fractions[ip,it]):
+                    has_nan = True
+        if num_valid == 0:
+            counts[0] += 1
+        if saturated:
+            counts[1] += 1
+        if has_nan:
+            counts[2] += 1
+
+        for it in range(num_slots):
+            if not flag[it]:
+                continue
+            f = fractions[ip,it]
+            seg = track_ids[ip,it]
+
+            # 1. too small fraction (in relative and absolute)
+            if f <= 0.:
+                flag[it] = False
+                counts[4] += f * de
+                counts[5] += 1
+                continue
+            if f * de < charge_limit:
+                flag[it] = False
+                counts[6] += f
+                counts[7] += 1
+                continue
+
+            # 2. associated segments with invalid trajectory ID
+            tid = traj_id[seg]
+            if tid < 0 or tid >= len(trackid2idx) or trackid2idx[tid] < 0:
+                flag[it] = False
+                counts[8] += 1
+                continue
+
+            # 3. along-drift window
+            frac = _clamp((y - start[seg,1]) * span[seg,1] + (z - start[seg,2]) * span[seg,2], length2_yz[seg])
+            px = start[seg,0] + frac * span[seg,0]
+            py = start[seg,1] + frac * span[seg,1]
+            pz = start[seg,2] + frac * span[seg,2]
+            direction = _drift_sign(px, py, pz, lower, upper, sign)
+            has_neg = drift[0,seg] == -1 or drift[1,seg] == -1 or direction == -1
+            has_pos = drift[0,seg] ==  1 or drift[1,seg] ==  1 or direction ==  1
+            if has_neg == has_pos:
+                return num_ass, ip
+            if has_neg:
+                low, hi = px - time_future * v_drift, px + time_past * v_drift
+            else:
+                low, hi = px - time_past * v_drift, px + time_future * v_drift
+            if not (low < x < hi):
+                flag[it] = False
+                counts[9] += 1
+                continue
+
+            # 4. PoCA distance, computed from the earlier (in time) end point
+            frac = _clamp((x - pt0[seg,0]) * delta[seg,0] + (y - pt0[seg,1]) * delta[seg,1] + (z - pt0[seg,2]) * delta[seg,2], length2[seg])
+            dx = pt0[seg,0] + delta[seg,0] * frac - x
+            dy = pt0[seg,1] + delta[seg,1] * frac - y
+            dz = pt0[seg,2] + delta[seg,2] * frac - z
+            if np.sqrt(dx*dx + dy*dy + dz*dz) > distance_limit:
+                flag[it] = False
+                counts[10] += f
+                counts[11] += 1
+                continue
+            times[it] = t0[seg] + frac * (t1[seg] - t0[seg])
+
+        # split the energy among valid, associated segments
+        num_flag = 0
+        fsum = 0.
+        for it in range(num_slots):
+            if flag[it]:
+                num_flag += 1
+                fsum += fractions[ip,it]
+        if num_flag < 1:
+            unassociated[ip] = True
+            counts[12] += 1
+            continue
+        counts[13] += fsum
+        counts[14] += 1
+        norm = fsum if fsum > 0 else num_flag
+        for it in range(num_slots):
+            if not flag[it]:
+                continue
+            seg = track_ids[ip,it]
+            out_index[num_ass] = trackid2idx[traj_id[seg]]
+            out_position[num_ass,0], out_position[num_ass,1], out_position[num_ass,2] = x, y, z
+            out_position[num_ass,3] = times[it]
+            out_e[num_ass] = de * fractions[ip,it] / norm
+            out_dedx[num_ass] = dedx[seg]
+            num_ass += 1
+
+    return num_ass, -1
+
+
+if HAS_JIT:
+    _clamp = numba.njit(cache=True)(_clamp)
+    _drift_sign = numba.njit(cache=True)(_drift_sign)
+    _associate_kernel = numba.njit(cache=True)(_associate_kernel)
+
+
+def associate_jit(xyz, energy, track_ids, fractions, segments, trackid2idx,
+    tpc_lookup, v_drift, time_future, time_past, distance_limit, charge_limit, table=None):
+    '''
+    Same as associate (AssociationEngine: jit) with a compiled per-packet loop. tpc_lookup is a TPCLookup.
+    The compilation is cached on disk by numba (cache=True) across runs.
+    '''
+    xyz = np.ascontiguousarray(xyz,dtype=np.float64).reshape(-1,3)
+    energy = np.ascontiguousarray(energy,dtype=np.float64)
+    track_ids = np.ascontiguousarray(track_ids,dtype=np.int64)
+    fractions = np.ascontiguousarray(fractions,dtype=np.float64)
+    trackid2idx = np.ascontiguousarray(trackid2idx,dtype=np.int64)
+    # the compiled kernel does not check the bounds
+    check_segment_index(track_ids, len(segments))
+    if table is None:
+        table = SegmentTable.FromSegments(segments, tpc_lookup.DriftDirection)
+    lower, upper, sign = tpc_lookup.Bounds()
+
+    num_packets = len(energy)
+    num_pairs = int((track_ids > -1).sum())
+    out_index = np.zeros(num_pairs,dtype=np.int64)
+    out_position = np.zeros((num_pairs,4),dtype=np.float64)
+    out_e = np.zeros(num_pairs,dtype=np.float64)
+    out_dedx = np.zeros(num_pairs,dtype=np.float64)
+    unassociated = np.zeros(num_packets,dtype=np.bool_)
+    counts = np.zeros(len(COUNT_KEYS),dtype=np.float64)
+
+    num_ass, ambiguous = _associate_kernel(xyz, energy, track_ids, fractions,
+        table.start, table.span, table.length2_yz, np.ascontiguousarray(table.drift,dtype=np.int64),
+        table.pt0, table.delta, table.length2, table.t0, table.t1,
+        np.ascontiguousarray(segments['traj_id'],dtype=np.int64),
+        np.ascontiguousarray(segments['dEdx'],dtype=np.float64),
+        trackid2idx,
+        lower, upper, sign.astype(np.int64), float(v_drift), float(time_future), float(time_past),
+        float(distance_limit), float(charge_limit),
+        out_index, out_position, out_e, out_dedx, unassociated, counts)
+    if ambiguous >= 0:
+        raise RuntimeError(f'Found a packet with ambiguous drift direction packet {xyz[ambiguous]}')
+
+    counts = {key:(float(value) if key in _SUM_KEYS else int(value)) for key,value in zip(COUNT_KEYS,counts)}
+    associated = dict(index=out_index[:num_ass],
+        x=out_position[:num_ass,0], y=out_position[:num_ass,1], z=out_position[:num_ass,2],
+        t=out_position[:num_ass,3], e=out_e[:num_ass], dedx=out_dedx[:num_ass])
+    unassociated = dict(x=xyz[unassociated,0], y=xyz[unassociated,1], z=xyz[unassociated,2], e=energy[unassociated])
+
+    return dict(associated=associated,
+        unassociated=unassociated,
+        counts=counts,
+        raw_sum=float(energy.sum()),
+        ana_sum=float(associated['e'].sum() + unassociated['e'].sum()),
+        )
@@ -0,0 +1,230 @@
+'''
+Bulk conversion between numpy arrays and supera/STL containers (EDeps, index and value vectors).
+EDeps are created in compiled code (declared to ROOT once) instead of one supera.EDep per deposit in python.
+'''
+import threading
+import numpy as np
+import ROOT
+from ROOT import std
+
+# Columns of an EDep. "index" (particle index) is also used for deposits associated to particles.
+EDEP_COLUMNS = ('x','y','z','t','e','dedx')
+
+_CODE = '''
+#include <vector>
+#include <algorithm>
+namespace larnd2supera_bulk {
+
+  template <class EDep>
+  EDep make_edep(size_t i, const double* x, const double* y, const double* z,
+                 const double* e, const double* t, const double* dedx)
+  {
+    EDep edep;
+    edep.x = x[i]; edep.y = y[i]; edep.z = z[i]; edep.e = e[i];
+    if(t)    edep.t    = t[i];
+    if(dedx) edep.dedx = dedx[i];
+    return edep;
+  }
+
+  template <class Container>
+  void fill_edeps(Container& out, size_t n,
+                  const double* x, const double* y, const double* z,
+                  const double* e, const double* t, const double* dedx)
+  {
+    typedef typename Container::value_type EDep;
+    out.reserve(out.size() + n);
+    for(size_t i=0; i<n; ++i)
+      out.push_back(make_edep<EDep>(i, x, y, z, e, t, dedx));
+  }
+
+  template <class Event>
+  void fill_event(Event& event, size_t n, const long* index,
+                  const double* x, const double* y, const double* z,
+                  const double* e, const double* t, const double* dedx)
+  {
+    typedef typename decltype(event[0].pcloud)::value_type EDep;
+    std::vector<size_t> counts(event.size(), 0);
+    for(size_t i=0; i<n; ++i) ++counts[index[i]];
+    for(size_t p=0; p<event.size(); ++p)
+      if(counts[p]) event[p].pcloud.reserve(event[p].pcloud.size() + counts[p]);
+    for(size_t i=0; i<n; ++i)
+      event[index[i]].pcloud.push_back(make_edep<EDep>(i, x, y, z, e, t, dedx));
+  }
+
+  template <class Vector>
+  void assign_index(Vector& out, size_t n, const long* index, typename Vector::value_type invalid)
+  {
+    out.resize(n);
+    for(size_t i=0; i<n; ++i)
+      out[i] = index[i] < 0 ? invalid : index[i];
+  }
+
+  template <class T>
+  void copy_vector(const std::vector<T>& v, T* out)
+  { std::copy(v.begin(), v.end(), out); }
+
+  template <class T>
+  void assign_vector(std::vector<T>& v, size_t n, const T* data)
+  { v.assign(data, data + n); }
+
+  template <class T>
+  size_t total_size(const std::vector<std::vector<T> >& vv)
+  { size_t n=0; for(auto const& v : vv) n += v.size(); return n; }
+
+  template <class T>
+  void copy_vectors(const std::vector<std::vector<T> >& vv, unsigned long* sizes, T* out)
+  {
+    for(size_t i=0; i<vv.size(); ++i) {
+      sizes[i] = vv[i].size();
+      out = std::copy(vv[i].begin(), vv[i].end(), out);
+    }
+  }
+
+  template <class T>
+  void assign_vectors(std::vector<std::vector<T> >& vv, size_t n, const unsigned long* sizes, const T* data)
+  {
+    vv.resize(n);
+    for(size_t i=0; i<n; ++i) {
+      vv[i].assign(data, data + sizes[i]);
+      data += sizes[i];
+    }
+  }
+}
+'''
+
+_declared = False
+_declare_lock = threading.Lock()
+
+
+def declare():
+    '''
+    Compile the bulk fill helpers (once per process).
+    '''
+    global _declared
+    # pipeline stages may call this from several threads
+    with _declare_lock:
+        if not _declared:
+            if not ROOT.gInterpreter.Declare(_CODE):
+                raise RuntimeError('Failed to declare larnd2supera bulk EDep helpers')
+            _declared = True
+    return ROOT.larnd2supera_bulk
+
+
+def _buffer(columns, key, size):
+    if columns.get(key, None) is None:
+        return ROOT.nullptr
+    values = np.ascontiguousarray(columns[key], dtype=np.float64)
+    if len(values) != size:
+        raise ValueError(f'Column {key} has length {len(values)} (expected {size})')
+    return values
+
+
+def _buffers(columns):
+    size = len(columns['e'])
+    return size, [_buffer(columns, key, size) for key in ('x','y','z','e','t','dedx')]
+
+
+def fill_edeps(container, columns):
+    '''
+    Append EDeps to container (std::vector<supera::EDep>) from columns, a dict of arrays with keys
+    x, y, z, e and optionally t, dedx (left to the EDep default if missing).
+    '''
+    size, buffers = _buffers(columns)
+    if size:
+        declare().fill_edeps(container, size, *buffers)
+    return container
+
+
+def fill_event(supera_event, columns):
+    '''
+    Append EDeps to the pcloud of the particles in supera_event (supera::EventInput) from columns,
+    a dict of arrays with keys index (particle index), x, y, z, e and optionally t, dedx.
+    The order of deposits within each particle follows the order of the columns.
+    '''
+    size, buffers = _buffers(columns)
+    if not size:
+        return supera_event
+    index = np.ascontiguousarray(columns['index'], dtype=np.int64)
+    if len(index) != size or index.min() < 0 or index.max() >= supera_event.size():
+        raise IndexError(f'Particle index out of range [0,{supera_event.size()}) or wrong length')
+    declare().fill_event(supera_event, size, index, *buffers)
+    return supera_event
+
+
+def assign_index(container, index, invalid):
+    '''
+    Assign an index array (negative values mapped to invalid) to container (std::vector<supera::Index_t>).
+    '''
+    index = np.ascontiguousarray(index, dtype=np.int64)
+    declare().assign_index(container, len(index), index, invalid)
+    return container
+
+
+# C++ types of the numpy dtypes supported by the vector conversions below
+_CTYPES = {np.dtype(np.float32):'float', np.dtype(np.uint64):'unsigned long'}
+
+
+def vector_to_array(vec, dtype):
+    '''
+    Copy a std::vector (of float or unsigned long, given by dtype) into a new numpy array.
+    '''
+    out = np.empty(vec.size(), dtype=dtype)
+    if len(out):
+        declare().copy_vector[_CTYPES[out.dtype]](vec, out)
+    return out
+
+
+def array_to_vector(array, vec):
+    '''
+    Assign a numpy array to a std::vector of the same type.
+    '''
+    array = np.ascontiguousarray(array)
+    declare().assign_vector[_CTYPES[array.dtype]](vec, len(array), array)
+    return vec
+
+
+def vectors_to_arrays(vv, dtype):
+    '''
+    Copy a std::vector<std::vector<T>> into two numpy arrays: the size of each vector and the concatenated values.
+    '''
+    ctype = _CTYPES[np.dtype(dtype)]
+    sizes = np.zeros(vv.size(), dtype=np.uint64)
+    data = np.empty(declare().total_size[ctype](vv), dtype=dtype)
+    if len(sizes):
+        declare().copy_vectors[ctype](vv, sizes, data)
+    return sizes, data
+
+
+def arrays_to_vectors(sizes, data, vv):
+    '''
+    Assign the output of vectors_to_arrays to a std::vector<std::vector<T>>.
+    '''
+    sizes = np.ascontiguousarray(sizes, dtype=np.uint64)
+    data = np.ascontiguousarray(data)
+    declare().assign_vectors[_CTYPES[data.dtype]](vv, len(sizes), sizes, data)
+    return vv
+
+
+def edep_columns(edeps):
+    '''
+    Read x, y, z, t, e, dedx of a container of supera::EDep into a dict of numpy arrays.
+    '''
+    values = np.array([[edep.x,edep.y,edep.z,edep.t,edep.e,edep.dedx] for edep in edeps],dtype=float).reshape(-1,len(EDEP_COLUMNS))
+    return {key:values[:,i] for i,key in enumerate(EDEP_COLUMNS)}
+
+
+def concatenate(*columns):
+    '''
+    Concatenate dicts of column arrays with the same keys (None entries are skipped).
+    '''
+    columns = [c for c in columns if c is not None]
+    if not columns:
+        return None
+    return {key:np.concatenate([c[key] for c in columns]) for key in columns[0]}
+
+
+def select(columns, mask):
+    '''
+    Select the rows of a dict of column arrays.
+    '''
+    return {key:np.asarray(value)[mask] for key,value in columns.items()}
@@ -0,0 +1,152 @@
+'''
+Segmented output of run_supera with a checkpoint file, so that a job can be resumed after
+the last finalized segment (see SegmentWriter).
+'''
+import os
+import json
+
+
+class SegmentWriter:
+    '''
+    Output of run_supera. With checkpoint=K>0 the entries are written in numbered segment files
+    (<out_file stem>_0000.root, ...) of K entries each. A checkpoint file (<out_file>.l2s-checkpoint.json)
+    records the finalized segments and the next entry to convert, so that a job can be resumed after
+    the last finalized segment. With checkpoint=0 everything goes to out_file.
+    The job parameters (see JOB_KEYS) are recorded in the checkpoint and have to match when resuming.
+    Existing output files are only written again when resuming from the checkpoint or with overwrite.
+    open_output(name) returns the writer (larcv IOManager) of an output file and store_output(writer, output)
+    stores one entry (by default get_iomanager and store_entry of larnd2supera.utils).
+    '''
+    CHECKPOINT_SUFFIX = '.l2s-checkpoint.json'
+    JOB_KEYS = ('input_files','config','entries','entry_range','shard')
+
+    def __init__(self, out_file, checkpoint=0, resume=False, input_files=(), config='', entries=(0,0),
+        entry_range=None, shard=None, overwrite=False, open_output=None, store_output=None):
+
+        if open_output is None or store_output is None:
+            from larnd2supera.utils import get_iomanager, store_entry
+            open_output, store_output = get_iomanager, store_entry
+        self._open_output = open_output
+        self._store_output = store_output
+
+        if isinstance(input_files,str):
+            input_files = [input_files]
+        self._out_file = out_file
+        self._checkpoint = int(checkpoint)
+        self._path = out_file + self.CHECKPOINT_SUFFIX
+        job = dict(input_files=[os.path.abspath(f) for f in input_files],
+            config=os.path.abspath(config) if os.path.isfile(config) else config,
+            entries=[int(entries[0]),int(entries[1])],
+            entry_range=entry_range,
+            shard=shard)
+        # as stored in the checkpoint (tuples become lists)
+        job = json.loads(json.dumps(job))
+        self._state = dict(job,
+            checkpoint=self._checkpoint,
+            next_entry=int(entries[0]),
+            segments=[],
+            done=False)
+        self._count = 0
+        self._writer = None
+
+        if resume and os.path.isfile(self._path):
+            with open(self._path) as f:
+                try:
+                    state = json.load(f)
+                except ValueError as e:
+                    raise ValueError(f'Checkpoint {self._path} is not readable ({e})')
+            for key in self.JOB_KEYS:
+                if state.get(key) != job[key]:
+                    raise ValueError(f'Checkpoint {self._path} was made for {key}={state.get(key)} (given {job[key]})')
+            self._state = state
+            if self._checkpoint < 1:
+                self._checkpoint = state['checkpoint']
+            print(f'Resuming from entry {state["next_entry"]} after {len(state["segments"])} segment(s)')
+            return
+
+        if overwrite:
+            # start over: the checkpoint of a previous job must not be resumed later
+            if os.path.isfile(self._path):
+                os.remove(self._path)
+            return
+
+        if self._checkpoint > 0 and os.path.isfile(self._path):
+            raise FileExistsError(f'Checkpoint {self._path} exists (resume the job, remove it or overwrite)')
+        # nothing to resume from: never overwrite an existing output
+        existing = [name for name in self.OutputFiles() if os.path.isfile(name)]
+        if existing:
+            raise FileExistsError(f'Output file(s) {", ".join(existing)} exist without a checkpoint {self._path} to resume from')
+
+    def Done(self):
+        return self._state['done']
+
+    def NextEntry(self):
+        '''
+        First entry not stored in a finalized segment.
+        '''
+        return self._state['next_entry']
+
+    def Segments(self):
+        return list(self._state['segments'])
+
+    def OutputFiles(self):
+        '''
+        Names of all the output files of the job.
+        '''
+        if self._checkpoint < 1:
+            return [self._out_file]
+        first, last = self._state['entries']
+        num_segments = max(1, -(-(last - first) // self._checkpoint))
+        return [self._segment_name(index) for index in range(num_segments)]
+
+    def _segment_name(self, index=None):
+        if self._checkpoint < 1:
+            return self._out_file
+        if index is None:
+            index = len(self._state['segments'])
+        stem, ext = os.path.splitext(self._out_file)
+        return f'{stem}_{index:04d}{ext}'
+
+    def _open(self):
+        self._writer = self._open_output(self._segment_name())
+        self._count = 0
+
+    def _commit(self, next_entry):
+        self._writer.finalize()
+        self._writer = None
+        self._state['segments'].append(self._segment_name())
+        self._state['next_entry'] = int(next_entry)
+        self._save()
+
+    def _save(self):
+        if self._checkpoint > 0:
+            # replace the checkpoint atomically so that a job killed here leaves a valid one
+            with open(self._path + '.tmp', 'w') as f:
+                json.dump(self._state, f, indent=1)
+            os.replace(self._path + '.tmp', self._path)
+
+    def Store(self, entry, output):
+        '''
+        Store the result of process_entry for entry (entries have to come in increasing order).
+        '''
+        if self._writer is None:
+            self._open()
+        self._store_output(self._writer, output)
+        self._count += 1
+        if self._checkpoint > 0 and self._count >= self._checkpoint:
+            self._commit(entry + 1)
+
+    def Finalize(self):
+        '''
+        Finalize the last segment and mark the job as done in the checkpoint.
+        '''
+        if self.Done():
+            return
+        self._state['done'] = True
+        if self._writer is None and self._state['segments']:
+            self._state['next_entry'] = self._state['entries'][1]
+            self._save()
+            return
+        if self._writer is None:
+            self._open()
+        self._commit(self._state['entries'][1])
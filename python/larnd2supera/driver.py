@@ -3,7 +3,6 @@ import edep2supera, ROOT
 from ROOT import supera,std,TG4TrajectoryPoint
 import numpy as np
 import LarpixParser
-from LarpixParser import hit_parser as HitParser
 import yaml
 from yaml import Loader
 import larnd2supera
@@ -31,11 +30,24 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         'drop_ctr_negative_charge',
         )
 
+    # Fields of the input segments ("tracks") and trajectories used by the driver.
+    # The reader can load only these columns (plus the event separator).
+    SEGMENT_FIELDS = ('trackID','traj_id','dEdx',
+        'x_start','y_start','z_start','t0_start',
+        'x_end','y_end','z_end','t0_end',
+        )
+    TRAJECTORY_FIELDS = ('eventID','trackID','parentID','pdgId',
+        'pxyz_start','xyz_start','xyz_end','t_start','t_end',
+        'start_process','start_subprocess',
+        )
+
     def __init__(self):
         super().__init__()
         self._geom_dict  = None
         self._run_config = None
+        self._pixel_geometry = None
         self._trackid2idx = std.vector('supera::Index_t')()
+        self._trackid_index = None
         self._allowed_detectors = std.vector('std::string')()
         self._edeps_unassociated = std.vector('supera::EDep')()
         self._edeps_all = std.vector('supera::EDep')()
@@ -45,13 +57,24 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         self._ass_time_past=5 # 1.8
         self._log=None
         self._electron_energy_threshold=0
+        self._g4_codes=larnd2supera.particle_type.g4_codes(TG4TrajectoryPoint.G4ProcessType,
+            TG4TrajectoryPoint.G4ProcessSubtype)
         self._search_association=True
+        self._association_engine='loop'
+        self._tpc_lookup=None
+        self._v_drift=None
         print("Initialized SuperaDriver class")
 
 
     def parser_run_config(self):
         return self._run_config
 
+    def parser_geometry(self):
+        return self._geom_dict
+
+    def pixel_geometry(self):
+        return self._pixel_geometry
+
 
     def log(self,data_holder):
 
@@ -63,30 +86,10 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
 
     def drift_dir(self,xyz):
 
-        from larndsim.consts import detector
-            
-        pixel_plane = -1
-        for ip, plane in enumerate(detector.TPC_BORDERS):
-            if not plane[0][0]-2e-2 <= xyz[2] <= plane[0][1]+2e-2: continue
-            if not plane[1][0]-2e-2 <= xyz[1] <= plane[1][1]+2e-2: continue
-            if not min(plane[2][1]-2e-2,plane[2][0]-2e-2) <= xyz[0] <= max(plane[2][1]+2e-2,plane[2][0]+2e-2):
-                continue
-            pixel_plane=ip
-            break
-                    
-        if pixel_plane < 0:
-            #raise ValueError(f'Could not find pixel plane id for xyz {xyz}')
-            return 0
-
-        edges = detector.TPC_BORDERS[pixel_plane][2]
-        if edges[1] > edges[0]:
-            return -1
-        else:
-            return 1
+        return int(self._tpc_lookup.DriftDirection(xyz)[0])
 
     def associated_along_drift(self, seg, packet_pt, raise_error=True, verbose=False):
 
-        from larndsim.consts import detector
         # project on 2D, find the closest point on YZ plane 
         a = np.array([seg['x_start'],seg['y_start'],seg['z_start']],dtype=float)
         b = np.array([seg['x_end'],seg['y_end'],seg['z_end']],dtype=float)
@@ -95,7 +98,7 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         seg_pt = a + frac*(b-a)
 
         # Check the drift direction
-        directions = [self.drift_dir(pt) for pt in [a,b,seg_pt]]
+        directions = list(self._tpc_lookup.DriftDirection([a,b,seg_pt]))
         if 1 in directions and -1 in directions:
             if raise_error:
                 #print(f'start {a}\nend {b}\nyz {seg_pt}\npacket {packet_pt}')
@@ -103,13 +106,13 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
             return False
         elif -1 in directions:
             # signal | segment | induced signal
-            low = seg_pt[0] - self._ass_time_future * detector.V_DRIFT
-            hi  = seg_pt[0] + self._ass_time_past * detector.V_DRIFT
+            low = seg_pt[0] - self._ass_time_future * self._v_drift
+            hi  = seg_pt[0] + self._ass_time_past * self._v_drift
             #return low < packet_pt[0] < hi
         elif 1 in directions:
             # induced signal | segment | signal
-            low = seg_pt[0] - self._ass_time_past * detector.V_DRIFT
-            hi  = seg_pt[0] + self._ass_time_future * detector.V_DRIFT
+            low = seg_pt[0] - self._ass_time_past * self._v_drift
+            hi  = seg_pt[0] + self._ass_time_future * self._v_drift
             #return low < packet_pt[0] < hi
         elif raise_error:
             print(f'start {a}\nend {b}\nyz {seg_pt}\npacket {packet_pt}')
@@ -138,8 +141,14 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
             else:
                 try:
                     self._run_config, self._geom_dict = LarpixParser.util.detector_configuration(cfg_dict['PropertyKeyword'])
+                    # pixel geometry lookup table for the packet positions (cached on disk)
+                    self._pixel_geometry = larnd2supera.geometry.PixelGeometry.Load(cfg_dict['PropertyKeyword'],
+                        self._geom_dict, use_cache=cfg_dict.get('PixelGeometryCache',True))
                     from larndsim.consts import detector
                     detector.load_detector_properties(cfg_dict['PropertyKeyword'])
+                    # TPC borders and drift velocity used by the association
+                    self._tpc_lookup = larnd2supera.association.TPCLookup(detector.TPC_BORDERS)
+                    self._v_drift = detector.V_DRIFT
 
                 except ValueError:
                     print('Failed to load with PropertyKeyword',cfg_dict['PropertyKeyword'])
@@ -173,6 +182,13 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
                 self._ass_charge_limit)
             self._search_association = cfg.get('SearchAssociation',
                 self._search_association)
+            self._association_engine = cfg.get('AssociationEngine',
+                self._association_engine)
+            if not self._association_engine in larnd2supera.association.ENGINES:
+                raise ValueError(f'AssociationEngine "{self._association_engine}" not in {larnd2supera.association.ENGINES}')
+            if self._association_engine == 'jit' and not larnd2supera.association.HAS_JIT:
+                print('[WARNING] AssociationEngine "jit" requires numba (not found), using "numpy" instead')
+                self._association_engine = 'numpy'
         super().ConfigureFromFile(fname)
 
 
@@ -228,50 +244,52 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         supera_event = supera.EventInput()
         supera_event.reserve(len(data.trajectories))
         
-        # 1. Loop over trajectories, create one supera::ParticleInput for each
-        #    store particle inputs in list to fill parent information later
-        max_trackid = max(data.trajectories['trackID'].max(),data.segments['trackID'].max())
-        self._trackid2idx.resize(int(max_trackid+1),supera.kINVALID_INDEX)
-        for traj in data.trajectories:
-            # print("traj",traj)
+        # 1. Compute particle information column-wise, create one supera::ParticleInput for each trajectory
+        self._trackid_index = self.TrackIndex(data)
+        larnd2supera.bulk.assign_index(self._trackid2idx, self._trackid_index, supera.kINVALID_INDEX)
+        cols = self.ParticleColumns(data, self._trackid_index)
+        values = {key:cols[key].tolist() for key in ['trackid','pdg','px','py','pz','energy_init','parent_trackid','parent_pdg']}
+        vtx = np.column_stack([cols['vtx'],cols['vtx_t']]).tolist()
+        end = np.column_stack([cols['end'],cols['end_t']]).tolist()
+
+        # 2. Particle type from the process, parent and kinematics information (see ProcessTypes)
+        ptypes, processes = self.ProcessTypes(cols)
+
+        for i in range(len(data.trajectories)):
             part_input = supera.ParticleInput()
-
             part_input.valid = True
-            part_input.part  = self.TrajectoryToParticle(traj)
-            part_input.part.id = supera_event.size()
-            #part_input.type  = self.GetG4CreationProcess(traj)
-            #supera_event.append(part_input)
+            p = supera.Particle()
+            p.id             = i
+            p.trackid        = values['trackid'][i]
+            p.pdg            = values['pdg'][i]
+            p.px, p.py, p.pz = values['px'][i], values['py'][i], values['pz'][i]
+            p.energy_init    = values['energy_init'][i]
+            p.vtx            = supera.Vertex(*vtx[i])
+            p.end_pt         = supera.Vertex(*end[i])
+            p.parent_trackid = values['parent_trackid'][i]
+            p.parent_pdg     = values['parent_pdg'][i]
+            p.process        = processes[i]
+            p.type           = ptypes[i]
+            part_input.part = p
             if self.GetLogger().verbose():
                 if verbose > 1:
-                    print('  TrackID',part_input.part.trackid,
-                          'PDG',part_input.part.pdg,
-                          'Energy',part_input.part.energy_init)
-            if traj['trackID'] < 0:
-                print('Negative track ID found',traj['trackID'])
-                raise ValueError
-            self._trackid2idx[int(traj['trackID'])] = part_input.part.id
+                    print('  TrackID',p.trackid,
+                          'PDG',p.pdg,
+                          'Energy',p.energy_init)
             supera_event.push_back(part_input)
-            
+
         if verbose > 0:
             print("--- trajectory filling %s seconds ---" % (time.time() - start_time)) 
         start_time = time.time()  
 
-        # 2. Fill parent information for ParticleInputs created in previous loop
-        for i,part in enumerate(supera_event):
-            traj = data.trajectories[i]
-
-            parent=None
-            if(part.part.parent_trackid < self._trackid2idx.size()):
-                parent_index = self._trackid2idx[part.part.parent_trackid]
-                if not parent_index == supera.kINVALID_INDEX:
-                    parent = supera_event[parent_index].part
-                    part.part.parent_pdg = parent.pdg
-                    
-            self.SetProcessType(traj,part.part,parent)
-
         # 3. Loop over "voxels" (aka packets), get EDep from xyz and charge information,
         #    and store in pcloud
-        x, y, z, dE = HitParser.hit_parser_energy(data.t0, data.packets, self._geom_dict, self._run_config, switch_xz=True)
+        if data.hits is None:
+            x, y, z, dE = self._pixel_geometry.HitParserEnergy(data.t0, data.packets, self._run_config, switch_xz=True)
+        else:
+            # computed by the reader for blocks of packets (InputReader hit_geometry), same as above for data packets
+            hits = data.hits[data.packets['packet_type'] == 0]
+            x, y, z, dE = hits['x'], hits['y'], hits['z'], hits['dE']
         if verbose>1:
             print('Got x,y,z,dE = ', x, y, z, dE)
 
@@ -290,6 +308,186 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
 
         ass_segments = np.subtract(ass_segments, data.segment_index_min*(ass_segments!=-1))
 
+        # a list to keep energy depositions w/o true association
+        self._edeps_unassociated.clear() 
+        self._edeps_unassociated.reserve(len(data.packets))
+        self._edeps_all.clear();
+        self._edeps_all.reserve(len(data.packets))
+        self._mm2cm = 0.1 # For converting packet x,y,z values
+
+        # Per-event segment geometry shared by the numpy association and the search association
+        segment_table = None
+        if self._association_engine in ['numpy','jit'] or self._search_association:
+            segment_table = larnd2supera.association.SegmentTable.FromSegments(data.segments,
+                self._tpc_lookup.DriftDirection)
+
+        # The numpy/jit engines and the search association keep EDeps as columns (dict of arrays),
+        # converted into supera::EDep in bulk at the end (see larnd2supera.bulk).
+        edeps_associated, edeps_unassociated = None, None
+        if self._association_engine in ['numpy','jit']:
+            check_raw_sum, check_ana_sum, edeps_associated, edeps_unassociated = self.AssociateNumpy(data,
+                supera_event, x, y, z, dE, ass_segments, ass_fractions, verbose, segment_table)
+        else:
+            check_raw_sum, check_ana_sum = self.AssociateLoop(data, supera_event, x, y, z, dE, ass_segments, ass_fractions, verbose)
+
+        if verbose:
+            print("--- filling edep %s seconds ---" % (time.time() - start_time))
+
+        if edeps_unassociated is None:
+            print('Unassociated edeps',self._edeps_unassociated.size())
+        else:
+            print('Unassociated edeps',len(edeps_unassociated['e']))
+        if self._search_association:
+            if edeps_unassociated is None:
+                edeps_unassociated = larnd2supera.bulk.edep_columns(self._edeps_unassociated)
+            # Attempt to associate unassociated edeps
+            unass_xyz = np.column_stack([edeps_unassociated['x'],edeps_unassociated['y'],edeps_unassociated['z']])
+            seg_found, seg_time = larnd2supera.association.search(unass_xyz, data.segments,
+                self._tpc_lookup.DriftDirection,
+                self._v_drift, self._ass_time_future, self._ass_time_past,
+                self._ass_distance_limit,
+                table=segment_table,
+                )
+            found = seg_found > -1
+            seg_index = np.full(len(seg_found),-1,dtype=np.int64)
+            trackid2idx = self._trackid_index
+            traj_id = data.segments['traj_id'][seg_found[found]].astype(np.int64)
+            valid = (traj_id >= 0) & (traj_id < len(trackid2idx))
+            seg_index[found] = np.where(valid, trackid2idx[np.where(valid,traj_id,0)], -1)
+            found = seg_index > -1
+            for iedep in np.nonzero(~found)[0]:
+                print(f'Found unassociated edep ({iedep}th) ... Energy={edeps_unassociated["e"][iedep]}')
+
+            #associate
+            searched = larnd2supera.bulk.select(edeps_unassociated, found)
+            searched['index'] = seg_index[found]
+            searched['t']     = seg_time[found]
+            searched['dedx']  = data.segments['dEdx'][seg_found[found]].astype(float)
+            edeps_associated = larnd2supera.bulk.concatenate(edeps_associated, searched)
+            edeps_unassociated = larnd2supera.bulk.select(edeps_unassociated, ~found)
+            print('New self._edeps_unassociated size',len(edeps_unassociated['e']))
+
+        # Bulk conversion of the columns to supera::EDep
+        if edeps_associated is not None:
+            larnd2supera.bulk.fill_event(supera_event, edeps_associated)
+        if edeps_unassociated is not None:
+            self._edeps_unassociated.clear()
+            larnd2supera.bulk.fill_edeps(self._edeps_unassociated, edeps_unassociated)
+
+        if not self._log is None:
+            self._log['packet_noass'][-1] = self._edeps_unassociated.size()
+            self._log['packet_ctr'][-1]   = (data.packets['packet_type'] == 0).sum()
+
+        print('Unassociated edeps',self._edeps_unassociated.size())
+
+        if not self._log is None:
+
+            self._log['residual_q'][-1] = check_raw_sum - check_ana_sum
+
+            if self._log['packet_ctr'][-1]>0:
+                self._log['ass_frac'][-1]        /= self._log['packet_ctr'][-1]
+                self._log['ass_charge_frac'][-1] /= self._log['packet_ctr'][-1]
+                self._log['packet_frac_sum'][-1] /= self._log['packet_ctr'][-1]
+                self._log['ass_drop_charge'][-1] /= self._log['packet_ctr'][-1]
+                self._log['ass_drop_dist'][-1]   /= self._log['packet_ctr'][-1]
+
+            if self._log['packet_noass'][-1]:
+                value_bad, value_frac = self._log['packet_noass'][-1], self._log['packet_noass'][-1]/self._log['packet_ctr'][-1]*100.
+                print(f'    [WARNING]: {value_bad} packets ({value_frac} %) had no MC track association')
+
+            if self._log['fraction_nan'][-1]:
+                value_bad, value_frac = self._log['fraction_nan'][-1], self._log['fraction_nan'][-1]/self._log['packet_ctr'][-1]*100.
+                print(f'    [WARNING]: {value_bad} packets ({value_frac} %) had nan fractions associated')
+
+            if self._log['packet_frac_sum'][-1]<0.9999:
+                print(f'    [WARNING] some input packets have the fraction sum < 1.0 (average over packets {self._log["packet_frac_sum"]})')
+
+            if self._log['ass_frac'][-1]<0.9999:
+                print(f'    [WARNING] associated packet count fraction to the total is {self._log["ass_frac"][-1]} (<1.0)')
+
+            if self._log['ass_charge_frac'][-1]<0.9999:
+                print(f'    [WARNING] the average of summed fractions after charge/dist cut {self._log["ass_charge_frac"]}')
+
+            if self._log['ass_drop_charge'][-1]>0.0001:
+                print(f'    [WARNING] the average of associated fraction dropped due to charge cut: {self._log["ass_drop_charge"]}')
+
+            if self._log['ass_drop_dist'][-1]>0.0001:
+                print(f'    [WARNING] the average of associated fraction dropped due to distance cut: {self._log["ass_drop_dist"]}')
+
+            if self._log['drop_ctr_total'][-1]:
+                for key in self._log.keys():
+                    if not str(key).startswith('drop_ctr'):
+                        continue
+                    print(key,self._log[key])
+
+
+            #if self._log['bad_track_id'][-1]:
+            #    print(f'    WARNING: {self._log["bad_track_id"][-1]} invalid track IDs found in the association')
+
+        if abs(check_raw_sum - check_ana_sum)>0.1:
+            print('[WARNING] large disagreement in the sum packet values:')
+            print('    Raw sum:',check_raw_sum)
+            print('    Accounted sum:',check_ana_sum)
+        supera_event.unassociated_edeps = self._edeps_unassociated
+        return supera_event
+
+    def TrackIndex(self, data):
+        '''
+        Numpy version of self._trackid2idx: particle index for each track ID (-1 if invalid).
+        '''
+        max_trackid = max(data.trajectories['trackID'].max(),data.segments['trackID'].max())
+        trackid = data.trajectories['trackID'].astype(np.int64)
+        if (trackid < 0).any():
+            print('Negative track ID found',trackid[trackid < 0][0])
+            raise ValueError
+        trackid2idx = np.full(int(max_trackid+1),-1,dtype=np.int64)
+        trackid2idx[trackid] = np.arange(len(trackid))
+        return trackid2idx
+
+    def ParticleColumns(self, data, trackid2idx):
+        '''
+        Column-wise version of TrajectoryToParticle and the parent lookup for data.trajectories.
+        Returns a dict of arrays (one entry per trajectory): trackid, pdg, process_main, process_sub,
+        px, py, pz, ke (momentum magnitude), energy_init, vtx (N,3), vtx_t, end (N,3), end_t, parent_trackid,
+        parent_index (-1 if not found), parent_pdg (the supera default if no parent) and dr, the sum of
+        the parent end point minus the vertex coordinates (1.e20 if no parent).
+        '''
+        traj = data.trajectories
+        cols = dict()
+        cols['trackid'] = traj['trackID'].astype(np.int64)
+        cols['pdg'] = traj['pdgId'].astype(np.int64)
+        cols['process_main'] = traj['start_process'].astype(np.int64)
+        cols['process_sub'] = traj['start_subprocess'].astype(np.int64)
+        pxyz = traj['pxyz_start'].astype(float)
+        cols['px'], cols['py'], cols['pz'] = pxyz[:,0], pxyz[:,1], pxyz[:,2]
+        cols['ke'] = np.sqrt(cols['px']**2 + cols['py']**2 + cols['pz']**2)
+        mass = larnd2supera.pdg2mass.pdg2mass_array(cols['pdg'])
+        cols['energy_init'] = np.sqrt(mass**2 + cols['px']**2 + cols['py']**2 + cols['pz']**2)
+        cols['vtx'], cols['vtx_t'] = traj['xyz_start'].astype(float), traj['t_start'].astype(float)
+        cols['end'], cols['end_t'] = traj['xyz_end'].astype(float), traj['t_end'].astype(float)
+
+        parent_id = traj['parentID'].astype(np.int64)
+        cols['parent_trackid'] = np.where(parent_id == -1, cols['trackid'], parent_id)
+        for key in ['trackid','parent_trackid']:
+            if (cols[key] == supera.kINVALID_TRACKID).any():
+                print('Unexpected to have an invalid track ID',cols[key][cols[key] == supera.kINVALID_TRACKID][0],'(%s)' % key)
+                raise ValueError
+
+        in_range = (cols['parent_trackid'] >= 0) & (cols['parent_trackid'] < len(trackid2idx))
+        parent_index = np.full(len(traj),-1,dtype=np.int64)
+        parent_index[in_range] = trackid2idx[cols['parent_trackid'][in_range]]
+        has_parent = parent_index >= 0
+        cols['parent_index'] = parent_index
+        cols['parent_pdg'] = np.where(has_parent, cols['pdg'][np.maximum(parent_index,0)], supera.Particle().parent_pdg)
+        cols['dr'] = np.where(has_parent, (cols['end'][np.maximum(parent_index,0)] - cols['vtx']).sum(axis=1), 1.e20)
+        return cols
+
+    def AssociateLoop(self, data, supera_event, x, y, z, dE, ass_segments, ass_fractions, verbose=0):
+        '''
+        Reference packet-to-segment association (AssociationEngine: loop).
+        Fills supera_event particles pcloud and self._edeps_unassociated.
+        Returns the sum of input packet energies and the energy accounted in the output.
+        '''
         # Define some objects that are repeatedly used within the loop
         seg_pt0   = supera.Point3D()
         seg_pt1   = supera.Point3D()
@@ -298,13 +496,6 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
         seg_flag  = None
         seg_dist  = None
 
-        # a list to keep energy depositions w/o true association
-        self._edeps_unassociated.clear() 
-        self._edeps_unassociated.reserve(len(data.packets))
-        self._edeps_all.clear();
-        self._edeps_all.reserve(len(data.packets))
-        self._mm2cm = 0.1 # For converting packet x,y,z values
-
         #
         # Loop over packets and decide particle trajectory segments that are associated with it.
         # Also calculate how much fraction of the packet value should be associated to this particle.
@@ -494,219 +685,83 @@ class SuperaDriver(edep2supera.edep2supera.SuperaDriver):
                     self._log['ass_charge_frac'][-1] += fsum
                     self._log['ass_frac'][-1] += 1
 
-            if verbose > 1:
-                print('[INFO] Assessing packet',ip)
-                print('       Associated?',seg_flag.sum())
-                print('       Segments :', packet_segments)
-                print('       TrackIDs :', [data.segments[packet_segments[idx]]['trackID'] for idx in range(packet_segments.shape[0])])
-                print('       Fractions:', ['%.3f' % f for f in packet_fractions])
-                print('       Energy   : %.3f' % dE[ip])
-                print('       Position :', ['%.3f' % f for f in [x[ip]*self._mm2cm,y[ip]*self._mm2cm,z[ip]*self._mm2cm]])
-                print('       Distance :', ['%.3f' % f for f in seg_dist])
-
-            # Post-Step1, check if there is any associated segments left.
-            # Post-Step1.A: If none left, then register to the set of unassociated segments.
-            if (seg_dist < self._ass_distance_limit).sum()<1:
-                if verbose:
-                    print('[WARNING] found a packet unassociated with any tracks')
-                    print('          Packet %d Charge %.3f' % (ip,dE[ip]))
-                edep = supera.EDep()
-                edep.x,edep.y,edep.z,edep.e = x[ip]*self._mm2cm, y[ip]*self._mm2cm, z[ip]*self._mm2cm, dE[ip]
-                self._edeps_unassociated.push_back(edep)
-                if not self._log is None:
-                    self._log['packet_noass'][-1] += 1
-                check_ana_sum += edep.e
-                continue
-
-            # After this point, >=1 association will be found. Log if needed
-            if not self._log is None:
-                self._log['ass_frac'][-1] += 1
-
-            # Post-Step1.B: If only one segment left, register to that packet.
-            if (seg_dist < self._ass_distance_limit).sum()==1:
-                if verbose:
-                    print('[INFO] Registering the only segment within distance limit',packet_segments[it])
-                it = np.argmin(seg_dist)
-                seg_idx = packet_segments[it]
-                seg = data.segments[seg_idx]
-                packet_edeps[it].dedx = seg['dEdx']
-                packet_edeps[it].e = dE[ip]
-                supera_event[self._trackid2idx[int(seg['trackID'])]].pcloud.push_back(packet_edeps[it])
-                check_ana_sum += packet_edeps[it].e
-                continue
+        return check_raw_sum, check_ana_sum
 
-            # Check (and log if needed) if the number of associations is saturated 
-            if not -1 in packet_segments:
-                if verbose:
-                    print('[WARNING] found',len(packet_segments),'associated track IDs maxing out the recording array size')
-                if not self._log is None:
-                    self._log['ass_saturation'][-1] += 1
 
-            # Step 2. Claculate the fraction min threshold and ignore segments with a fraction value below
-            frac_min = 0
-            nan_fraction_found=False
-            if abs(dE[ip])>0.:
-                frac_min = abs(self._ass_charge_limit / dE[ip])
-            for it in range(packet_fractions.shape[0]):
-                # If the associated fraction of this segment is nan, disregard this segment
-                if np.isnan(packet_fractions[it]):
-                    seg_flag[it]=False
-                    nan_fraction_found=True
-                    continue
-                if seg_dist[it] > self._ass_distance_limit:
-                    seg_flag[it]=False
-                    continue
-                seg_flag[it] = abs(packet_fractions[it]) > frac_min
-
-            if nan_fraction_found:
-                print('    WARNING: found nan in fractions of a packet:', packet_fractions)
-                if self._log is not None:
-                    self._log['fraction_nan'][-1] += 1
+    def AssociateNumpy(self, data, supera_event, x, y, z, dE, ass_segments, ass_fractions, verbose=0, segment_table=None):
+        '''
+        Packet-to-segment association with array operations (AssociationEngine: numpy)
+        or a compiled packet loop (AssociationEngine: jit).
+        Applies the same cuts as AssociateLoop on all packets at once (see larnd2supera.association).
+        Fills self._edeps_all. Returns the sum of input packet energies, the energy accounted in the output,
+        and the associated (with the particle index) and unassociated EDeps as columns (see larnd2supera.bulk).
+        '''
+        # x, y, z, dE are only computed for "data" (type==0) packets
+        data_mask = data.packets['packet_type'] == 0
+        xyz = np.column_stack([x,y,z]).astype(float)*self._mm2cm
+        energy = np.asarray(dE,dtype=float)
 
-
-            # Check if none of segments is above the frac_min. If so, only use the shortest distant segment.
-            if seg_flag.sum()<1:
-                if verbose:
-                    print('[WARNING] All associated segment below threshold: packet')
-                    print('          Packet %d Charge %.3f' % (ip,dE[ip]), ['%.3f' % f for f in packet_fractions])
-                if not self._log is None:
-                    self._log['packet_badass'][-1] += 1            
-                it = np.argmin(seg_dist)
-                if verbose:
-                    print('[INFO] Registering the closest segment',packet_segments[it])
-                #print(ass_segments[ip])
-                #print(ass_fractions[ip])
-                #print(it)
-                #print(packet_fractions)
-                seg_idx = packet_segments[it]
-                seg = data.segments[seg_idx]
-                packet_edeps[it].dedx = seg['dEdx']
-                packet_edeps[it].e = dE[ip]
-                supera_event[self._trackid2idx[int(seg['trackID'])]].pcloud.push_back(packet_edeps[it])
-                check_ana_sum += packet_edeps[it].e
-                continue
-
-
-            # Step 3: re-normalize the fraction among remaining segments and create EDeps
-            frac_norm = 1. / (np.abs(packet_fractions[seg_flag]).sum())
-            for it in range(packet_fractions.shape[0]):
-                if not seg_flag[it]: continue
-                seg_idx = packet_segments[it]
-                seg = data.segments[seg_idx]
-                packet_edeps[it].dedx = seg['dEdx']
-                packet_edeps[it].e = dE[ip] * abs(packet_fractions[it]) * frac_norm
-                supera_event[self._trackid2idx[int(seg['trackID'])]].pcloud.push_back(packet_edeps[it])
-                if verbose:
-                    print('[INFO] Registered segment',seg_idx)
-                check_ana_sum += packet_edeps[it].e
-
-        if verbose:
-            print("--- filling edep %s seconds ---" % (time.time() - start_time))
-
-        print('Unassociated edeps',self._edeps_unassociated.size())
-        if self._search_association:
-            import tqdm
-            # Attempt to associate unassociated edeps
-            failed_unass = std.vector('supera::EDep')()
-            for iedep, edep in tqdm.tqdm(enumerate(self._edeps_unassociated)):
-                #print('Searching for EDep',iedep,'/',self._edeps_unassociated.size())
-                ass_found=False
-                for seg in data.segments:
-
-                    xyz = np.array([edep.x,edep.y,edep.z])
-                    if not self.associated_along_drift(seg,xyz,False):
-                        continue
-
-                    seg_pt0.x, seg_pt0.y, seg_pt0.z = seg['x_start'], seg['y_start'], seg['z_start']
-                    seg_pt1.x, seg_pt1.y, seg_pt1.z = seg['x_end'], seg['y_end'], seg['z_end']
-                    packet_pt.x, packet_pt.y, packet_pt.z = edep.x, edep.y, edep.z
-
-                    edep_time = 0 
-                    if seg['t0_start'] < seg['t0_end']:
-                        time_frac = self.PoCA(seg_pt0,seg_pt1,packet_pt,scalar=True)
-                        edep_time = seg['t0_start'] + time_frac * (seg['t0_end'  ] - seg['t0_start'])
-                        poca_pt = seg_pt0 + (seg_pt1 - seg_pt0) * time_frac
-                    else:
-                        time_frac = self.PoCA(seg_pt1,seg_pt0,packet_pt,scalar=True)
-                        edep_time = seg['t0_end'  ] + time_frac * (seg['t0_start'] - seg['t0_end'  ])
-                        poca_pt = seg_pt1 + (seg_pt0 - seg_pt1) * time_frac
-
-                    seg_dist = poca_pt.distance(packet_pt)
-                    if seg_dist < self._ass_distance_limit:
-                        #associate
-                        edep.dedx = seg['dEdx']
-                        edep.t    = edep_time
-                        supera_event[self._trackid2idx[int(seg['traj_id'])]].pcloud.push_back(edep)
-
-                        ass_found=True
-                        break
-                if not ass_found:
-                    failed_unass.push_back(edep)
-                    print(f'Found unassociated edep ({iedep}th) ... Energy={edep.e}')
-
-                #print('    Found so far:',failed_unass.size())
-            print('Clearing self._edeps_unassociated of size',self._edeps_unassociated.size())
-            self._edeps_unassociated.clear()
-            print('Size after clearing:',self._edeps_unassociated.size())
-            self._edeps_unassociated = failed_unass
-            print('New self._edeps_unassociated size',self._edeps_unassociated.size())
-
-        if not self._log is None:
-            self._log['packet_noass'][-1] = self._edeps_unassociated.size()
-            self._log['packet_ctr'][-1]   = (data.packets['packet_type'] == 0).sum()
-
-        print('Unassociated edeps',self._edeps_unassociated.size())
+        if self._association_engine == 'jit':
+            associate, drift = larnd2supera.association.associate_jit, self._tpc_lookup
+        else:
+            associate, drift = larnd2supera.association.associate, self._tpc_lookup.DriftDirection
+        res = associate(xyz, energy,
+            ass_segments[data_mask], ass_fractions[data_mask],
+            data.segments, self._trackid_index,
+            drift,
+            self._v_drift, self._ass_time_future, self._ass_time_past,
+            self._ass_distance_limit, self._ass_charge_limit,
+            table=segment_table,
+            )
+
+        larnd2supera.bulk.fill_edeps(self._edeps_all, dict(x=xyz[:,0],y=xyz[:,1],z=xyz[:,2],e=energy))
+
+        counts = res['counts']
+        if counts['invalid_traj_id']:
+            print(f'[ERROR] found {counts["invalid_traj_id"]} associations to a segment with an invalid traj_id')
+        if verbose > 0 and counts['packet_noass_input']:
+            print(f'[WARNING] found {counts["packet_noass_input"]} packets with no association!')
+        if counts['fraction_nan']:
+            print(f'    [ERROR]: found nan in fractions of {counts["fraction_nan"]} packets')
 
         if not self._log is None:
+            for key in self.LOG_KEYS:
+                if key in counts:
+                    self._log[key][-1] += counts[key]
+
+        return res['raw_sum'], res['ana_sum'], res['associated'], res['unassociated']
+
+    def ProcessTypes(self, cols):
+        '''
+        Column-wise SetProcessType for the output of ParticleColumns (see larnd2supera.particle_type).
+        The rules are evaluated in order and the first matching one gives the type of a particle.
+        Particles matching a rule with a note are reported in a summary (one line per case).
+        Returns the list of supera particle types and the list of process strings ("main::sub").
+        '''
+        pdg, main, sub = cols['pdg'], cols['process_main'], cols['process_sub']
+        rules = larnd2supera.particle_type.RULES
+        rule = larnd2supera.particle_type.classify(cols, self._g4_codes, self._electron_energy_threshold)
+
+        for irule,(name,note) in enumerate(rules):
+            index = np.nonzero(rule == irule)[0]
+            if note is None or len(index) < 1:
+                continue
+            cases = np.column_stack([pdg,cols['parent_pdg'],main,sub])[index]
+            cases, first, counts = np.unique(cases, axis=0, return_index=True, return_counts=True)
+            print(f'    WARNING: {note} ({len(index)} particles)')
+            for case, ifirst, count in zip(cases, first, counts):
+                print("      PDG",case[0],
+                      "Parent PDG",case[1],
+                      "G4ProcessType",case[2],
+                      "SubProcessType",case[3],
+                      "Particles",count,
+                      "First TrackId",cols['trackid'][index[ifirst]])
+            if name is None:
+                raise ValueError
 
-            self._log['residual_q'][-1] = check_raw_sum - check_ana_sum
-
-            if self._log['packet_ctr'][-1]>0:
-                self._log['ass_frac'][-1]        /= self._log['packet_ctr'][-1]
-                self._log['ass_charge_frac'][-1] /= self._log['packet_ctr'][-1]
-                self._log['packet_frac_sum'][-1] /= self._log['packet_ctr'][-1]
-                self._log['ass_drop_charge'][-1] /= self._log['packet_ctr'][-1]
-                self._log['ass_drop_dist'][-1]   /= self._log['packet_ctr'][-1]
-
-            if self._log['packet_noass'][-1]:
-                value_bad, value_frac = self._log['packet_noass'][-1], self._log['packet_noass'][-1]/self._log['packet_ctr'][-1]*100.
-                print(f'    [WARNING]: {value_bad} packets ({value_frac} %) had no MC track association')
-
-            if self._log['fraction_nan'][-1]:
-                value_bad, value_frac = self._log['fraction_nan'][-1], self._log['fraction_nan'][-1]/self._log['packet_ctr'][-1]*100.
-                print(f'    [WARNING]: {value_bad} packets ({value_frac} %) had nan fractions associated')
-
-            if self._log['packet_frac_sum'][-1]<0.9999:
-                print(f'    [WARNING] some input packets have the fraction sum < 1.0 (average over packets {self._log["packet_frac_sum"]})')
-
-            if self._log['ass_frac'][-1]<0.9999:
-                print(f'    [WARNING] associated packet count fraction to the total is {self._log["ass_frac"][-1]} (<1.0)')
-
-            if self._log['ass_charge_frac'][-1]<0.9999:
-                print(f'    [WARNING] the average of summed fractions after charge/dist cut {self._log["ass_charge_frac"]}')
-
-            if self._log['ass_drop_charge'][-1]>0.0001:
-                print(f'    [WARNING] the average of associated fraction dropped due to charge cut: {self._log["ass_drop_charge"]}')
-
-            if self._log['ass_drop_dist'][-1]>0.0001:
-                print(f'    [WARNING] the average of associated fraction dropped due to distance cut: {self._log["ass_drop_dist"]}')
-
-            if self._log['drop_ctr_total'][-1]:
-                for key in self._log.keys():
-                    if not str(key).startswith('drop_ctr'):
-                        continue
-                    print(key,self._log[key])
-
-
-            #if self._log['bad_track_id'][-1]:
-            #    print(f'    WARNING: {self._log["bad_track_id"][-1]} invalid track IDs found in the association')
-
-        if abs(check_raw_sum - check_ana_sum)>0.1:
-            print('[WARNING] large disagreement in the sum packet values:')
-            print('    Raw sum:',check_raw_sum)
-            print('    Accounted sum:',check_ana_sum)
-        supera_event.unassociated_edeps = self._edeps_unassociated
-        return supera_event
+        types = [getattr(supera,name) if name else None for name,_ in rules]
+        processes = ['%d::%d' % (m,s) for m,s in zip(main.tolist(),sub.tolist())]
+        return [types[irule] for irule in rule.tolist()], processes
 
     def TrajectoryToParticle(self, trajectory):
         p = supera.Particle()
@@ -0,0 +1,149 @@
+'''
+Pixel geometry lookup table compiled from the LarpixParser geometry dictionary, and the packet
+position/energy reconstruction of LarpixParser.hit_parser with array operations.
+The table is cached on disk per PropertyKeyword (see PixelGeometry.Load).
+'''
+import os
+import tempfile
+import numpy as np
+from LarpixParser import get_vdrift as GetV
+from LarpixParser import get_charge as GetCharge
+
+# Packet fields identifying a pixel channel, in the order of the geometry dictionary keys
+CHANNEL_FIELDS = ('io_group','io_channel','chip_id','channel_id')
+
+# Cache directory of the compiled tables (default ~/.cache/larnd2supera)
+CACHE_DIR_ENV = 'LARND2SUPERA_CACHE_DIR'
+CACHE_VERSION = 1
+
+
+def cache_dir():
+    return os.environ.get(CACHE_DIR_ENV,os.path.join(os.path.expanduser('~'),'.cache','larnd2supera'))
+
+
+def _parser_version():
+    try:
+        from importlib.metadata import version
+        return version('LarpixParser')
+    except Exception:
+        return 'unknown'
+
+
+class PixelGeometry:
+    '''
+    Dense lookup table of the pixel geometry. A channel (io_group within a module, io_channel, chip_id, channel_id)
+    is packed into one integer key (mixed radix with the sizes in self.shape), mapped by self.index (int32, -1 for
+    channels not in the geometry) to a row of self.table: the anode x, y, z and the drift direction (as in the
+    values of the geometry dictionary).
+    '''
+    def __init__(self, shape, index, table):
+        self.shape = np.asarray(shape,dtype=np.int64)
+        self.index = np.asarray(index,dtype=np.int32)
+        self.table = np.asarray(table,dtype=np.float64)
+
+    @classmethod
+    def FromDict(cls, geom_dict):
+        '''
+        Compile the geometry dictionary {(io_group, io_channel, chip_id, channel_id): [x, y, z, direction]}
+        '''
+        keys  = np.array(list(geom_dict.keys()),dtype=np.int64).reshape(-1,len(CHANNEL_FIELDS))
+        table = np.array([np.asarray(v,dtype=float)[:4] for v in geom_dict.values()],dtype=np.float64).reshape(-1,4)
+        if len(keys) and keys.min() < 0:
+            raise ValueError('Negative channel identifier in the geometry dictionary')
+        shape = keys.max(axis=0) + 1 if len(keys) else np.ones(len(CHANNEL_FIELDS),dtype=np.int64)
+        index = np.full(int(np.prod(shape)),-1,dtype=np.int32)
+        index[np.ravel_multi_index(keys.T,shape)] = np.arange(len(keys),dtype=np.int32)
+        return cls(shape, index, table)
+
+    @classmethod
+    def Load(cls, keyword, geom_dict, use_cache=True):
+        '''
+        Return the compiled geometry for a PropertyKeyword, from the cache if available
+        (otherwise compiled from geom_dict and stored in the cache). The cache is valid for the
+        same LarpixParser version.
+        '''
+        key  = dict(version=CACHE_VERSION, parser_version=_parser_version())
+        path = os.path.join(cache_dir(),'pixel_geometry_%s.npz' % keyword)
+
+        if use_cache and os.path.isfile(path):
+            try:
+                with np.load(path) as f:
+                    if all(str(f[k]) == str(v) for k,v in key.items()):
+                        return cls(f['shape'],f['index'],f['table'])
+                print('    Pixel geometry cache is outdated (re-creating):',path)
+            except Exception as e:
+                print('    Failed to read the pixel geometry cache',path,e)
+
+        geometry = cls.FromDict(geom_dict)
+
+        if use_cache:
+            # a unique temporary file per writer (worker processes may compile the table at the same time)
+            tmp = None
+            try:
+                os.makedirs(os.path.dirname(path),exist_ok=True)
+                fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path)+'.',suffix='.tmp',dir=os.path.dirname(path))
+                with os.fdopen(fd,'wb') as f:
+                    np.savez(f,shape=geometry.shape,index=geometry.index,table=geometry.table,**key)
+                os.replace(tmp,path)
+            except OSError as e:
+                print('    Failed to store the pixel geometry cache',path,e)
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+
+        return geometry
+
+    def __len__(self):
+        return len(self.table)
+
+    def Lookup(self, io_group, io_channel, chip_id, channel_id):
+        '''
+        Return the row of self.table for each channel. Raises KeyError for a channel not in the geometry.
+        '''
+        channels = [np.asarray(v,dtype=np.int64) for v in (io_group, io_channel, chip_id, channel_id)]
+        valid = np.ones(channels[0].shape,dtype=bool)
+        for v, size in zip(channels, self.shape):
+            valid &= (v >= 0) & (v < size)
+        rows = np.full(channels[0].shape,-1,dtype=np.int32)
+        rows[valid] = self.index[np.ravel_multi_index([v[valid] for v in channels],self.shape)]
+        if (rows < 0).any():
+            bad = np.argmax(rows < 0)
+            raise KeyError(tuple(int(v[bad]) for v in channels))
+        return rows
+
+    def PixelPlanePosition(self, packets_arr, run_config):
+        '''
+        Anode position (x, y, z in mm) and drift direction of data packets, with the module offsets.
+        Same as LarpixParser.get_raw_coord.get_pixel_plane_position.
+        '''
+        nr_iogroup_module = run_config['nr_iogroup_module']
+        io_group  = packets_arr['io_group'].astype(np.int64)
+        module_id = (io_group - 1) // nr_iogroup_module
+        rows = self.Lookup(io_group - module_id * nr_iogroup_module,
+            packets_arr['io_channel'], packets_arr['chip_id'], packets_arr['channel_id'])
+        xyz = self.table[rows]
+        # tpc_offsets is ordered by z, y, x (in cm)
+        offsets = np.asarray(run_config['tpc_offsets'],dtype=float)[module_id][:,::-1]*10
+        return xyz[:,0]+offsets[:,0], xyz[:,1]+offsets[:,1], xyz[:,2]+offsets[:,2], xyz[:,3]
+
+    def HitParserPosition(self, t0, packets, run_config, switch_xz=True):
+        '''
+        x, y, z (mm) and the drift time of data packets (packet_type 0), t0 being a scalar or one value per data packet.
+        Same as LarpixParser.hit_parser.hit_parser_position (with the drift model of run_config).
+        '''
+        packets_arr = packets[packets['packet_type'] == 0]
+        x, y, z_anode, direction = self.PixelPlanePosition(packets_arr, run_config)
+        v_drift = GetV.v_drift(run_config, run_config['drift_model'])
+        t_drift = packets_arr['timestamp'].astype(float) * run_config['CLOCK_CYCLE'] - t0
+        z = z_anode + direction * t_drift * v_drift
+        if switch_xz:
+            x, z = z, x
+        return x, y, z, t_drift
+
+    def HitParserEnergy(self, t0, packets, run_config, switch_xz=True):
+        '''
+        x, y, z (mm) and the energy (MeV) of data packets.
+        Same as LarpixParser.hit_parser.hit_parser_energy.
+        '''
+        x, y, z, t_drift = self.HitParserPosition(t0, packets, run_config, switch_xz)
+        dE = GetCharge.get_calo_MeV(packets[packets['packet_type'] == 0], t_drift, run_config)
+        return x, y, z, dE
@@ -0,0 +1,85 @@
+'''
+Particle type classification (SuperaDriver.SetProcessType) as an ordered rule table over columns
+of plain integer codes, so that it can be used without ROOT (see classify).
+'''
+import numpy as np
+
+# Names of the TG4TrajectoryPoint.G4ProcessType and G4ProcessSubtype values used by the rules
+G4_PROCESS_TYPES = ('kProcessElectromagetic','kProcessHadronic','kProcessDecay')
+G4_PROCESS_SUBTYPES = ('kSubtypeEMIonization','kSubtypeEMPhotoelectric','kSubtypeEMComptonScattering',
+    'kSubtypeEMGammaConversion','kSubtypeEMPairProdByCharged')
+
+# Hadronic subprocess of a decay at rest
+HADRONIC_DECAY_SUBTYPE = 151
+
+# (supera type name, note for the summary). A particle gets the type of the first rule it matches.
+# The rule without a type is an error.
+RULES = (
+    ('kNeutron',       None),
+    ('kNucleus',       None),
+    ('kPrimary',       None),
+    ('kPhoton',        None),
+    ('kTrack',         None),
+    # electrons and positrons
+    ('kPhotoElectron', None),
+    ('kCompton',       None),
+    ('kConversion',    None),
+    ('kIonization',    None),
+    ('kDelta',         None),
+    ('kCompton',       None),
+    ('kIonization',    'UNEXPECTED CASE for IONIZATION'),
+    (None,             'UNEXPECTED EM SubType'),
+    ('kDecay',         None),
+    ('kIonization',    None),
+    ('kDecay',         None),
+    ('kCompton',       'Guessing the shower type as Compton'),
+    ('kOtherShower',   'Guessing the shower type as OtherShower'),
+    )
+
+
+def g4_codes(process_type, process_subtype):
+    '''
+    Integer values of the G4 process (sub)types used by classify, from the
+    TG4TrajectoryPoint.G4ProcessType and G4ProcessSubtype enums.
+    '''
+    codes = {name:int(getattr(process_type,name)) for name in G4_PROCESS_TYPES}
+    codes.update({name:int(getattr(process_subtype,name)) for name in G4_PROCESS_SUBTYPES})
+    return codes
+
+
+def classify(cols, codes, energy_threshold):
+    '''
+    Index in RULES of the rule matched by each particle. cols is a dict of arrays (see
+    SuperaDriver.ParticleColumns): pdg, parent_pdg, trackid, parent_trackid, process_main,
+    process_sub, ke and dr. codes maps the names in G4_PROCESS_TYPES and G4_PROCESS_SUBTYPES
+    to their values (see g4_codes).
+    '''
+    pdg, main, sub = [np.asarray(cols[key]) for key in ('pdg','process_main','process_sub')]
+    parent_pdg = np.asarray(cols['parent_pdg'])
+    low_ke = np.asarray(cols['ke']) < energy_threshold
+    em  = main == codes['kProcessElectromagetic']
+    ion = em & (sub == codes['kSubtypeEMIonization'])
+    hadronic_decay = (main == codes['kProcessHadronic']) & (sub == HADRONIC_DECAY_SUBTYPE) & \
+        (np.asarray(cols['dr']) < 0.0001)
+
+    conditions = [
+        pdg == 2112,
+        pdg > 1000000000,
+        np.asarray(cols['trackid']) == np.asarray(cols['parent_trackid']),
+        pdg == 22,
+        np.abs(pdg) != 11,
+        em & (sub == codes['kSubtypeEMPhotoelectric']),
+        em & (sub == codes['kSubtypeEMComptonScattering']),
+        em & ((sub == codes['kSubtypeEMGammaConversion']) | (sub == codes['kSubtypeEMPairProdByCharged'])),
+        ion & (np.abs(parent_pdg) == 11),
+        ion & np.isin(np.abs(parent_pdg),[211,13,2212,321]),
+        ion & (parent_pdg == 22),
+        ion,
+        em,
+        main == codes['kProcessDecay'],
+        hadronic_decay & low_ke,
+        hadronic_decay,
+        low_ke,
+        np.ones(len(pdg),dtype=bool),
+        ]
+    return np.select(conditions, np.arange(len(RULES)), len(RULES)-1)
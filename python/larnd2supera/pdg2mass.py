@@ -4,6 +4,15 @@ import os
 with np.load(os.path.join(os.path.dirname(__file__),'pdg_data/pdg.npz'),'r') as f:
     _PDG_DATA = dict(f)
 
+# PDG codes sorted for np.searchsorted, and the corresponding mass in MeV
+_PDG_ORDER = np.argsort(_PDG_DATA['pdg_code'],kind='stable')
+_PDG_CODES = _PDG_DATA['pdg_code'][_PDG_ORDER]
+_PDG_MASSES = _PDG_DATA['mass'][_PDG_ORDER]*1000.
+# the lookup (searchsorted) requires one mass per PDG code
+_PDG_DUPLICATES = np.unique(_PDG_CODES[1:][_PDG_CODES[1:] == _PDG_CODES[:-1]])
+if len(_PDG_DUPLICATES):
+    raise ValueError(f'Duplicate PDG codes in the mass table: {_PDG_DUPLICATES.tolist()}')
+
 def pdg2mass(pdg_code):
     '''
     Given a PDG code, return the mass in MeV.
@@ -12,11 +21,20 @@ def pdg2mass(pdg_code):
     if pdg_code > 1000000000:
         return int(str(pdg_code)[-4:-1])*1000.
 
-    where = np.where(_PDG_DATA['pdg_code']==pdg_code)[0]
-    if len(where)<1:
+    where = np.searchsorted(_PDG_CODES,pdg_code)
+    if where >= len(_PDG_CODES) or not _PDG_CODES[where] == pdg_code:
         return -1
-    assert len(where) == 1
-    return _PDG_DATA['mass'][where[0]]*1000.
+    return _PDG_MASSES[where]
+
+def pdg2mass_array(pdg_codes):
+    '''
+    Array version of pdg2mass: given an array of PDG codes, return the masses in MeV (-1 if unknown).
+    For nuclei (10 digits) the atomic number is the 2nd to 4th last digits, (code // 10) % 1000.
+    '''
+    pdg_codes = np.asarray(pdg_codes,dtype=np.int64)
+    where = np.minimum(np.searchsorted(_PDG_CODES,pdg_codes),len(_PDG_CODES)-1)
+    mass = np.where(_PDG_CODES[where] == pdg_codes, _PDG_MASSES[where], -1.)
+    return np.where(pdg_codes > 1000000000, ((pdg_codes // 10) % 1000)*1000., mass)
 
 
 '''
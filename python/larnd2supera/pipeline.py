@@ -0,0 +1,241 @@
+'''
+A staged pipeline: items flow through a chain of stages connected by bounded queues.
+Each stage runs a function on one item at a time with a number of worker threads, or of worker
+processes (a multiprocessing.Pool fed by the same number of threads). The occupancy of the queue in
+front of each stage is sampled so that the bottleneck stage can be identified (see Pipeline.Report).
+
+    pipe = Pipeline(queue_size=4)
+    pipe.AddStage('read', read_entry)
+    pipe.AddStage('convert', convert_entry, workers=8, processes=True)
+    pipe.AddStage('store', store_entry, ordered=True)
+    for result in pipe.Run(entries):
+        ...
+    pipe.Report()
+'''
+import queue
+import threading
+import time
+
+# End-of-stream marker passed between stages
+_STOP = object()
+
+
+class Stage:
+    '''
+    One stage of a Pipeline (see Pipeline.AddStage).
+    '''
+    def __init__(self, name, func, workers=1, processes=False, initializer=None, initargs=(), ordered=False):
+        if workers < 1:
+            raise ValueError(f'Stage {name} needs at least one worker (given {workers})')
+        if ordered and workers > 1:
+            raise ValueError(f'Stage {name} processes items in order and can only have one worker')
+        self.name = name
+        self.func = func
+        self.workers = int(workers)
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.ordered = ordered
+        self.input = None
+        self.pool = None
+        # statistics
+        self.items = 0
+        self.busy_time = 0.
+        self.queue_samples = 0
+        self.queue_sum = 0
+        self.queue_max = 0
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def _sample(self):
+        occupancy = self.input.qsize()
+        with self._lock:
+            self.queue_samples += 1
+            self.queue_sum += occupancy
+            self.queue_max = max(self.queue_max, occupancy)
+
+    def _call(self, payload):
+        if self.pool is not None:
+            return self.pool.apply(self.func, (payload,))
+        return self.func(payload)
+
+
+class Pipeline:
+    '''
+    Chain of stages connected by bounded queues of size queue_size.
+    Items are numbered at the source, and Run yields the output of the last stage in the input order.
+    A stage returning None drops the item: later stages do not see it and Run does not yield it.
+    '''
+    def __init__(self, queue_size=4):
+        self._queue_size = int(queue_size)
+        self._stages = []
+        self._error = None
+        self._abort = threading.Event()
+        self._start_time = None
+        self._run_time = 0.
+
+    def AddStage(self, name, func, workers=1, processes=False, initializer=None, initargs=(), ordered=False):
+        '''
+        Append a stage calling func(item) with workers threads, or workers processes if processes is True
+        (func, initializer and items then have to be picklable; initializer(*initargs) runs in each process).
+        If ordered, the stage receives items in the input order (requires workers=1).
+        '''
+        self._stages.append(Stage(name, func, workers, processes, initializer, initargs, ordered))
+        return self
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOP
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._abort.set()
+
+    def _feed(self, items):
+        try:
+            for seq, item in enumerate(items):
+                if not self._put(self._stages[0].input, (seq, item)):
+                    return
+        except Exception as e:
+            self._fail(e)
+        for _ in range(self._stages[0].workers):
+            self._put(self._stages[0].input, _STOP)
+
+    def _work(self, istage, output):
+        stage = self._stages[istage]
+        nworkers = self._stages[istage+1].workers if istage+1 < len(self._stages) else 1
+        pending = dict()
+        next_seq = 0
+        try:
+            while True:
+                stage._sample()
+                item = self._get(stage.input)
+                if item is _STOP:
+                    break
+                if stage.ordered:
+                    pending[item[0]] = item[1]
+                    ready = []
+                    while next_seq in pending:
+                        ready.append((next_seq, pending.pop(next_seq)))
+                        next_seq += 1
+                else:
+                    ready = [item]
+                for seq, payload in ready:
+                    # dropped items are forwarded so that the order can be restored downstream
+                    if payload is not None:
+                        start = time.time()
+                        payload = stage._call(payload)
+                        with stage._lock:
+                            stage.busy_time += time.time() - start
+                            stage.items += 1
+                    if not self._put(output, (seq, payload)):
+                        return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with stage._lock:
+                stage._running -= 1
+                last = stage._running == 0
+            if last:
+                for _ in range(nworkers):
+                    self._put(output, _STOP)
+
+    def Run(self, items):
+        '''
+        Run the pipeline on items (an iterable) and yield the outputs of the last stage in the input order.
+        An exception raised in a stage stops the pipeline and is raised here.
+        '''
+        if not self._stages:
+            raise RuntimeError('Pipeline has no stage')
+
+        for stage in self._stages:
+            stage.input = queue.Queue(self._queue_size)
+            stage._running = stage.workers
+            if stage.processes:
+                import multiprocessing
+                stage.pool = multiprocessing.Pool(stage.workers, stage.initializer, stage.initargs)
+            elif stage.initializer is not None:
+                stage.initializer(*stage.initargs)
+        output = queue.Queue(self._queue_size)
+
+        self._start_time = time.time()
+        threads = [threading.Thread(target=self._feed, args=(items,), daemon=True)]
+        for istage, stage in enumerate(self._stages):
+            target = self._stages[istage+1].input if istage+1 < len(self._stages) else output
+            threads += [threading.Thread(target=self._work, args=(istage, target), daemon=True)
+                for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        finished = False
+        try:
+            pending = dict()
+            next_seq = 0
+            while True:
+                item = self._get(output)
+                if item is _STOP:
+                    finished = True
+                    break
+                pending[item[0]] = item[1]
+                while next_seq in pending:
+                    payload = pending.pop(next_seq)
+                    next_seq += 1
+                    if payload is not None:
+                        yield payload
+        finally:
+            # stop the stages if the consumer did not read all the outputs
+            if not finished:
+                self._abort.set()
+            for thread in threads:
+                thread.join()
+            for stage in self._stages:
+                if stage.pool is not None:
+                    stage.pool.close() if self._error is None else stage.pool.terminate()
+                    stage.pool.join()
+                    stage.pool = None
+            self._run_time = time.time() - self._start_time
+
+        if self._error is not None:
+            raise self._error
+
+    def Stats(self):
+        '''
+        Per-stage statistics: number of processed items, busy time summed over workers, utilization
+        (busy time / (workers x run time)), and the mean/max occupancy of the input queue.
+        '''
+        stats = dict()
+        for stage in self._stages:
+            run_time = self._run_time if self._run_time > 0 else float('nan')
+            stats[stage.name] = dict(workers=stage.workers,
+                items=stage.items,
+                busy_time=stage.busy_time,
+                utilization=stage.busy_time / (stage.workers * run_time),
+                queue_mean=stage.queue_sum / stage.queue_samples if stage.queue_samples else 0.,
+                queue_max=stage.queue_max,
+                queue_size=self._queue_size,
+                )
+        return stats
+
+    def Report(self):
+        '''
+        Print the statistics of each stage. The stage with a full input queue and a high utilization
+        is the bottleneck.
+        '''
+        print(f'--- pipeline {self._run_time:.2e} seconds ---')
+        for name, s in self.Stats().items():
+            print(f'    {name:10s} workers {s["workers"]:3d} items {s["items"]:6d} busy {s["busy_time"]:.2e} s'
+                f' utilization {s["utilization"]*100:5.1f} % queue mean {s["queue_mean"]:.2f} max {s["queue_max"]}/{s["queue_size"]}')
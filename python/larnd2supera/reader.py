@@ -1,3 +1,9 @@
+import os
+import json
+import queue
+import hashlib
+import tempfile
+import threading
 import h5py as h5
 import numpy as np
 from LarpixParser import event_parser as EventParser
@@ -9,24 +15,80 @@ class InputEvent:
     segments = None
     packets  = None
     trajectories = None
+    hits = None
     t0 = -1
+    entry = -1
     segment_index_min = -1
     event_separator = ''
 
 class InputReader:
+
+    # HDF5 dataset name for each data product held by the reader
+    DATASETS = dict(packets='packets',
+        mc_packets_assn='mc_packets_assn',
+        segments='tracks',
+        trajectories='trajectories',
+        vertices='vertices',
+        )
+
+    # Sidecar event index cache (see _file_index)
+    INDEX_CACHE_SUFFIX  = '.l2s-index.npz'
+    INDEX_CACHE_VERSION = 1
+    INDEX_KEYS = ('packet2event','segment_event','trajectory_event','event_t0s')
+
+    # Columns computed for each packet row by the hit parsing pre-pass (see _parse_hits)
+    HIT_DTYPE = np.dtype([('x','f8'),('y','f8'),('z','f8'),('dE','f8')])
+
+    # Integrity counts per entry (see IntegrityCounts)
+    INTEGRITY_KEYS = ('trackid_above_max', # segments with a track ID above the max trajectory track ID
+        'trackid_below_min',               # segments with a track ID below the min trajectory track ID
+        'invalid_traj_id',                 # segments with a traj_id not found in the trajectories
+        'assn_below_range',                # packets associated to a segment index below the event's segments
+        'assn_above_range',                # packets associated to a segment index above the event's segments
+        )
     
-    def __init__(self,parser_run_config, input_files=None):
+    def __init__(self,parser_run_config, input_files=None, streaming=False, chunk_size=1000000, index_cache=False,
+        use_mmap=True, fields=None, check_integrity=False, entry_range=None, shard=None, hit_geometry=None):
         self._mc_packets_assn = None
         self._packets = None
         self._segments = None
         self._trajectories = None
-        self._vertices = None
-        self._packet2event = None
         self._event_ids = None
+        self._event_order = None
         self._event_t0s = None
         self._if_spill = False
         self._run_config = parser_run_config
         self._is_sim = False
+        # streaming mode: keep the input file open and read rows per event
+        self._streaming = streaming
+        self._chunk_size = int(chunk_size)
+        self._index_cache = index_cache
+        # serve uncompressed, contiguous datasets as memory-mapped arrays
+        self._use_mmap = use_mmap
+        # column projection: {dataset name: list of fields to read} (all fields if not listed)
+        self._fields = dict(fields) if fields else dict()
+        # run the integrity check for whole files in ReadFile (counts per entry used by CheckIntegrity)
+        self._check_integrity = check_integrity
+        self._integrity = None
+        # only handle a subset of entries: entry_range=(start,stop) or shard=(i,N) for the i-th of N shards
+        self._entry_range = entry_range
+        self._shard = shard
+        # larnd2supera.geometry.PixelGeometry: if given, x, y, z and dE of the data packets are computed
+        # in blocks of chunk_size packets and returned as InputEvent.hits (see _parse_hits)
+        self._hit_geometry = hit_geometry
+        self._hits = None
+        self._hit_t0s = None
+        self._hit_blocks = None
+        # first row of the loaded (in-memory) part of each dataset of the current file
+        self._row_base = dict()
+        # input files are kept separate: global entry => (file, local entry) via self._entry_offsets
+        self._input_files = []
+        self._entry_offsets = None
+        # per-file event index: event IDs and (row order, start, stop) for packets, segments and trajectories
+        self._file_indices = []
+        # the currently opened input file (index into self._input_files) and its h5py handle
+        self._current_file = -1
+        self._fin = None
         
         if input_files:
             self.ReadFile(input_files)
@@ -42,6 +104,51 @@ class InputReader:
             yield self.GetEntry(entry)
 
 
+    def Prefetch(self,entries=None,depth=2):
+        '''
+        Iterate over (entry, InputEvent) for the given entries (default: all) while a background
+        thread reads up to depth upcoming entries, overlapping the input I/O with the processing.
+        The reader must not be used otherwise (e.g. GetEntry) during the iteration.
+        '''
+        if entries is None:
+            entries = range(len(self))
+
+        buffer = queue.Queue(maxsize=max(1,int(depth)))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item,timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read():
+            try:
+                for entry in entries:
+                    if not put((entry,self.GetEntry(entry))):
+                        return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        thread = threading.Thread(target=read,daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is None:
+                    break
+                if isinstance(item,Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
     def _correct_t0s(self,event_t0s,num_event):
         # compute dt.
         dt=event_t0s[1:]-event_t0s[:-1]
@@ -54,143 +161,600 @@ class InputReader:
         return corrected_t0s
 
     
+    def Close(self):
+        if self._fin is not None:
+            self._fin.close()
+        self._fin = None
+        self._current_file = -1
+        self._packets = None
+        self._mc_packets_assn = None
+        self._segments = None
+        self._trajectories = None
+        self._hits = None
+        self._hit_t0s = None
+        self._hit_blocks = None
+
+
+    def __getstate__(self):
+        # the reader is sent to worker processes closed (file handles and loaded datasets are not copied)
+        state = self.__dict__.copy()
+        for name in ['fin','packets','mc_packets_assn','segments','trajectories',
+            'hits','hit_t0s','hit_blocks']:
+            state['_'+name] = None
+        state['_current_file'] = -1
+        return state
+
+
+    def _projection(self,name,dset):
+        '''
+        Return the list of fields to be read for a dataset, or None to read all fields.
+        The event separator is always included. Requested fields missing in the input are ignored.
+        '''
+        if not name in self._fields:
+            return None
+        fields = list(self._fields[name])
+        separator = self._run_config['event_separator']
+        if separator in dset.dtype.names and not separator in fields:
+            fields.append(separator)
+        missing = [f for f in fields if not f in dset.dtype.names]
+        if missing:
+            print('    Requested fields not found in',dset.name,'(ignored):',missing)
+        return [f for f in dset.dtype.names if f in fields]
+
+
+    def _memmap(self,dset):
+        '''
+        Return a copy-on-write np.memmap of an HDF5 dataset if it is stored contiguously without
+        compression/filters (i.e. the raw bytes in the file are the structured array), otherwise None.
+        '''
+        if dset.chunks is not None or dset.compression is not None or dset.dtype.hasobject:
+            return None
+        offset = dset.id.get_offset()
+        if offset is None or dset.id.get_type().get_size() != dset.dtype.itemsize:
+            return None
+        return np.memmap(dset.file.filename,mode='c',dtype=dset.dtype,offset=offset,shape=dset.shape)
+
+
+    def _open(self,ifile):
+        '''
+        Make the ifile-th input file the current one. Only one input file is opened at a time.
+        Contiguous datasets are memory-mapped (if enabled). Other datasets are read through the
+        h5py handle in streaming mode, or otherwise loaded in memory.
+        '''
+        if ifile == self._current_file:
+            return
+        self.Close()
+        fin = h5.File(self._input_files[ifile],'r')
+        row_range = self._file_indices[ifile]['row_range']
+        for name in ['packets','mc_packets_assn','segments','trajectories']:
+            dset = fin[self.DATASETS[name]]
+            fields = self._projection(name,dset)
+            # only the rows spanned by the entries of this file are used
+            lo, hi = row_range[name]
+            data = self._memmap(dset) if self._use_mmap else None
+            if data is None:
+                if fields:
+                    dset = dset.fields(fields)
+                if self._streaming:
+                    data, lo = dset, 0
+                else:
+                    data = dset[lo:hi]
+            else:
+                data = data[lo:hi]
+                if fields:
+                    # multi-field index of a structured array is a view (no copy)
+                    data = data[fields]
+            setattr(self,'_'+name,data)
+            self._row_base[name] = lo
+        # vertices are only read for the event T0s when building the index (see _file_index)
+        if self._streaming:
+            self._fin = fin
+        else:
+            fin.close()
+        self._current_file = ifile
+        if self._hit_geometry is not None:
+            self._init_hits(ifile)
+
+
+    def _init_hits(self,ifile):
+        '''
+        Prepare the hit columns of the packet rows of the current file: the t0 of the event of each
+        packet row (NaN if not an entry), and empty x, y, z, dE to be filled block by block.
+        Columns kept in the file index by ParseHits are used as they are.
+        '''
+        index = self._file_indices[ifile]
+        lo, hi = index['row_range']['packets']
+        self._row_base['hits'] = lo
+        if 'hits' in index:
+            self._hit_t0s, self._hits, self._hit_blocks = index['hits']
+            return
+        order, start, stop = index['packets']
+        counts = stop - start
+        # positions in order of the rows of each entry, concatenated
+        pos = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        self._hit_t0s = np.full(hi-lo,np.nan)
+        self._hit_t0s[order[pos]-lo] = np.repeat(index['event_t0s'][index['event_ids']],counts)
+        self._hits = np.full(hi-lo,np.nan,dtype=self.HIT_DTYPE)
+        self._hit_blocks = np.zeros((hi-lo+self._chunk_size-1)//self._chunk_size,dtype=bool)
+
+
+    def ParseHits(self):
+        '''
+        Compute the hit columns of all entries and keep them in the file indices, so that they
+        are computed once (e.g. before the reader is handed to worker processes). Requires hit_geometry.
+        '''
+        if self._hit_geometry is None:
+            raise RuntimeError('ParseHits requires the hit_geometry of the reader')
+        for ifile, index in enumerate(self._file_indices):
+            lo, hi = index['row_range']['packets']
+            if hi <= lo:
+                continue
+            self._open(ifile)
+            self._parse_hits(np.arange(lo,hi))
+            index['hits'] = (self._hit_t0s, self._hits, self._hit_blocks)
+        self.Close()
+
+
+    def _parse_hits(self,rows):
+        '''
+        Return x, y, z, dE of the given packet rows of the current file (NaN for non-data packets).
+        They are computed by one PixelGeometry call per block of chunk_size packet rows, using the t0
+        of each packet's event, when a row of the block is first requested.
+        '''
+        base = self._row_base['hits']
+        for block in np.unique((rows - base)//self._chunk_size):
+            if self._hit_blocks[block]:
+                continue
+            start = block*self._chunk_size
+            stop  = min(start+self._chunk_size,len(self._hits))
+            packets = self._read_rows('packets',np.arange(start,stop)+base)
+            t0s  = self._hit_t0s[start:stop]
+            mask = (packets['packet_type'] == 0) & np.isfinite(t0s)
+            if mask.any():
+                x, y, z, dE = self._hit_geometry.HitParserEnergy(t0s[mask], packets[mask],
+                    self._run_config, switch_xz=True)
+                for key, values in zip(self.HIT_DTYPE.names,(x,y,z,dE)):
+                    self._hits[key][start:stop][mask] = values
+            self._hit_blocks[block] = True
+        return self._read_rows('hits',rows)
+
+
+    def _packet_to_eventid(self,fin):
+        '''
+        Compute the event ID of each packet in one input file. The association array is read
+        in blocks of self._chunk_size rows and only the event separator column of segments is
+        loaded, so the memory usage does not scale with the size of these datasets.
+        '''
+        separator = self._run_config['event_separator']
+        segments = fin[self.DATASETS['segments']].fields([separator])[:]
+        assn = fin[self.DATASETS['mc_packets_assn']]
+
+        packet2event = np.empty(len(assn),dtype=int)
+        for start in range(0,len(assn),self._chunk_size):
+            stop  = min(start+self._chunk_size,len(assn))
+            block = assn.fields(['track_ids'])[start:stop]
+            packet2event[start:stop] = EventParser.packet_to_eventid(block,segments,separator)
+        return packet2event
+
+
+    def _config_hash(self):
+        # numpy repr elides large arrays: serialize the full values
+        def tolist(value):
+            if isinstance(value,(np.ndarray,np.generic)):
+                return value.tolist()
+            return repr(value)
+        return hashlib.sha1(json.dumps(self._run_config,sort_keys=True,default=tolist).encode()).hexdigest()
+
+
+    def _file_index(self,fname):
+        '''
+        Return the event index of one input file: the event ID of each packet, segment and trajectory
+        as well as the event T0s. If the index cache is enabled, the index is loaded from a sidecar file
+        next to the input (or stored there if missing/outdated). The cache is valid for the same input
+        file size, mtime and ParserRunConfig.
+        '''
+        stat = os.stat(fname)
+        key  = dict(version=self.INDEX_CACHE_VERSION,
+            file_size=stat.st_size,
+            file_mtime=stat.st_mtime_ns,
+            config_hash=self._config_hash(),
+            )
+        cache = fname + self.INDEX_CACHE_SUFFIX
+
+        if self._index_cache and os.path.isfile(cache):
+            try:
+                with np.load(cache) as f:
+                    if all(f[k] == v for k,v in key.items()):
+                        return {name:f[name] for name in self.INDEX_KEYS}
+                print('    Index cache is outdated (re-creating):',cache)
+            except Exception as e:
+                print('    Failed to read the index cache',cache,e)
+
+        separator = self._run_config['event_separator']
+        with h5.File(fname,'r') as fin:
+            if not 'mc_packets_assn' in fin.keys():
+                return None
+            index = dict(packet2event=self._packet_to_eventid(fin),
+                segment_event=fin[self.DATASETS['segments']].fields(separator)[:],
+                trajectory_event=fin[self.DATASETS['trajectories']].fields(separator)[:],
+                event_t0s=EventParser.get_t0_event(fin[self.DATASETS['vertices']][:],self._run_config),
+                )
+
+        if self._index_cache:
+            # a unique temporary file per writer (several jobs may index the same input)
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(prefix=os.path.basename(cache)+'.',suffix='.tmp',
+                    dir=os.path.dirname(os.path.abspath(cache)))
+                with os.fdopen(fd,'wb') as f:
+                    np.savez(f,**index,**key)
+                os.replace(tmp,cache)
+            except OSError as e:
+                print('    Failed to store the index cache',cache,e)
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+
+        return index
+
+
+    def _build_index(self,row_event,event_ids):
+        '''
+        Build a compressed row index from the event ID of each row. Rows of the i-th event are
+        order[start[i]:stop[i]], in the same (ascending) order as they appear in the input.
+        '''
+        order = np.argsort(row_event,kind='stable')
+        sorted_event = row_event[order]
+        start = np.searchsorted(sorted_event,event_ids,side='left')
+        stop  = np.searchsorted(sorted_event,event_ids,side='right')
+        return order, start, stop
+
+
+    def _locate(self,index):
+        '''
+        Map a global entry index to (input file index, local entry index within the file)
+        '''
+        ifile = np.searchsorted(self._entry_offsets,index,side='right') - 1
+        return ifile, index - self._entry_offsets[ifile]
+
+
+    def _event_rows(self,name,ifile,local_index):
+        order, start, stop = self._file_indices[ifile][name]
+        return order[start[local_index]:stop[local_index]]
+
+
+    def _read_rows(self,name,rows):
+        '''
+        Read the (sorted) row indices of a dataset from the current input file. If the rows are
+        contiguous, a slice is returned (a view for in-memory/memory-mapped data). An h5py dataset
+        is accessed with one contiguous slice covering the requested rows.
+        '''
+        data = getattr(self,'_'+name)
+        base = self._row_base[name]
+        block = data[rows[0]-base:rows[-1]+1-base]
+        if len(block) == len(rows):
+            return block
+        return block[rows - rows[0]]
+
+    
+    def _row_entry(self,row_event,event_ids):
+        '''
+        Return the (local) entry index of each row from its event ID, -1 if not an entry.
+        '''
+        loc = np.searchsorted(event_ids,row_event)
+        valid = loc < len(event_ids)
+        valid[valid] = event_ids[loc[valid]] == row_event[valid]
+        return np.where(valid,loc,-1)
+
+
+    def _integrity_counts(self,num_entries,
+        seg_entry,seg_trackid,seg_trajid,traj_entry,traj_trackid,
+        packet_entry,track_ids,seg_start,seg_stop):
+        '''
+        Compute integrity counts (see INTEGRITY_KEYS) per entry with column operations.
+        seg_entry/traj_entry/packet_entry is the entry index of each segment/trajectory/packet
+        (-1 to ignore), and the segment index range of each entry is [seg_start, seg_stop).
+        '''
+        counts = dict()
+
+        seg_mask  = seg_entry  > -1
+        traj_mask = traj_entry > -1
+        seg_entry, seg_trackid, seg_trajid = seg_entry[seg_mask], seg_trackid[seg_mask], seg_trajid[seg_mask]
+        traj_entry, traj_trackid = traj_entry[traj_mask], traj_trackid[traj_mask].astype(np.int64)
+
+        traj_max = np.full(num_entries,np.iinfo(np.int64).min)
+        traj_min = np.full(num_entries,np.iinfo(np.int64).max)
+        np.maximum.at(traj_max,traj_entry,traj_trackid)
+        np.minimum.at(traj_min,traj_entry,traj_trackid)
+        counts['trackid_above_max'] = np.bincount(seg_entry[seg_trackid > traj_max[seg_entry]],minlength=num_entries)
+        counts['trackid_below_min'] = np.bincount(seg_entry[seg_trackid < traj_min[seg_entry]],minlength=num_entries)
+
+        # (entry, track ID) pairs as a single key (IDs shifted to start from 0, as they can be negative)
+        seg_trajid = seg_trajid.astype(np.int64)
+        id_min = int(min(traj_trackid.min(initial=0),seg_trajid.min(initial=0)))
+        width  = int(max(traj_trackid.max(initial=0),seg_trajid.max(initial=0))) - id_min + 1
+        valid = np.isin(seg_entry*width + (seg_trajid - id_min),traj_entry*width + (traj_trackid - id_min))
+        counts['invalid_traj_id'] = np.bincount(seg_entry[~valid],minlength=num_entries)
+
+        below, above = self._association_range(track_ids,seg_start[packet_entry],seg_stop[packet_entry])
+        packet_mask = packet_entry > -1
+        counts['assn_below_range'] = np.bincount(packet_entry[packet_mask & below.any(axis=1)],minlength=num_entries)
+        counts['assn_above_range'] = np.bincount(packet_entry[packet_mask & above.any(axis=1)],minlength=num_entries)
+
+        return counts
+
+
+    def _association_range(self,track_ids,seg_start,seg_stop):
+        '''
+        Return masks of associated segment indices (track_ids, shape (N,M)) below/above
+        the per-packet segment index range [seg_start, seg_stop).
+        '''
+        valid = track_ids > -1
+        below = valid & (track_ids < np.asarray(seg_start)[...,None])
+        above = valid & (track_ids >= np.asarray(seg_stop)[...,None])
+        return below, above
+
+
+    def _check_file(self,ifile,index):
+        '''
+        Integrity counts for all entries of one input file (see INTEGRITY_KEYS).
+        '''
+        file_index = self._file_indices[ifile]
+        event_ids = file_index['event_ids']
+        order, start, stop = file_index['segments']
+        seg_start = np.where(stop > start,order[np.minimum(start,len(order)-1)],0)
+        seg_stop  = seg_start + (stop - start)
+
+        with h5.File(self._input_files[ifile],'r') as fin:
+            segments = fin[self.DATASETS['segments']].fields(['trackID','traj_id'])[:]
+            traj_trackid = fin[self.DATASETS['trajectories']].fields('trackID')[:]
+            counts = self._integrity_counts(len(event_ids),
+                self._row_entry(index['segment_event'],event_ids),segments['trackID'],segments['traj_id'],
+                self._row_entry(index['trajectory_event'],event_ids),traj_trackid,
+                np.zeros(0,dtype=int),np.zeros((0,1),dtype=int),seg_start,seg_stop)
+
+            # association is checked in blocks of packets
+            packet_entry = self._row_entry(index['packet2event'],event_ids)
+            assn = fin[self.DATASETS['mc_packets_assn']]
+            for key in ['assn_below_range','assn_above_range']:
+                counts[key][:] = 0
+            for block_start in range(0,len(assn),self._chunk_size):
+                block_stop = min(block_start+self._chunk_size,len(assn))
+                entry = packet_entry[block_start:block_stop]
+                mask  = entry > -1
+                track_ids = assn.fields('track_ids')[block_start:block_stop][mask]
+                below, above = self._association_range(track_ids,seg_start[entry[mask]],seg_stop[entry[mask]])
+                counts['assn_below_range'] += np.bincount(entry[mask][below.any(axis=1)],minlength=len(event_ids))
+                counts['assn_above_range'] += np.bincount(entry[mask][above.any(axis=1)],minlength=len(event_ids))
+
+        return counts
+
+
+    def IntegrityCounts(self,data):
+        '''
+        Return the integrity counts (see INTEGRITY_KEYS) of one InputEvent
+        '''
+        counts = self._integrity_counts(1,
+            np.zeros(len(data.segments),dtype=int),data.segments['trackID'],data.segments['traj_id'],
+            np.zeros(len(data.trajectories),dtype=int),data.trajectories['trackID'],
+            np.zeros(len(data.packets),dtype=int),data.mc_packets_assn['track_ids'],
+            np.array([data.segment_index_min]),np.array([data.segment_index_min+len(data.segments)]))
+        return {key:int(val[0]) for key,val in counts.items()}
+
+
+    def IntegrityReport(self):
+        '''
+        Return the integrity counts of all entries (arrays indexed by entry) computed in ReadFile.
+        Requires check_integrity=True.
+        '''
+        if not self._check_integrity:
+            raise RuntimeError('The integrity check is not enabled (check_integrity=True)')
+        if self._integrity is None:
+            self._integrity = {key:np.concatenate([index['integrity'][key] for index in self._file_indices])
+                for key in self.INTEGRITY_KEYS}
+        return self._integrity
+
+
+    def _row_range(self,index):
+        '''
+        Return the range of rows [lo, hi) spanned by the entries of a (row order, start, stop) index
+        '''
+        order, start, stop = index
+        nonempty = stop > start
+        if not nonempty.any():
+            return 0, 0
+        return int(order[start[nonempty]].min()), int(order[stop[nonempty]-1].max())+1
+
+
+    def _select_entries(self,start,stop):
+        '''
+        Keep only the global entries [start, stop) in the per-file indices (entries are renumbered from 0)
+        '''
+        offsets = np.cumsum([0]+[len(index['event_ids']) for index in self._file_indices])
+        for ifile, index in enumerate(self._file_indices):
+            lo = min(max(start - offsets[ifile],0),len(index['event_ids']))
+            hi = min(max(stop  - offsets[ifile],0),len(index['event_ids']))
+            index['event_ids'] = index['event_ids'][lo:hi]
+            for name in ['packets','segments','trajectories']:
+                order, first, last = index[name]
+                index[name] = (order, first[lo:hi], last[lo:hi])
+            if 'integrity' in index:
+                index['integrity'] = {key:val[lo:hi] for key,val in index['integrity'].items()}
+
+
     def ReadFile(self,input_files,verbose=False):
-        mc_packets_assn = []
-        packets  = []
-        segments = []
-        trajectories = []
-        vertices = []
+        event_ids = []
+        event_t0s = []
+        ctr_packet = 0
+        ctr_invalid_packet = 0
         
         if type(input_files) == str:
             input_files = [input_files]
+
+        self.Close()
+        self._input_files = list(input_files)
+        self._file_indices = []
+        self._integrity = None
         
         self._is_sim = False
-        for f in input_files:
-            with h5.File(f,'r') as fin:
-                packets.append(fin['packets'][:])
-                self._is_sim = 'mc_packets_assn' in fin.keys()
-                if self._is_sim:
-                    mc_packets_assn.append(fin['mc_packets_assn'][:])
-                    segments.append(fin['tracks'][:])
-                    trajectories.append(fin['trajectories'][:])
-                    vertices.append(fin['vertices'][:])
-                    if verbose: print('Read-in:',f)
-                
-        self._packets = np.concatenate(packets)
+        for f in self._input_files:
+            index = self._file_index(f)
+            self._is_sim = index is not None
+            if not self._is_sim:
+                break
+
+            packet2event = index['packet2event']
+            packet_mask  = packet2event != -1
+            ctr_packet  += len(packet2event)
+            ctr_invalid_packet += len(packet2event) - packet_mask.sum()
+
+            # create a list of unique Event IDs in this file and the per-event row index
+            # so that GetEntry does not need to scan all rows
+            file_event_ids = np.unique(packet2event[packet_mask]).astype(np.int64)
+            self._file_indices.append(dict(event_ids=file_event_ids,
+                packets=self._build_index(packet2event,file_event_ids),
+                segments=self._build_index(index['segment_event'],file_event_ids),
+                trajectories=self._build_index(index['trajectory_event'],file_event_ids),
+                # event IDs start from 0 in each file: T0s are looked up per file
+                event_t0s=np.asarray(index['event_t0s']).flatten(),
+                ))
+            if self._check_integrity:
+                self._file_indices[-1]['integrity'] = self._check_file(len(self._file_indices)-1,index)
+            event_ids.append(file_event_ids)
+            event_t0s.append(index['event_t0s'])
+            if verbose: print('Read-in:',f)
 
         if not self._is_sim:
             print('Currently only simulation is supoprted')
             raise NotImplementedError
-        self._mc_packets_assn = np.concatenate(mc_packets_assn)
-        self._segments  = np.concatenate(segments )
-        self._trajectories = np.concatenate(trajectories)
-        self._vertices = np.concatenate(vertices)
-        
 
-        import yaml
-        yaml.dump(self._run_config)
-
-        # create mapping
-<<<<<<< HEAD
-        self._packet2event = EventParser.packet_to_eventid(self._mc_packets_assn,
-            self._segments,
-            self._run_config['event_separator'])
-=======
-        self._packet2event = EventParser.packet_to_eventid(self._mc_packets_assn, self._segments, self._vertices)
->>>>>>> c27f26a9fe1d7af96956e4c611a213e5d8d21dd0
-        
-        packet_mask = self._packet2event != -1
-        ctr_packet  = len(self._packets)
-        ctr_invalid_packet = ctr_packet - packet_mask.sum()
         if verbose:
             print('    %d (%.2f%%) packets without an event ID assignment. They will be ignored.' % (ctr_invalid_packet,
                                                                                                      ctr_invalid_packet/ctr_packet)
                  )
         
-        # create a list of unique Event IDs
-        self._event_ids = np.unique(self._packet2event[packet_mask]).astype(np.int64)
+        # Restrict to a range of entries if requested, then find the rows spanned by them in each file
+        num_entries = sum([len(ids) for ids in event_ids])
+        if self._shard:
+            ishard, nshard = self._shard
+            if not 0 <= ishard < nshard:
+                raise ValueError(f'Invalid shard {ishard}/{nshard}')
+            self._select_entries(ishard*num_entries//nshard,(ishard+1)*num_entries//nshard)
+        elif self._entry_range:
+            start, stop = self._entry_range
+            self._select_entries(0 if start is None else start, num_entries if stop is None else stop)
+        event_ids = [index['event_ids'] for index in self._file_indices]
+        for index in self._file_indices:
+            index['row_range'] = {name:self._row_range(index[name]) for name in ['packets','segments','trajectories']}
+            index['row_range']['mc_packets_assn'] = index['row_range']['packets']
+
+        self._entry_offsets = np.cumsum([0]+[len(ids) for ids in event_ids])
+        self._event_ids = np.concatenate(event_ids)
+        # entries sorted by event ID for the event ID => entry lookup
+        self._event_order = np.argsort(self._event_ids,kind='stable')
         if verbose:
             missing_ids = [i for i in np.arange(np.min(self._event_ids),np.max(self._event_ids)+1,1) if not i in self._event_ids]
             print('    %d unique event IDs found.' % len(self._event_ids))
             print('    Potentially missing %d event IDs %s' % (len(missing_ids),str(missing_ids)))
-        
+
         # create a list of corresponding T0s        
-        self._event_t0s = EventParser.get_t0_event(self._vertices,self._run_config)
+        self._event_t0s = np.concatenate(event_t0s)
 
         # Assert strong assumptions here
         # the number of readout should be same as the number of valid Event IDs
-        if len(self._event_ids) > len(self._event_t0s):
-            raise ValueError(f'Mismatch in the number of unique Event IDs {len(self._event_ids)} and event T0 counts {self._event_t0s.shape[0]}')
+        if num_entries > len(self._event_t0s):
+            raise ValueError(f'Mismatch in the number of unique Event IDs {num_entries} and event T0 counts {self._event_t0s.shape[0]}')
 
-        if len(self._event_ids) < len(self._event_t0s):
-            print('    %d T0s found > %d unique event IDs.' % (len(self._event_t0s),len(self._event_ids)))
+        if num_entries < len(self._event_t0s):
+            print('    %d T0s found > %d unique event IDs.' % (len(self._event_t0s),num_entries))
             print('    Ignoring the extra t0s...')
 
         # Now it's safe to assume all readout groups for every event shares the same T0
         self._event_t0s = self._event_t0s.flatten()
 
+        if self._check_integrity:
+            for key, val in self.IntegrityReport().items():
+                if verbose or val.sum():
+                    print('    Integrity check %s: %d in %d entries' % (key,val.sum(),(val>0).sum()))
+
+
+
+    def FindEntries(self,event_ids):
+        '''
+        Return the entry index for each of the given event IDs (-1 if not found). If an event ID
+        appears in more than one entry (i.e. input files), the first entry is returned.
+        '''
+        event_ids = np.asarray(event_ids,dtype=np.int64)
+        if len(self) < 1:
+            return np.full(event_ids.shape,-1)
+        sorted_ids = self._event_ids[self._event_order]
+        loc = np.searchsorted(sorted_ids,event_ids,side='left')
+        loc = np.minimum(loc,len(sorted_ids)-1)
+        found = sorted_ids[loc] == event_ids
+        return np.where(found,self._event_order[loc],-1)
 
 
     def GetEvent(self,event_id):
         
-        index_loc = (self._event_ids == event_id).nonzero()[0]
+        index = self.FindEntries([event_id])[0]
         
-        if len(index_loc) < 1:
+        if index < 0:
             print('Event ID',event_id,'not found in the data')
             print('Invalid read request (returning None)')
             return None
         
-        return GetEntry(index_loc[0])
+        return self.GetEntry(index)
 
-    def CheckIntegrity(self,data,fix_association=False):
 
-        flag = True
-        tid_range0 = np.array([t['trackID'] for t in data.trajectories])
-        tid_range1 = np.array([s['trackID'] for s in data.segments    ])
+    def GetEvents(self,event_ids):
+        '''
+        Return a list of InputEvent for the given event IDs (None for those not found).
+        Entries are read in the order of the input so that each input file is opened once.
+        '''
+        indices = self.FindEntries(event_ids)
+        result  = [None] * len(indices)
+        for i in np.argsort(indices,kind='stable'):
+            if indices[i] < 0:
+                print('Event ID',event_ids[i],'not found in the data')
+                continue
+            result[i] = self.GetEntry(indices[i])
+        return result
 
-        if tid_range0.max() < tid_range1.max():
-            print('[ERROR] Max Track ID in the segments exceeds the maximum of the trajectories')
-            flag = False
+    def CheckIntegrity(self,data,fix_association=False):
 
-        if tid_range0.min() > tid_range1.min():
-            print('[ERROR] Min Track ID in the segments is below the minimum of the trajectories')
-            flag = False
+        if self._check_integrity and data.entry > -1:
+            # counts of the whole-file check in ReadFile: nothing to do for a good entry
+            counts = {key:int(val[data.entry]) for key,val in self.IntegrityReport().items()}
+            if not any(counts.values()):
+                return True
+        else:
+            counts = self.IntegrityCounts(data)
+        problems = ['%s=%d' % (key,val) for key,val in counts.items() if val]
+        if problems:
+            print('[WARNING] Integrity check for event',data.event_id,':',', '.join(problems))
 
-        if not flag:
-            return flag
+        # Track IDs in the segments must be within the range of the trajectories
+        if counts['trackid_above_max'] or counts['trackid_below_min']:
+            print('[ERROR] Track ID range of the segments exceeds that of the trajectories')
+            return False
 
-        seg_index = data.mc_packets_assn['track_ids']
-        # check if max index is within the number of segments
-        max_index = seg_index.max()
-        min_index = seg_index[seg_index>-1].min()
+        if not (counts['assn_below_range'] or counts['assn_above_range']):
+            return True
 
-        prefix = '[WARNING]' if fix_association else '[ERROR]'
-        if min_index < data.segment_index_min:
-            # Bad segment index on low end
-
-            print(prefix,'Minimum segment index from the association:',min_index)
-            print('        Index range of segments for this event:',data.segment_index_min,
-                '=>',data.segment_index_min+len(data.segments))
-            flag = False
-            if fix_association:
-                print('[WARNING] ignoring the bad association')
-                seg_index[seg_index<data.segment_index_min] = -1
-                data.mc_packets_assn['track_ids'] = seg_index
-                flag = True
-
-        if (max_index - data.segment_index_min) >= len(data.segments):
-            # Bad segment index on high end
-            print(prefix,'Maximum segment index from the association:',max_index)
-            print('        Index range of segments for this event:',data.segment_index_min,
+        # Bad segment index in the association
+        if not fix_association:
+            print('[ERROR] Association refers to segments out of the index range',data.segment_index_min,
                 '=>',data.segment_index_min+len(data.segments))
-            flag = False
-            if fix_association:
-                print('[WARNING] ignoring the bad association')
-                seg_index[seg_index>=(data.segment_index_min+len(data.segments))] = -1
-                data.mc_packets_assn['track_ids'] = seg_index
-                flag = True
+            return False
 
-        return flag
+        print('[WARNING] ignoring the bad association')
+        # the rows may be views of the buffer shared by all entries: fix a copy
+        data.mc_packets_assn = data.mc_packets_assn.copy()
+        seg_index = data.mc_packets_assn['track_ids']
+        below, above = self._association_range(seg_index,data.segment_index_min,
+            data.segment_index_min+len(data.segments))
+        seg_index[below | above] = -1
+        data.mc_packets_assn['track_ids'] = seg_index
+        return True
 
 
     def GetEntry(self,index):
@@ -206,19 +770,25 @@ class InputReader:
         result.event_separator = self._run_config['event_separator']
         
         result.event_id = self._event_ids[index]
-        result.t0 = self._event_t0s[result.event_id]
+        result.entry = index
 
-        mask = self._packet2event == result.event_id
-        
-        result.packets = self._packets[mask]
-        result.mc_packets_assn = self._mc_packets_assn[mask]
+        # Open the input file for this entry (if not yet) and read its rows
+        ifile, local_index = self._locate(index)
+        result.t0 = self._file_indices[ifile]['event_t0s'][result.event_id]
+        self._open(ifile)
+
+        rows = self._event_rows('packets',ifile,local_index)
+        result.packets = self._read_rows('packets',rows)
+        result.mc_packets_assn = self._read_rows('mc_packets_assn',rows)
+        if self._hit_geometry is not None:
+            result.hits = self._parse_hits(rows)
         
-        mask = self._segments[self._run_config['event_separator']] == result.event_id
-        result.segments = self._segments[mask]
+        rows = self._event_rows('segments',ifile,local_index)
+        result.segments = self._read_rows('segments',rows)
         
-        result.segment_index_min = mask.nonzero()[0][0]
+        result.segment_index_min = rows[0]
         
-        mask = self._trajectories[self._run_config['event_separator']] == result.event_id
-        result.trajectories = self._trajectories[mask]
+        rows = self._event_rows('trajectories',ifile,local_index)
+        result.trajectories = self._read_rows('trajectories',rows)
         
         return result  
@@ -9,6 +9,7 @@ from edep2supera.utils import get_iomanager, larcv_meta, larcv_particle
 from LarpixParser import event_parser as EventParser
 from larcv import larcv
 import pandas as pd
+from larnd2supera.checkpoint import SegmentWriter
 
 
 def get_larnd2supera(config_key):
@@ -21,6 +22,16 @@ def get_larnd2supera(config_key):
     
     return driver 
 
+def get_reader(driver, in_file, precompute_hits=False, **kwargs):
+    '''
+    Create an InputReader for the driver. With precompute_hits, the reader computes the packet
+    positions and energies for blocks of packets (instead of ReadEvent for each event).
+    '''
+    return larnd2supera.reader.InputReader(driver.parser_run_config(),in_file,
+        fields=dict(segments=driver.SEGMENT_FIELDS,trajectories=driver.TRAJECTORY_FIELDS),
+        hit_geometry=driver.pixel_geometry() if precompute_hits else None,
+        **kwargs)
+
 def log_supera_integrity_check(data,driver,log,verbose=False):
 
     if not log:
@@ -74,20 +85,41 @@ def log_supera_integrity_check(data,driver,log,verbose=False):
     log['out_unass_sum'].append(unass_sum)
 
 
-# Fill SuperaAtomic class and hand off to label-making
-def run_supera(out_file='larcv.root',
-               in_file='',
-               config_key='',
-               num_events=-1,
-               num_skip=0,
-               ignore_bad_association=True,
-               save_log=None):
+# Keys of the run_supera log (in addition to SuperaDriver.LOG_KEYS)
+LOG_KEYS  = ['event_id','time_read','time_convert','time_generate', 'time_store', 'time_event']
+LOG_KEYS += ['raw_image_sum','raw_image_npx','raw_packet_sum','raw_packet_num',
+    'in_cluster_sum','in_unass_sum','out_image_sum','out_image_num',
+    'out_cluster_sum','out_unass_sum']
 
-    start_time = time.time()
+# Output products of process_entry stored by store_entry: (type, producer, key in the result)
+SPARSE3D_PRODUCTS = [('sparse3d','pcluster','tensor_energy'),
+    ('sparse3d','packets','tensor_packets'),
+    ('sparse3d','pcluster_semantics','tensor_semantic'),
+    ]
+CLUSTER3D_PRODUCTS = [('cluster3d','pcluster','cluster_energy'),
+    ('cluster3d','pcluster_dedx','cluster_dedx'),
+    ]
 
-    writer = get_iomanager(out_file)
-    driver = get_larnd2supera(config_key)
-    reader = larnd2supera.reader.InputReader(driver.parser_run_config(),in_file)
+
+def process_entry(driver, input_data, logger=None):
+    '''
+    Run the driver (ReadEvent, GenerateImageMeta, GenerateLabel) on one event and return a compact result
+    to be stored by store_entry: numpy arrays for tensors/clusters and larcv meta/particles (picklable).
+    '''
+    t1 = time.time()
+    EventInput = driver.ReadEvent(input_data)
+    time_convert = time.time() - t1
+
+    t2 = time.time()
+    driver.GenerateImageMeta(EventInput)
+    driver.GenerateLabel(EventInput) 
+    time_generate = time.time() - t2
+
+    # Perform an integrity check
+    if logger:
+        log_supera_integrity_check(EventInput,driver,logger)
+
+    result = driver.Label()
 
     id_vv=ROOT.std.vector("std::vector<unsigned long>")()
     value_vv=ROOT.std.vector("std::vector<float>")()
@@ -95,117 +127,297 @@ def run_supera(out_file='larcv.root',
     id_v=ROOT.std.vector("unsigned long")()
     value_v=ROOT.std.vector("float")()
 
-    if num_events < 0:
-        num_events = len(reader)
+    def tensor():
+        return (larnd2supera.bulk.vector_to_array(id_v,np.uint64),
+            larnd2supera.bulk.vector_to_array(value_v,np.float32))
 
-    print("--- startup {:.2e} seconds ---".format(time.time() - start_time))
+    def cluster():
+        return (larnd2supera.bulk.vectors_to_arrays(id_vv,np.uint64),
+            larnd2supera.bulk.vectors_to_arrays(value_vv,np.float32))
 
-    LOG_KEYS  = ['event_id','time_read','time_convert','time_generate', 'time_store', 'time_event']
-    LOG_KEYS += ['raw_image_sum','raw_image_npx','raw_packet_sum','raw_packet_num',
-    'in_cluster_sum','in_unass_sum','out_image_sum','out_image_num',
-    'out_cluster_sum','out_unass_sum']
+    output = dict(event_id=int(input_data.event_id),
+        meta=larcv_meta(driver.Meta()),
+        time_convert=time_convert,
+        time_generate=time_generate,
+        )
+
+    result.FillTensorEnergy(id_v,value_v)
+    output['tensor_energy'] = tensor()
+
+    driver.Meta().edep2voxelset(driver._edeps_all).fill_std_vectors(id_v,value_v)
+    output['tensor_packets'] = tensor()
+
+    result.FillTensorSemantic(id_v,value_v)
+    output['tensor_semantic'] = tensor()
+
+    result.FillClustersEnergy(id_vv,value_vv)
+    output['cluster_energy'] = cluster()
+
+    result.FillClustersdEdX(id_vv,value_vv)
+    output['cluster_dedx'] = cluster()
+
+    output['particles'] = [larcv_particle(p) for p in result._particles if p.valid]
+
+    return output
+
+
+def store_entry(writer, output):
+    '''
+    Store the result of process_entry as one entry of the writer (larcv IOManager).
+    '''
+    meta = output['meta']
+
+    id_vv=ROOT.std.vector("std::vector<unsigned long>")()
+    value_vv=ROOT.std.vector("std::vector<float>")()
+
+    id_v=ROOT.std.vector("unsigned long")()
+    value_v=ROOT.std.vector("float")()
+
+    for data_type, producer, key in SPARSE3D_PRODUCTS:
+        ids, values = output[key]
+        larnd2supera.bulk.array_to_vector(ids,id_v)
+        larnd2supera.bulk.array_to_vector(values,value_v)
+        larcv.as_event_sparse3d(writer.get_data(data_type,producer),meta,id_v,value_v)
+
+    for data_type, producer, key in CLUSTER3D_PRODUCTS:
+        ids, values = output[key]
+        larnd2supera.bulk.arrays_to_vectors(*ids,id_vv)
+        larnd2supera.bulk.arrays_to_vectors(*values,value_vv)
+        larcv.as_event_cluster3d(writer.get_data(data_type,producer),meta,id_vv,value_vv)
+
+    particle = writer.get_data("particle","pcluster")
+    for larp in output['particles']:
+        particle.append(larp)
 
+    # TODO fill the run ID 
+    writer.set_id(0,0,output['event_id'])
+    writer.save_entry()
+
+
+# Per-process state of run_supera workers (see _init_worker)
+_WORKER = dict()
+
+
+def _init_worker(config_key, reader, save_log):
+
+    # the reader (if any) comes with the event index (and parsed hits) of the main process
+    driver = get_larnd2supera(config_key)
     logger = dict()
     if save_log:
         for key in LOG_KEYS:
             logger[key]=[]
         driver.log(logger)
-        
-    for entry in range(len(reader)):
+    _WORKER.update(driver=driver, reader=reader, logger=logger)
 
-        if num_skip and entry < num_skip:
-            continue
 
-        if num_events <= 0:
-            break
+def _convert_worker(args):
 
-        num_events -= 1 
+    entry, input_data, time_read = args
+    driver, logger = _WORKER['driver'], _WORKER['logger']
 
-        print(f'Processing Entry {entry}')
+    print(f'Processing Entry {entry}')
+    output = process_entry(driver,input_data,logger)
+    output['time_read'] = time_read
 
-        t0 = time.time()
-        input_data = reader.GetEntry(entry)
-        is_good_event = reader.CheckIntegrity(input_data,ignore_bad_association)
-        if not is_good_event:
-            print('[ERROR] Skipping the entry')
-            continue
-        time_read = time.time() - t0
-        
-        t1 = time.time()
-        EventInput = driver.ReadEvent(input_data)
-        time_convert = time.time() - t1
-
-        # TODO Seems to run, but how to check it's really working?
-        # TODO Should this be supera_driver or driver?
-        t2 = time.time()
-        driver.GenerateImageMeta(EventInput)
-        driver.GenerateLabel(EventInput) 
-        time_generate = time.time() - t2
-
-        # Perform an integrity check
-        if save_log:
-            log_supera_integrity_check(EventInput,driver,logger,verbose)
-
-        # Start data store process
-        t3 = time.time()
-        result = driver.Label()
-        meta   = larcv_meta(driver.Meta())
-        
-        tensor_energy = writer.get_data("sparse3d","pcluster")
-        result.FillTensorEnergy(id_v,value_v)
-        larcv.as_event_sparse3d(tensor_energy,meta,id_v,value_v)
+    # hand over the log of this event and reset the worker log (the driver keeps references to the lists)
+    event_log = {key:list(values) for key,values in logger.items()}
+    for values in logger.values():
+        values.clear()
+    return entry, output, event_log
 
-        tensor_packets = writer.get_data("sparse3d","packets")
-        driver.Meta().edep2voxelset(driver._edeps_all).fill_std_vectors(id_v,value_v)
-        larcv.as_event_sparse3d(tensor_packets,meta,id_v,value_v)
 
-        tensor_semantic = writer.get_data("sparse3d","pcluster_semantics")
-        result.FillTensorSemantic(id_v,value_v)
-        larcv.as_event_sparse3d(tensor_semantic,meta,id_v,value_v)
+def _run_worker(args):
 
-        cluster_energy = writer.get_data("cluster3d","pcluster")
-        result.FillClustersEnergy(id_vv,value_vv)
-        larcv.as_event_cluster3d(cluster_energy,meta,id_vv,value_vv)
+    entry, ignore_bad_association = args
+    reader = _WORKER['reader']
 
-        cluster_dedx = writer.get_data("cluster3d","pcluster_dedx")
-        result.FillClustersdEdX(id_vv,value_vv)
-        larcv.as_event_cluster3d(cluster_dedx,meta,id_vv,value_vv)
-        
-        particle = writer.get_data("particle","pcluster")
-        for p in result._particles:
-            if not p.valid:
-                continue
-            larp = larcv_particle(p)
-            particle.append(larp)
-
-        # TODO fill the run ID 
-        writer.set_id(0,0,int(input_data.event_id))
-        writer.save_entry()
-        time_store = time.time() - t3
-
-        time_event = time.time() - t0
-        print("--- running driver  {:.2e} seconds ---".format(time_event))
-
-        if save_log:
-            logger['event_id'].append(input_data.event_id)
-            logger['time_read'    ].append(time_read)
-            logger['time_convert' ].append(time_convert)
-            logger['time_generate'].append(time_generate)
-            logger['time_store'   ].append(time_store)
-            logger['time_event'   ].append(time_event)
-
-    writer.finalize()
+    t0 = time.time()
+    input_data = reader.GetEntry(entry)
+    if not reader.CheckIntegrity(input_data,ignore_bad_association):
+        print(f'[ERROR] Skipping the entry {entry}')
+        return entry, None, None
+    return _convert_worker((entry, input_data, time.time() - t0))
 
-    # store supera log dictionary
-    if save_log:
-        np.savez('log_larnd2supera.npz',**logger)
 
-    print("done")   
+# Fill SuperaAtomic class and hand off to label-making
+def run_supera(out_file='larcv.root',
+               in_file='',
+               config_key='',
+               num_events=-1,
+               num_skip=0,
+               ignore_bad_association=True,
+               save_log=None,
+               streaming=False,
+               index_cache=False,
+               use_mmap=True,
+               prefetch=0,
+               check_integrity=False,
+               entry_range=None,
+               shard=None,
+               workers=0,
+               pipeline=False,
+               queue_size=4,
+               checkpoint=0,
+               resume=False,
+               precompute_hits=False,
+               overwrite=False):
 
+    start_time = time.time()
 
+    reader_kwargs = dict(streaming=streaming,
+        index_cache=index_cache,
+        use_mmap=use_mmap,
+        check_integrity=check_integrity,
+        entry_range=entry_range,
+        shard=shard,
+        precompute_hits=precompute_hits)
 
+    driver = get_larnd2supera(config_key)
+    reader = get_reader(driver,in_file,**reader_kwargs)
 
+    if num_events < 0:
+        num_events = len(reader)
 
+    print("--- startup {:.2e} seconds ---".format(time.time() - start_time))
 
+    logger = dict()
+    if save_log:
+        for key in LOG_KEYS:
+            logger[key]=[]
+        driver.log(logger)
+        
+    entries = range(num_skip,min(len(reader),num_skip+num_events))
 
+    # entries before the last checkpoint are not read at all
+    writer = SegmentWriter(out_file,checkpoint,resume,in_file,config_key,(entries.start,entries.stop),
+        entry_range,shard,overwrite)
+    if writer.Done():
+        print('All entries were converted already')
+        return
+    entries = range(writer.NextEntry(),entries.stop)
+
+    pipe = None
+    if pipeline:
+        # read (thread) -> convert and label (thread, or a pool of worker processes) -> store (thread),
+        # connected by queues of queue_size entries. Entries are stored in order.
+        pipe = larnd2supera.pipeline.Pipeline(queue_size)
+
+        def read(entry):
+            t0 = time.time()
+            input_data = reader.GetEntry(entry)
+            if not reader.CheckIntegrity(input_data,ignore_bad_association):
+                print(f'[ERROR] Skipping the entry {entry}')
+                return None
+            return entry, input_data, time.time() - t0
+
+        def store(event):
+            t3 = time.time()
+            writer.Store(event[0],event[1])
+            event[1]['time_store'] = time.time() - t3
+            return event
+
+        pipe.AddStage('read',read)
+        if workers > 0:
+            pipe.AddStage('convert',_convert_worker,workers=workers,processes=True,
+                initializer=_init_worker,initargs=(config_key,None,save_log))
+        else:
+            def convert(event):
+                entry, input_data, time_read = event
+                print(f'Processing Entry {entry}')
+                output = process_entry(driver,input_data,logger)
+                output['time_read'] = time_read
+                return entry, output, logger
+            pipe.AddStage('convert',convert)
+        pipe.AddStage('store',store,ordered=True)
+        # the stages call ROOT (supera, larcv) from different threads
+        ROOT.EnableThreadSafety()
+        events = pipe.Run(entries)
+
+    elif workers > 0:
+        # Each worker process has its own driver and a copy of the reader (index built once here)
+        # and converts whole entries. Results are returned (and stored) in the entry order.
+        import multiprocessing
+        if precompute_hits:
+            reader.ParseHits()
+        reader.Close()
+        pool = multiprocessing.Pool(workers,_init_worker,(config_key,reader,save_log))
+        events = pool.imap(_run_worker,[(entry,ignore_bad_association) for entry in entries])
+    else:
+        # Read the entries in the background (prefetch>0) while the current one is processed
+        if prefetch > 0:
+            events = reader.Prefetch(entries,prefetch)
+        else:
+            events = ((entry,reader.GetEntry(entry)) for entry in entries)
+
+    completed = False
+    try:
+        t0 = time.time()
+        for event in events:
+
+            if pipeline or workers > 0:
+                entry, output, event_log = event
+                if output is None:
+                    t0 = time.time()
+                    continue
+                time_read = output['time_read']
+                # the log of the driver in this process is filled directly
+                if save_log and event_log is not logger:
+                    for key,values in event_log.items():
+                        logger[key].extend(values)
+            else:
+                entry, input_data = event
+                print(f'Processing Entry {entry}')
+
+                is_good_event = reader.CheckIntegrity(input_data,ignore_bad_association)
+                if not is_good_event:
+                    print('[ERROR] Skipping the entry')
+                    t0 = time.time()
+                    continue
+                time_read = time.time() - t0
+
+                output = process_entry(driver,input_data,logger)
+
+            # Start data store process (done by the store stage of the pipeline)
+            if 'time_store' in output:
+                time_store = output['time_store']
+            else:
+                t3 = time.time()
+                writer.Store(entry,output)
+                time_store = time.time() - t3
+
+            time_event = time.time() - t0
+            print("--- running driver  {:.2e} seconds ---".format(time_event))
+
+            if save_log:
+                logger['event_id'].append(output['event_id'])
+                logger['time_read'    ].append(time_read)
+                logger['time_convert' ].append(output['time_convert'])
+                logger['time_generate'].append(output['time_generate'])
+                logger['time_store'   ].append(time_store)
+                logger['time_event'   ].append(time_event)
+
+            t0 = time.time()
+        completed = True
+
+    finally:
+        # stop the workers if the loop was interrupted (e.g. by an exception)
+        if pipe is not None:
+            if not completed:
+                events.close()
+        elif workers > 0:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    if pipe is not None:
+        pipe.Report()
+
+    writer.Finalize()
+
+    # store supera log dictionary
+    if save_log:
+        np.savez('log_larnd2supera.npz',**logger)
 
+    print("done")
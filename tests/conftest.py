@@ -0,0 +1,82 @@
+import os
+import sys
+import importlib
+import importlib.util
+
+import h5py as h5
+import numpy as np
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'python')
+
+
+def load(name):
+    '''
+    Import larnd2supera.<name>. Modules that do not need ROOT/supera are loaded from the source file
+    if the package itself cannot be imported (e.g. edep2supera is not installed).
+    '''
+    try:
+        return importlib.import_module('larnd2supera.'+name)
+    except ImportError:
+        pass
+    key = 'larnd2supera_test_'+name
+    if key in sys.modules:
+        return sys.modules[key]
+    spec = importlib.util.spec_from_file_location(key,os.path.join(PYTHON_DIR,'larnd2supera',name+'.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[key] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_config():
+    return dict(event_separator='eventID',CLOCK_CYCLE=0.1)
+
+
+PACKET_DTYPE = np.dtype([('packet_type','u1'),('io_group','u1'),('io_channel','u1'),('chip_id','u1'),
+    ('channel_id','u1'),('timestamp','u8'),('dataword','u1')])
+ASSN_DTYPE = np.dtype([('track_ids','i8',(5,)),('fraction','f8',(5,))])
+SEGMENT_DTYPE = np.dtype([('eventID','i4'),('trackID','i4'),('traj_id','i4'),
+    ('x_start','f4'),('y_start','f4'),('z_start','f4'),('x_end','f4'),('y_end','f4'),('z_end','f4'),
+    ('t0_start','f4'),('t0_end','f4'),('dE','f4')])
+TRAJECTORY_DTYPE = np.dtype([('eventID','i4'),('trackID','i4'),('parentID','i4'),('pdgId','i4')])
+VERTEX_DTYPE = np.dtype([('eventID','i4'),('t_event','f8')])
+
+
+def write_larndsim(path, t0s, segments_per_event=3, packets_per_event=4):
+    '''
+    Write a minimal larnd-sim like file with one event per t0 (event IDs from 0). Each packet of an event
+    is associated to one segment of the same event, and one non-data packet is added per event.
+    '''
+    num_events = len(t0s)
+    segments = np.zeros(num_events*segments_per_event,dtype=SEGMENT_DTYPE)
+    segments['eventID'] = np.repeat(np.arange(num_events),segments_per_event)
+    segments['trackID'] = np.tile(np.arange(segments_per_event),num_events)
+    segments['traj_id'] = segments['trackID']
+    trajectories = np.zeros(num_events*segments_per_event,dtype=TRAJECTORY_DTYPE)
+    trajectories['eventID'] = segments['eventID']
+    trajectories['trackID'] = segments['trackID']
+    trajectories['parentID'] = -1
+
+    packets, assn = [], []
+    for event in range(num_events):
+        p = np.zeros(packets_per_event+1,dtype=PACKET_DTYPE)
+        p['timestamp'] = int(t0s[event]*10) + np.arange(packets_per_event+1)
+        p['packet_type'][-1] = 4
+        a = np.zeros(packets_per_event+1,dtype=ASSN_DTYPE)
+        a['track_ids'] = -1
+        a['track_ids'][:,0] = event*segments_per_event + np.arange(packets_per_event+1) % segments_per_event
+        a['fraction'][:,0] = 1.
+        packets.append(p)
+        assn.append(a)
+
+    vertices = np.zeros(num_events,dtype=VERTEX_DTYPE)
+    vertices['eventID'] = np.arange(num_events)
+    vertices['t_event'] = t0s
+
+    with h5.File(path,'w') as f:
+        f.create_dataset('packets',data=np.concatenate(packets))
+        f.create_dataset('mc_packets_assn',data=np.concatenate(assn))
+        f.create_dataset('tracks',data=segments)
+        f.create_dataset('trajectories',data=trajectories)
+        f.create_dataset('vertices',data=vertices)
+    return path
@@ -0,0 +1,298 @@
+import numpy as np
+import pytest
+
+from conftest import load
+
+association = load('association')
+
+# two TPCs along x with opposite drift directions (borders ordered by z, y, x)
+BORDERS = np.array([[[-30,30],[-60,60],[-30,0]],[[-30,30],[-60,60],[30,0.]]])
+V_DRIFT = 0.16
+TIME_FUTURE, TIME_PAST = 20, 5
+DISTANCE_LIMIT, CHARGE_LIMIT = 2.0, 0.05
+COLUMNS = ('index','x','y','z','t','e','dedx')
+SEGMENT_FIELDS = ('x_start','y_start','z_start','t0_start','x_end','y_end','z_end','t0_end','dEdx')
+
+
+def drift_direction(xyz):
+    for tpc in BORDERS:
+        if not tpc[0][0]-2e-2 <= xyz[2] <= tpc[0][1]+2e-2: continue
+        if not tpc[1][0]-2e-2 <= xyz[1] <= tpc[1][1]+2e-2: continue
+        if not min(tpc[2])-2e-2 <= xyz[0] <= max(tpc[2])+2e-2: continue
+        return -1 if tpc[2][1] > tpc[2][0] else 1
+    return 0
+
+
+def poca(a, b, pt):
+    ab = b - a
+    t = (pt - a).dot(ab)
+    if t <= 0: return 0.
+    d = ab.dot(ab)
+    return 1. if t >= d else t / d
+
+
+def endpoints(seg):
+    a = np.array([seg['x_start'],seg['y_start'],seg['z_start']],float)
+    b = np.array([seg['x_end'],seg['y_end'],seg['z_end']],float)
+    return a, b
+
+
+def along_drift(seg, pt):
+    '''
+    SuperaDriver.associated_along_drift with the drift along x
+    '''
+    a, b = endpoints(seg)
+    f = poca(a[1:],b[1:],pt[1:])
+    direction = [drift_direction(p) for p in (a,b,a+f*(b-a))]
+    if 1 in direction and -1 in direction:
+        raise RuntimeError('segment crossing the cathode')
+    x = (a+f*(b-a))[0]
+    if -1 in direction:
+        return x-TIME_FUTURE*V_DRIFT < pt[0] < x+TIME_PAST*V_DRIFT
+    if 1 in direction:
+        return x-TIME_PAST*V_DRIFT < pt[0] < x+TIME_FUTURE*V_DRIFT
+    raise RuntimeError('segment outside the TPCs')
+
+
+def closest(seg, pt):
+    '''
+    Time and position of the point of closest approach, as in SuperaDriver.AssociateLoop
+    '''
+    a, b = endpoints(seg)
+    if seg['t0_start'] < seg['t0_end']:
+        f = poca(a,b,pt)
+        return seg['t0_start'] + f * (seg['t0_end'] - seg['t0_start']), a + (b - a) * f
+    f = poca(b,a,pt)
+    return seg['t0_end'] + f * (seg['t0_start'] - seg['t0_end']), b + (a - b) * f
+
+
+@pytest.fixture(scope='module')
+def event():
+    rng = np.random.default_rng(1)
+    nseg, npacket, width = 60, 400, 5
+
+    segments = np.zeros(nseg,dtype=[(n,'f4') for n in SEGMENT_FIELDS]+[('traj_id','i4')])
+    side = rng.integers(0,2,nseg)
+    for k in 'xyz':
+        c = rng.uniform(-25,25,nseg)
+        if k == 'x':
+            c = np.where(side==0,-rng.uniform(1,29,nseg),rng.uniform(1,29,nseg))
+        segments[k+'_start'] = c
+        segments[k+'_end'] = c + rng.normal(0,1,nseg)
+    segments['x_end'] = np.clip(segments['x_end'],np.where(side==0,-29.9,0.1),np.where(side==0,-0.1,29.9))
+    segments['t0_start'] = rng.uniform(0,10,nseg)
+    segments['t0_end'] = segments['t0_start'] + rng.normal(0,1,nseg)
+    segments['dEdx'] = rng.uniform(1,3,nseg)
+    segments['traj_id'] = rng.integers(0,12,nseg)
+    # not in the trajectory table
+    segments['traj_id'][0] = 50
+
+    # traj_id 11 is missing from the table
+    trackid2idx = np.full(13,-1)
+    trackid2idx[:11] = np.arange(11)[::-1]
+
+    track_ids = rng.integers(-1,nseg,(npacket,width))
+    fractions = rng.normal(0.3,0.3,(npacket,width))
+    fractions[track_ids < 0] = 0
+    seed = segments[np.clip(track_ids[:,0],0,None)]
+    xyz = np.column_stack([seed['x_start'],seed['y_start'],seed['z_start']]).astype(float) + rng.normal(0,1,(npacket,3))
+    xyz[:,0] = np.clip(xyz[:,0],-29.9,29.9)
+    # keep the associated segments in the TPC of the packet (no segment crossing the cathode)
+    other_tpc = (track_ids >= 0) & (side[np.clip(track_ids,0,None)] != (xyz[:,0] >= 0)[:,None])
+    track_ids[other_tpc] = -1
+    fractions[other_tpc] = 0
+    energy = rng.uniform(0,2,npacket)
+
+    return dict(xyz=xyz, energy=energy, track_ids=track_ids, fractions=fractions,
+        segments=segments, trackid2idx=trackid2idx)
+
+
+def associate_loop(xyz, energy, track_ids, fractions, segments, trackid2idx):
+    '''
+    Packet loop of SuperaDriver.AssociateLoop without the supera containers.
+    Returns the associated EDeps (rows of COLUMNS), the unassociated packet indices and the drop counters.
+    '''
+    associated, unassociated = [], []
+    counts = dict(drop_ctr_negative_charge=0, drop_ctr_low_charge=0, invalid_traj_id=0,
+        drop_ctr_drift_dist=0, drop_ctr_dist3d=0)
+    for ip in range(len(xyz)):
+        flag = track_ids[ip] > -1
+        f = fractions[ip].copy()
+        times = dict()
+        for it in range(track_ids.shape[1]):
+            if not flag[it]:
+                continue
+            if f[it] <= 0:
+                flag[it] = False
+                counts['drop_ctr_negative_charge'] += 1
+                continue
+            if f[it] * energy[ip] < CHARGE_LIMIT:
+                flag[it] = False
+                counts['drop_ctr_low_charge'] += 1
+                continue
+            seg = segments[track_ids[ip,it]]
+            traj_id = int(seg['traj_id'])
+            if traj_id >= len(trackid2idx) or trackid2idx[traj_id] < 0:
+                flag[it] = False
+                counts['invalid_traj_id'] += 1
+                continue
+            if not along_drift(seg,xyz[ip]):
+                flag[it] = False
+                counts['drop_ctr_drift_dist'] += 1
+        for it in range(track_ids.shape[1]):
+            if not flag[it]:
+                continue
+            t, pt = closest(segments[track_ids[ip,it]],xyz[ip])
+            if np.linalg.norm(pt - xyz[ip]) > DISTANCE_LIMIT:
+                flag[it] = False
+                counts['drop_ctr_dist3d'] += 1
+                continue
+            times[it] = t
+        if flag.sum() < 1:
+            unassociated.append(ip)
+            continue
+        fsum = f[flag].sum()
+        f[~flag] = 0
+        f[flag] = f[flag] / fsum if fsum > 0 else f[flag] / flag.sum()
+        for it in np.where(flag)[0]:
+            seg = segments[track_ids[ip,it]]
+            associated.append((trackid2idx[int(seg['traj_id'])],*xyz[ip],times[it],energy[ip]*f[it],seg['dEdx']))
+    return np.array(associated), np.array(unassociated), counts
+
+
+def test_drift_direction():
+    pts = np.random.default_rng(2).uniform(-35,35,(2000,3))
+    assert list(association.drift_direction(pts,BORDERS)) == [drift_direction(p) for p in pts]
+    assert list(association.TPCLookup(BORDERS).DriftDirection(pts)) == [drift_direction(p) for p in pts]
+
+
+def test_numpy_engine_matches_loop(event):
+    expected, unassociated, counts = associate_loop(**event)
+    # every cut is exercised by the synthetic event
+    assert len(expected) and len(unassociated) and all(counts.values())
+
+    res = association.associate(**event,
+        drift_dir=lambda p: association.drift_direction(p,BORDERS),
+        v_drift=V_DRIFT, time_future=TIME_FUTURE, time_past=TIME_PAST,
+        distance_limit=DISTANCE_LIMIT, charge_limit=CHARGE_LIMIT)
+
+    got = np.column_stack([res['associated'][k] for k in COLUMNS])
+    assert got.shape == expected.shape
+    np.testing.assert_allclose(got,expected,rtol=1e-5,atol=1e-5)
+
+    xyz, energy = event['xyz'], event['energy']
+    np.testing.assert_allclose(res['unassociated']['e'],energy[unassociated])
+    for k, axis in zip('xyz',range(3)):
+        np.testing.assert_allclose(res['unassociated'][k],xyz[unassociated,axis])
+
+    for key, value in counts.items():
+        assert res['counts'][key] == value, key
+    assert res['raw_sum'] == pytest.approx(energy.sum())
+    assert res['ana_sum'] == pytest.approx(res['raw_sum'])
+
+
+def search_loop(xyz, segments):
+    '''
+    First segment (in the input order) along the drift and within the distance limit of each point
+    '''
+    index, time = [], []
+    for pt in xyz:
+        found, found_t = -1, 0.
+        for iseg, seg in enumerate(segments):
+            try:
+                if not along_drift(seg,pt):
+                    continue
+            except RuntimeError:
+                continue
+            t, poca_pt = closest(seg,pt)
+            if np.linalg.norm(poca_pt - pt) < DISTANCE_LIMIT:
+                found, found_t = iseg, t
+                break
+        index.append(found)
+        time.append(found_t)
+    return np.array(index), np.array(time)
+
+
+@pytest.mark.parametrize('chunk_size,cell_size',[(1000000,None),(100,None),(7,None),
+    (50,0.5),(50,7.),(50,100.)])
+def test_search_matches_brute_force(event, chunk_size, cell_size):
+    xyz = np.concatenate([event['xyz'],np.random.default_rng(3).uniform(-30,30,(100,3))])
+    expected_index, expected_time = search_loop(xyz,event['segments'])
+    assert (expected_index >= 0).any() and (expected_index < 0).any()
+
+    index, time = association.search(xyz,event['segments'],
+        lambda p: association.drift_direction(p,BORDERS),
+        V_DRIFT, TIME_FUTURE, TIME_PAST, DISTANCE_LIMIT,
+        chunk_size=chunk_size, cell_size=cell_size)
+    np.testing.assert_array_equal(index,expected_index)
+    np.testing.assert_allclose(time,expected_time,atol=1e-5)
+
+
+def compare_jit(event, charge_limit):
+    lookup = association.TPCLookup(BORDERS)
+    limits = dict(v_drift=V_DRIFT, time_future=TIME_FUTURE, time_past=TIME_PAST,
+        distance_limit=DISTANCE_LIMIT, charge_limit=charge_limit)
+    res = association.associate(**event, drift_dir=lookup.DriftDirection, **limits)
+    jit = association.associate_jit(**event, tpc_lookup=lookup, **limits)
+
+    assert len(res['associated']['e'])
+    for key in COLUMNS:
+        np.testing.assert_allclose(jit['associated'][key],res['associated'][key],rtol=1e-6,err_msg=key)
+    for key in res['unassociated']:
+        np.testing.assert_allclose(jit['unassociated'][key],res['unassociated'][key],rtol=1e-6,err_msg=key)
+    for key, value in res['counts'].items():
+        assert jit['counts'][key] == pytest.approx(value), key
+    assert jit['raw_sum'] == pytest.approx(res['raw_sum'])
+    assert jit['ana_sum'] == pytest.approx(res['ana_sum'])
+
+
+@pytest.mark.parametrize('charge_limit',[CHARGE_LIMIT,0.])
+def test_jit_kernel_matches_numpy(event, monkeypatch, charge_limit):
+    # run the kernel as plain python (also when numba is installed)
+    kernel = association._associate_kernel
+    monkeypatch.setattr(association,'_associate_kernel',getattr(kernel,'py_func',kernel))
+    compare_jit(event, charge_limit)
+
+
+@pytest.mark.parametrize('charge_limit',[CHARGE_LIMIT,0.])
+def test_compiled_kernel_matches_numpy(event, charge_limit):
+    pytest.importorskip('numba')
+    assert association.HAS_JIT
+    compare_jit(event, charge_limit)
+
+
+def test_segment_index_out_of_range(event):
+    event = dict(event,track_ids=event['track_ids'].copy())
+    event['track_ids'][3,1] = len(event['segments'])
+    lookup = association.TPCLookup(BORDERS)
+    limits = dict(v_drift=V_DRIFT, time_future=TIME_FUTURE, time_past=TIME_PAST,
+        distance_limit=DISTANCE_LIMIT, charge_limit=CHARGE_LIMIT)
+    with pytest.raises(IndexError):
+        association.associate(**event, drift_dir=lookup.DriftDirection, **limits)
+    with pytest.raises(IndexError):
+        association.associate_jit(**event, tpc_lookup=lookup, **limits)
+
+
+@pytest.mark.parametrize('max_cells',[1,8])
+def test_search_segments_outside_grid(event, monkeypatch, max_cells):
+    # segments covering more than max_cells cells are candidates for all points
+    monkeypatch.setattr(association.SegmentGrid,'MAX_CELLS_PER_SEGMENT',max_cells)
+    xyz = np.concatenate([event['xyz'],np.random.default_rng(3).uniform(-30,30,(100,3))])
+    expected_index, expected_time = search_loop(xyz,event['segments'])
+
+    index, time = association.search(xyz,event['segments'],
+        lambda p: association.drift_direction(p,BORDERS),
+        V_DRIFT, TIME_FUTURE, TIME_PAST, DISTANCE_LIMIT, chunk_size=50, cell_size=0.5)
+    np.testing.assert_array_equal(index,expected_index)
+    np.testing.assert_allclose(time,expected_time,atol=1e-5)
+
+
+def test_grid_size_is_bounded():
+    # a long track with a small padding next to a short segment
+    start = np.array([[-500.,-500.,-500.],[0.,0.,0.]])
+    end   = np.array([[500.,500.,500.],[0.1,0.,0.]])
+    grid = association.SegmentGrid(start,end,1.e-3)
+    assert grid._cell_size >= 1000. / grid.MAX_CELLS_PER_AXIS
+    assert len(grid._segments) <= grid.MAX_CELLS_PER_SEGMENT
+    ipt, iseg = grid.Candidates(np.array([[0.05,0.,0.],[400.,400.,400.]]))
+    assert list(zip(ipt,iseg)) == [(0,0),(0,1),(1,0)]
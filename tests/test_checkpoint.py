@@ -0,0 +1,144 @@
+import json
+import os
+
+import pytest
+
+from conftest import load
+
+checkpoint = load('checkpoint')
+
+JOB = dict(input_files=['a.h5','b.h5'],config='2x2',entries=(0,10),entry_range=None,shard=(0,2))
+
+
+class IOManager:
+    '''
+    Stand-in for the larcv IOManager: the file is created when opened, entries are counted
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.entries = []
+        self.finalized = False
+        open(name,'w').close()
+
+    def finalize(self):
+        self.finalized = True
+
+
+def writer(out_file, checkpoint_size=3, resume=False, job=JOB, overwrite=False, stored=None):
+    opened = []
+
+    def open_output(name):
+        opened.append(IOManager(name))
+        return opened[-1]
+
+    def store_output(io, output):
+        io.entries.append(output)
+        if stored is not None:
+            stored.append(output)
+
+    w = checkpoint.SegmentWriter(out_file,checkpoint_size,resume,overwrite=overwrite,
+        open_output=open_output,store_output=store_output,**job)
+    return w, opened
+
+
+def state(out_file):
+    with open(out_file + checkpoint.SegmentWriter.CHECKPOINT_SUFFIX) as f:
+        return json.load(f)
+
+
+def test_fresh_start(tmp_path):
+    out = str(tmp_path/'out.root')
+    w, opened = writer(out)
+    assert w.NextEntry() == 0 and not w.Done()
+    assert w.OutputFiles() == [str(tmp_path/f'out_{i:04d}.root') for i in range(4)]
+    for entry in range(10):
+        w.Store(entry,entry)
+    w.Finalize()
+    assert w.Done()
+    assert [io.entries for io in opened] == [[0,1,2],[3,4,5],[6,7,8],[9]]
+    assert all(io.finalized for io in opened)
+    s = state(out)
+    assert s['done'] and s['next_entry'] == 10 and s['segments'] == w.OutputFiles()
+    # nothing left to do
+    w, opened = writer(out,resume=True)
+    assert w.Done() and not opened
+
+
+def test_single_output(tmp_path):
+    out = str(tmp_path/'out.root')
+    w, opened = writer(out,checkpoint_size=0)
+    for entry in range(10):
+        w.Store(entry,entry)
+    w.Finalize()
+    assert [io.name for io in opened] == [out] and len(opened[0].entries) == 10
+    assert not os.path.exists(out + checkpoint.SegmentWriter.CHECKPOINT_SUFFIX)
+    with pytest.raises(FileExistsError):
+        writer(out,checkpoint_size=0)
+    with pytest.raises(FileExistsError):
+        writer(out,checkpoint_size=0,resume=True)
+
+
+def test_resume(tmp_path):
+    out = str(tmp_path/'out.root')
+    w, opened = writer(out)
+    # killed during the third segment
+    for entry in range(7):
+        w.Store(entry,entry)
+    assert state(out)['next_entry'] == 6 and len(state(out)['segments']) == 2
+
+    # a new job without --resume does not touch the outputs
+    with pytest.raises(FileExistsError):
+        writer(out)
+
+    stored = []
+    w, opened = writer(out,resume=True,stored=stored)
+    assert w.NextEntry() == 6 and len(w.Segments()) == 2
+    for entry in range(w.NextEntry(),10):
+        w.Store(entry,entry)
+    w.Finalize()
+    assert stored == [6,7,8,9]
+    # the unfinished segment is written again
+    assert [io.name for io in opened] == w.OutputFiles()[2:]
+    assert state(out)['done'] and state(out)['segments'] == w.OutputFiles()
+
+
+@pytest.mark.parametrize('change',[dict(shard=(1,2)),dict(config='other'),dict(input_files=['a.h5']),
+    dict(entries=(0,20)),dict(entry_range=(0,5))])
+def test_resume_mismatch(tmp_path, change):
+    out = str(tmp_path/'out.root')
+    w, _ = writer(out)
+    for entry in range(4):
+        w.Store(entry,entry)
+    with pytest.raises(ValueError):
+        writer(out,resume=True,job=dict(JOB,**change))
+
+
+def test_resume_corrupt_checkpoint(tmp_path):
+    out = str(tmp_path/'out.root')
+    w, _ = writer(out)
+    for entry in range(4):
+        w.Store(entry,entry)
+    with open(out + checkpoint.SegmentWriter.CHECKPOINT_SUFFIX,'w') as f:
+        f.write('{"segments": [')
+    with pytest.raises(ValueError):
+        writer(out,resume=True)
+
+
+def test_existing_segments(tmp_path):
+    out = str(tmp_path/'out.root')
+    # a segment file of an earlier job without checkpoint
+    open(str(tmp_path/'out_0002.root'),'w').close()
+    for resume in (False,True):
+        with pytest.raises(FileExistsError,match='out_0002.root'):
+            writer(out,resume=resume)
+
+    w, opened = writer(out,overwrite=True)
+    for entry in range(10):
+        w.Store(entry,entry)
+    w.Finalize()
+    assert len(opened) == 4 and state(out)['done']
+
+    # a new job overwriting the outputs does not leave the old checkpoint behind
+    w, opened = writer(out,overwrite=True)
+    assert not os.path.exists(out + checkpoint.SegmentWriter.CHECKPOINT_SUFFIX)
+    assert w.NextEntry() == 0
@@ -0,0 +1,66 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import LarpixParser
+from LarpixParser import hit_parser as HitParser
+from LarpixParser import util
+
+from conftest import load, PACKET_DTYPE
+
+geometry = load('geometry')
+
+CONFIG_DIR = os.path.join(os.path.dirname(LarpixParser.__file__),'config_repo')
+
+
+@pytest.fixture(scope='module')
+def geom_dict():
+    with open(os.path.join(CONFIG_DIR,'dict_repo','multi_tile_layout-2.3.16.pkl'),'rb') as f:
+        return pickle.load(f)
+
+
+@pytest.fixture(scope='module')
+def packets(geom_dict):
+    run_config = util.get_run_config('2x2.yaml',use_builtin=True)
+    rng = np.random.default_rng(1)
+    keys = np.array(list(geom_dict.keys()))
+    keys = keys[rng.integers(0,len(keys),500)]
+    packets = np.zeros(len(keys),dtype=PACKET_DTYPE)
+    # io_group of any module
+    module = rng.integers(0,4,len(keys))
+    packets['io_group'] = keys[:,0] + module * run_config['nr_iogroup_module']
+    for i, name in enumerate(geometry.CHANNEL_FIELDS[1:]):
+        packets[name] = keys[:,i+1]
+    packets['timestamp'] = rng.integers(100,2000,len(keys))
+    packets['dataword'] = rng.integers(0,256,len(keys))
+    packets['packet_type'][rng.random(len(keys)) < 0.1] = 4
+    return run_config, packets
+
+
+@pytest.mark.parametrize('switch_xz',[True,False])
+def test_hit_parser_energy(geom_dict, packets, switch_xz):
+    run_config, packets = packets
+    pixels = geometry.PixelGeometry.FromDict(geom_dict)
+    num_data = (packets['packet_type'] == 0).sum()
+    for t0 in (12.5, np.linspace(0,50,num_data)):
+        expected = HitParser.hit_parser_energy(t0,packets,geom_dict,run_config,switch_xz)
+        result = pixels.HitParserEnergy(t0,packets,run_config,switch_xz)
+        for got, ref in zip(result,expected):
+            np.testing.assert_allclose(got,np.asarray(ref,dtype=float),rtol=1e-12)
+
+
+def test_lookup_unknown_channel(geom_dict):
+    pixels = geometry.PixelGeometry.FromDict(geom_dict)
+    with pytest.raises(KeyError):
+        pixels.Lookup([1],[1],[1000],[0])
+
+
+def test_load_cache(geom_dict, tmp_path, monkeypatch):
+    monkeypatch.setenv(geometry.CACHE_DIR_ENV,str(tmp_path))
+    compiled = geometry.PixelGeometry.Load('test',geom_dict)
+    assert os.listdir(tmp_path) == ['pixel_geometry_test.npz']
+    # loaded from the cache (no dictionary)
+    cached = geometry.PixelGeometry.Load('test',None)
+    for key in ('shape','index','table'):
+        assert np.array_equal(getattr(cached,key),getattr(compiled,key))
@@ -0,0 +1,131 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from conftest import load
+
+particle_type = load('particle_type')
+
+# values of the TG4TrajectoryPoint enums
+CODES = dict(kProcessElectromagetic=2, kProcessHadronic=4, kProcessDecay=6,
+    kSubtypeEMIonization=2, kSubtypeEMPairProdByCharged=4, kSubtypeEMPhotoelectric=12,
+    kSubtypeEMComptonScattering=13, kSubtypeEMGammaConversion=14)
+THRESHOLD = 0.5
+
+
+def set_process_type(pdg, parent_pdg, trackid, parent_trackid, main, sub, ke, dr):
+    '''
+    The if/elif chain of SuperaDriver.SetProcessType (None for the ValueError)
+    '''
+    if pdg == 2112:
+        return 'kNeutron'
+    elif pdg > 1000000000:
+        return 'kNucleus'
+    elif trackid == parent_trackid:
+        return 'kPrimary'
+    elif pdg == 22:
+        return 'kPhoton'
+    elif abs(pdg) == 11:
+        if main == CODES['kProcessElectromagetic']:
+            if sub == CODES['kSubtypeEMPhotoelectric']:
+                return 'kPhotoElectron'
+            elif sub == CODES['kSubtypeEMComptonScattering']:
+                return 'kCompton'
+            elif sub == CODES['kSubtypeEMGammaConversion'] or sub == CODES['kSubtypeEMPairProdByCharged']:
+                return 'kConversion'
+            elif sub == CODES['kSubtypeEMIonization']:
+                if abs(parent_pdg) == 11:
+                    return 'kIonization'
+                elif abs(parent_pdg) in [211,13,2212,321]:
+                    return 'kDelta'
+                elif parent_pdg == 22:
+                    return 'kCompton'
+                else:
+                    return 'kIonization'
+            else:
+                return None
+        elif main == CODES['kProcessDecay']:
+            return 'kDecay'
+        elif main == CODES['kProcessHadronic'] and sub == 151 and dr < 0.0001:
+            if ke < THRESHOLD:
+                return 'kIonization'
+            else:
+                return 'kDecay'
+        else:
+            if ke < THRESHOLD:
+                return 'kCompton'
+            else:
+                return 'kOtherShower'
+    else:
+        return 'kTrack'
+
+
+FIELDS = ('pdg','parent_pdg','trackid','parent_trackid','process_main','process_sub','ke','dr')
+
+
+def classify(cases):
+    cols = {key:np.array(values) for key, values in zip(FIELDS,zip(*cases))}
+    rule = particle_type.classify(cols, CODES, THRESHOLD)
+    return [particle_type.RULES[irule][0] for irule in rule]
+
+
+# one case per branch of the chain: (pdg, parent_pdg, trackid, parent_trackid, main, sub, ke, dr)
+BRANCHES = [
+    ((2112, 11, 1, 1, 2, 2, 1., 0.), 'kNeutron'),
+    ((1000180400, 11, 2, 1, 2, 2, 1., 0.), 'kNucleus'),
+    ((13, 0, 1, 1, 0, 0, 1., 1.e20), 'kPrimary'),
+    ((11, 0, 1, 1, 2, 2, 1., 1.e20), 'kPrimary'),
+    ((22, 11, 2, 1, 2, 3, 1., 0.), 'kPhoton'),
+    ((2212, 2112, 2, 1, 4, 121, 1., 0.), 'kTrack'),
+    ((-13, 211, 2, 1, 6, 201, 1., 0.), 'kTrack'),
+    ((11, 22, 2, 1, 2, 12, 1., 0.), 'kPhotoElectron'),
+    ((11, 22, 2, 1, 2, 13, 1., 0.), 'kCompton'),
+    ((-11, 22, 2, 1, 2, 14, 1., 0.), 'kConversion'),
+    ((11, 13, 2, 1, 2, 4, 1., 0.), 'kConversion'),
+    ((11, -11, 2, 1, 2, 2, 1., 0.), 'kIonization'),
+    ((11, -211, 2, 1, 2, 2, 1., 0.), 'kDelta'),
+    ((11, 2212, 2, 1, 2, 2, 1., 0.), 'kDelta'),
+    ((11, 22, 2, 1, 2, 2, 1., 0.), 'kCompton'),
+    ((11, 2112, 2, 1, 2, 2, 1., 0.), 'kIonization'),
+    ((11, 11, 2, 1, 2, 3, 1., 0.), None),
+    ((11, 13, 2, 1, 6, 201, 1., 0.), 'kDecay'),
+    ((11, 13, 2, 1, 4, 151, 0.1, 0.), 'kIonization'),
+    ((11, 13, 2, 1, 4, 151, 1., -5.), 'kDecay'),
+    ((11, 13, 2, 1, 4, 151, 0.1, 1.), 'kCompton'),
+    ((11, 13, 2, 1, 4, 121, 1., 0.), 'kOtherShower'),
+    ((-11, 22, 2, 1, 0, 0, 1., 0.), 'kOtherShower'),
+    ]
+
+
+@pytest.mark.parametrize('case,expected',BRANCHES)
+def test_branches(case, expected):
+    assert set_process_type(*case) == expected
+    assert classify([case]) == [expected]
+
+
+def test_all_rules_covered():
+    rules = particle_type.classify({key:np.array(values) for key, values in
+        zip(FIELDS,zip(*[case for case,_ in BRANCHES]))}, CODES, THRESHOLD)
+    assert set(rules.tolist()) == set(range(len(particle_type.RULES)))
+
+
+def test_matches_chain():
+    # all combinations of values around each condition of the chain
+    cases = list(itertools.product([2112,1000020040,22,11,-11,13,2212],
+        [11,-11,22,13,-211,321,2212,2112,0],
+        [1,2], [1],
+        [0,2,4,6], [0,2,3,4,12,13,14,151],
+        [0.1,THRESHOLD,1.], [-1.,0.,1.e20]))
+    assert classify(cases) == [set_process_type(*case) for case in cases]
+
+
+def test_g4_codes():
+    class ProcessType:
+        kProcessElectromagetic, kProcessHadronic, kProcessDecay = 2, 4, 6
+
+    class ProcessSubtype:
+        kSubtypeEMIonization, kSubtypeEMPairProdByCharged = 2, 4
+        kSubtypeEMPhotoelectric, kSubtypeEMComptonScattering, kSubtypeEMGammaConversion = 12, 13, 14
+
+    assert particle_type.g4_codes(ProcessType, ProcessSubtype) == CODES
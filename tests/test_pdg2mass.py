@@ -0,0 +1,40 @@
+import numpy as np
+
+from conftest import load
+
+pdg2mass = load('pdg2mass')
+
+
+def check(codes):
+    expected = np.array([pdg2mass.pdg2mass(code) for code in codes],dtype=float)
+    np.testing.assert_array_equal(pdg2mass.pdg2mass_array(codes),expected)
+
+
+def test_table_codes():
+    codes = pdg2mass._PDG_DATA['pdg_code']
+    assert len(codes)
+    check(codes.tolist())
+    # electron mass in MeV
+    assert np.isclose(pdg2mass.pdg2mass_array([11,-11]),0.511,atol=1e-3).all()
+
+
+def test_nuclei():
+    # 100ZZZAAAI: the mass is A x 1000 MeV
+    codes = [1000010010, 1000020040, 1000060120, 1000180400, 1000260561, 1000822080, 1000000010]
+    check(codes)
+    assert pdg2mass.pdg2mass_array(codes).tolist() == [1000., 4000., 12000., 40000., 56000., 208000., 1000.]
+
+
+def test_unknown_codes():
+    known = set(pdg2mass._PDG_DATA['pdg_code'].tolist())
+    codes = [code for code in [0, 1, 7, 99, 8888, 12345, 123456789, 99999999, -99999999, 1000000000,
+        int(pdg2mass._PDG_CODES.max())+1, int(pdg2mass._PDG_CODES.min())-1] if code not in known]
+    assert len(codes) >= 8
+    check(codes)
+    assert (pdg2mass.pdg2mass_array(codes) == -1).all()
+
+
+def test_shape():
+    codes = np.array([[11,2212],[1000180400,12345]])
+    assert pdg2mass.pdg2mass_array(codes).shape == (2,2)
+    assert pdg2mass.pdg2mass_array([]).shape == (0,)
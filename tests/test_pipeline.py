@@ -0,0 +1,119 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from conftest import load
+
+pipeline = load('pipeline')
+
+
+def jitter(item):
+    # random processing time so that threads finish out of order
+    time.sleep(np.random.default_rng(item).uniform(0,2e-3))
+    return item
+
+
+def square(item):
+    return item * item
+
+
+def test_order():
+    pipe = pipeline.Pipeline(queue_size=3)
+    pipe.AddStage('first',jitter,workers=4)
+    pipe.AddStage('second',lambda x: None if x % 7 == 0 else x+1000,workers=3)
+    pipe.AddStage('last',jitter,workers=2)
+    assert list(pipe.Run(range(100))) == [x+1000 for x in range(100) if x % 7]
+
+
+def test_ordered_stage():
+    seen = []
+    pipe = pipeline.Pipeline(queue_size=2)
+    pipe.AddStage('first',jitter,workers=4)
+    pipe.AddStage('store',lambda x: seen.append(x) or x,ordered=True)
+    assert list(pipe.Run(range(50))) == list(range(50))
+    assert seen == list(range(50))
+    with pytest.raises(ValueError):
+        pipe.AddStage('store',square,workers=2,ordered=True)
+    with pytest.raises(ValueError):
+        pipe.AddStage('none',square,workers=0)
+
+
+def test_process_stage():
+    pipe = pipeline.Pipeline()
+    pipe.AddStage('square',square,workers=2,processes=True)
+    assert list(pipe.Run(range(20))) == [x*x for x in range(20)]
+
+
+def test_bounded_queues():
+    queue_size = 2
+    produced = []
+
+    def source():
+        for item in range(100):
+            produced.append(item)
+            yield item
+
+    pipe = pipeline.Pipeline(queue_size=queue_size)
+    pipe.AddStage('first',lambda x: x,workers=2)
+    pipe.AddStage('second',lambda x: x)
+    outputs = pipe.Run(source())
+    assert next(outputs) == 0
+    time.sleep(0.3)
+    # items held by the queues (2 stages and the output), the workers and the feeder
+    assert len(produced) <= 3*queue_size + 3 + 1 + 1
+    assert list(outputs) == list(range(1,100))
+    for stats in pipe.Stats().values():
+        assert stats['queue_max'] <= queue_size
+
+
+def test_stage_error():
+    def fail(item):
+        if item == 10:
+            raise RuntimeError('stage failed')
+        return item
+
+    threads = threading.active_count()
+    pipe = pipeline.Pipeline(queue_size=2)
+    pipe.AddStage('first',lambda x: x,workers=2)
+    pipe.AddStage('fail',fail,workers=2)
+    pipe.AddStage('last',lambda x: x)
+    outputs = []
+    with pytest.raises(RuntimeError,match='stage failed'):
+        for item in pipe.Run(range(1000)):
+            outputs.append(item)
+    assert len(outputs) < 1000
+    # all the stage threads are stopped
+    assert threading.active_count() == threads
+
+
+def test_source_error():
+    def source():
+        yield from range(5)
+        raise KeyError('source failed')
+
+    pipe = pipeline.Pipeline()
+    pipe.AddStage('first',lambda x: x)
+    with pytest.raises(KeyError):
+        list(pipe.Run(source()))
+
+
+def test_stats():
+    pipe = pipeline.Pipeline(queue_size=4)
+    with pytest.raises(RuntimeError):
+        next(pipe.Run(range(3)))
+    pipe.AddStage('drop',lambda x: None if x % 2 else x,workers=2)
+    pipe.AddStage('sleep',lambda x: time.sleep(1e-3) or x)
+    assert len(list(pipe.Run(range(40)))) == 20
+
+    stats = pipe.Stats()
+    assert list(stats) == ['drop','sleep']
+    assert stats['drop']['items'] == 40 and stats['drop']['workers'] == 2
+    # dropped items are not processed by later stages
+    assert stats['sleep']['items'] == 20 and stats['sleep']['workers'] == 1
+    assert stats['sleep']['busy_time'] >= 20e-3
+    for s in stats.values():
+        assert 0 <= s['utilization'] <= 1
+        assert s['queue_size'] == 4
+        assert 0 <= s['queue_mean'] <= s['queue_max'] <= 4
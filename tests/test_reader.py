@@ -0,0 +1,146 @@
+import os
+import pickle
+
+import h5py as h5
+import numpy as np
+import pytest
+
+from conftest import load, run_config, write_larndsim
+
+reader = load('reader')
+
+
+@pytest.fixture
+def two_files(tmp_path):
+    # event IDs start from 0 in both files, with different t0s
+    first  = write_larndsim(str(tmp_path/'first.h5'),np.arange(20)+1.)
+    second = write_larndsim(str(tmp_path/'second.h5'),np.arange(15)+1001.)
+    return [first,second]
+
+
+@pytest.mark.parametrize('kwargs',[dict(),
+    dict(streaming=True),
+    dict(use_mmap=False),
+    dict(fields=dict(segments=('eventID','trackID','traj_id'),trajectories=('eventID','trackID'))),
+    ])
+def test_t0_per_file(two_files, kwargs):
+    r = reader.InputReader(run_config(),two_files,**kwargs)
+    assert len(r) == 35
+    for entry in range(len(r)):
+        data = r.GetEntry(entry)
+        expected = entry + 1. if entry < 20 else entry - 20 + 1001.
+        assert data.event_id == (entry if entry < 20 else entry - 20)
+        assert data.t0 == expected
+        assert (data.segments['eventID'] == data.event_id).all()
+    r.Close()
+
+
+class RecordT0:
+    '''
+    Stand-in for PixelGeometry: x is the t0 given to each data packet
+    '''
+    def HitParserEnergy(self, t0, packets, run_config, switch_xz=True):
+        t0 = np.broadcast_to(t0,len(packets)).astype(float)
+        return t0, t0, t0, t0
+
+
+def test_precompute_hits_t0_per_file(two_files):
+    r = reader.InputReader(run_config(),two_files,chunk_size=7,hit_geometry=RecordT0())
+    for entry in [0,19,20,34,5,25]:
+        data = r.GetEntry(entry)
+        mask = data.packets['packet_type'] == 0
+        assert np.all(data.hits['x'][mask] == (entry + 1. if entry < 20 else entry - 20 + 1001.))
+        assert np.isnan(data.hits['x'][~mask]).all()
+
+
+@pytest.fixture
+def bad_file(tmp_path):
+    path = write_larndsim(str(tmp_path/'bad.h5'),np.arange(10)+1.)
+    with h5.File(path,'r+') as f:
+        assn = f['mc_packets_assn'][:]
+        # a packet of event 5 also associated to a segment of event 3
+        assn['track_ids'][5*5,1] = 3*3
+        f['mc_packets_assn'][:] = assn
+        trajectories = f['trajectories'][:]
+        # a segment of event 7 pointing to a missing trajectory
+        trajectories['trackID'][7*3+2] = 1
+        f['trajectories'][:] = trajectories
+    return path
+
+
+def test_check_integrity_uses_file_counts(bad_file, monkeypatch):
+    r = reader.InputReader(run_config(),bad_file)
+    expected = [r.IntegrityCounts(r.GetEntry(entry)) for entry in range(len(r))]
+
+    r = reader.InputReader(run_config(),bad_file,check_integrity=True)
+    report = r.IntegrityReport()
+    for entry, counts in enumerate(expected):
+        assert counts == {key:int(val[entry]) for key,val in report.items()}
+
+    # the per-event counts are not recomputed when the whole-file check ran
+    monkeypatch.setattr(r,'IntegrityCounts',None)
+    for entry in range(len(r)):
+        data = r.GetEntry(entry)
+        good = r.CheckIntegrity(data,fix_association=True)
+        assert good == (entry != 7)
+        if entry == 5:
+            assert (data.mc_packets_assn['track_ids'][0] == [15,-1,-1,-1,-1]).all()
+    # the fix is not applied to the reader buffer
+    assert (r.GetEntry(5).mc_packets_assn['track_ids'][0] == [15,9,-1,-1,-1]).all()
+
+
+def test_integrity_counts_negative_traj_id():
+    r = reader.InputReader(run_config())
+    # entry 0 has trajectories 0, 1, 2 and entry 1 has a segment with traj_id -1
+    counts = r._integrity_counts(2,
+        np.array([0,0,1]),np.array([0,1,0]),np.array([0,1,-1]),
+        np.array([0,0,0,1]),np.array([0,1,2,0]),
+        np.array([],dtype=int),np.zeros((0,5),dtype=int),np.array([0,2]),np.array([2,3]))
+    assert list(counts['invalid_traj_id']) == [0,1]
+
+
+class CountCalls(RecordT0):
+
+    calls = 0
+
+    def HitParserEnergy(self, t0, packets, run_config, switch_xz=True):
+        CountCalls.calls += 1
+        return super().HitParserEnergy(t0, packets, run_config, switch_xz)
+
+
+def test_pickled_reader_keeps_index_and_hits(two_files):
+    r = reader.InputReader(run_config(),two_files,chunk_size=7,hit_geometry=CountCalls(),entry_range=(5,30))
+    r.GetEntry(0)
+    r.ParseHits()
+    calls = CountCalls.calls
+
+    copy = pickle.loads(pickle.dumps(r))
+    assert len(copy) == len(r) == 25
+    for entry in range(len(copy)):
+        data, expected = copy.GetEntry(entry), r.GetEntry(entry)
+        assert data.event_id == expected.event_id and data.t0 == expected.t0
+        for key in data.hits.dtype.names:
+            assert np.array_equal(data.hits[key],expected.hits[key],equal_nan=True)
+    # the hits were parsed once, before pickling
+    assert CountCalls.calls == calls
+
+
+def test_index_cache(two_files):
+    config = dict(run_config(),tpc_offsets=np.zeros((2000,3)))
+    r = reader.InputReader(config,two_files,index_cache=True)
+    expected = [r.GetEntry(entry).event_id for entry in range(len(r))]
+    r.Close()
+    for fname in two_files:
+        cache = fname + reader.InputReader.INDEX_CACHE_SUFFIX
+        assert os.path.isfile(cache)
+        # no temporary file is left behind
+        assert [name for name in os.listdir(os.path.dirname(fname)) if name.endswith('.tmp')] == []
+
+    r = reader.InputReader(config,two_files,index_cache=True)
+    assert [r.GetEntry(entry).event_id for entry in range(len(r))] == expected
+
+    # a difference in the middle of a large array (elided by the numpy repr) changes the key
+    other = dict(config,tpc_offsets=config['tpc_offsets'].copy())
+    other['tpc_offsets'][1000,1] = 1.
+    assert reader.InputReader(other,two_files)._config_hash() != r._config_hash()
+    assert reader.InputReader(dict(config),two_files)._config_hash() == r._config_hash()